@@ -2,7 +2,7 @@ from flask import Flask
 from flask_socketio import SocketIO
 from .extensions import db, login_manager
 
-socketio = SocketIO(cors_allowed_origins='*', async_mode='eventlet')
+socketio = SocketIO(cors_allowed_origins='*')
 
 def create_app():
     app = Flask(__name__, template_folder='templates', static_folder='static')
@@ -12,14 +12,59 @@ def create_app():
     app.config.from_object(Config)
     
     db.init_app(app)
+    from . import database
+    database.init_app(app)
     login_manager.init_app(app)
-    socketio.init_app(app)
+    from . import passwords
+    passwords.init_app(app)
+    # With a message queue every worker relays room broadcasts through it,
+    # so a client on one worker receives messages emitted on another
+    socketio.init_app(
+        app,
+        async_mode=app.config['SOCKETIO_ASYNC_MODE'],
+        message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'],
+        channel=app.config['SOCKETIO_CHANNEL'],
+        cookie=app.config['SOCKETIO_COOKIE'],
+    )
     
     from .views import main_bp
     from .auth import auth_bp
+    from .api import api_bp
     
     app.register_blueprint(main_bp)
     app.register_blueprint(auth_bp, url_prefix='/auth')
+    app.register_blueprint(api_bp, url_prefix='/api')
+    
+    from . import commands
+    commands.init_app(app)
+    
+    from .jobs import jobs
+    jobs.init_app(app)
+    
+    from . import media
+    media.init_app(app)
+    
+    from .chat_buffer import message_buffer
+    message_buffer.init_app(app)
+    
+    from .user_cache import user_cache
+    user_cache.init_app(app)
+    
+    from .cache import fragment_cache
+    fragment_cache.init_app(app)
+    
+    from .notifications import notifier
+    notifier.init_app(app)
+    
+    from .matching import distances
+    distances.init_app(app)
+    
+    from . import instrumentation, matching, payments, reservations
+    instrumentation.init_app(app)
+    for prefix, stats in (('reservations', reservations.stats), ('chat_buffer', message_buffer.stats),
+                          ('user_cache', user_cache.stats), ('jobs', jobs.stats), ('notifications', notifier.stats),
+                          ('matching', matching.stats), ('ledger', payments.stats)):
+        instrumentation.metrics.register(prefix, stats)
     
     # Import socketio handlers to register events
     from . import socketio_handlers
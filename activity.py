@@ -0,0 +1,126 @@
+from collections import defaultdict
+from sqlalchemy import func, select, union_all
+from .extensions import db
+from .payments import link_bookings, settled
+from .models.models import ArchivedRide, Booking, Payment, Ride, UserActivity
+
+# Per-user totals for the dashboard. Each event adds its deltas to the user's
+# UserActivity row in the same transaction as the change itself, so reading the
+# totals is one primary-key lookup however long the user's history is.
+
+COUNTERS = ('trips_paid', 'trips_completed', 'seats_booked', 'spent',
+            'rides_completed', 'rides_cancelled', 'seats_filled', 'earned')
+
+
+def _dialect_insert():
+    # INSERT ... ON CONFLICT DO UPDATE where the backend has it
+    dialect = db.session.get_bind(mapper=UserActivity).dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    return insert
+
+
+def record(deltas):
+    """Add {user_id: {counter: delta}} to the users' totals, creating rows as needed.
+
+    One multi-row upsert for all the users; the additions happen in the
+    database, so concurrent events never overwrite each other's counts.
+    Does not commit.
+    """
+    rows = [dict({counter: 0 for counter in COUNTERS}, **changes, user_id=user_id)
+            for user_id, changes in deltas.items() if user_id is not None and any(changes.values())]
+    if not rows:
+        return
+    insert = _dialect_insert()
+    if insert is not None:
+        stmt = insert(UserActivity)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UserActivity.user_id],
+            set_={counter: getattr(UserActivity, counter) + getattr(stmt.excluded, counter) for counter in COUNTERS})
+        db.session.execute(stmt, rows)
+        return
+    for row in rows:
+        updated = UserActivity.query.filter_by(user_id=row['user_id']).update(
+            {getattr(UserActivity, counter): getattr(UserActivity, counter) + row[counter] for counter in COUNTERS},
+            synchronize_session=False)
+        if not updated:
+            db.session.execute(UserActivity.__table__.insert(), [row])
+
+
+def paid(rider_id, driver_id, amount, seats):
+    deltas = defaultdict(dict)
+    deltas[rider_id].update(trips_paid=1, seats_booked=seats, spent=amount)
+    deltas[driver_id].update(seats_filled=seats, earned=amount)
+    record(deltas)
+
+
+def refunded(refunds):
+    """Reverse paid() for (rider_id, driver_id, amount, seats) tuples."""
+    deltas = defaultdict(lambda: defaultdict(int))
+    for rider_id, driver_id, amount, seats in refunds:
+        deltas[rider_id]['trips_paid'] -= 1
+        deltas[rider_id]['seats_booked'] -= seats
+        deltas[rider_id]['spent'] -= amount
+        deltas[driver_id]['seats_filled'] -= seats
+        deltas[driver_id]['earned'] -= amount
+    record(deltas)
+
+
+def ride_completed(driver_id, rider_ids):
+    deltas = {rider_id: {'trips_completed': 1} for rider_id in rider_ids}
+    deltas.setdefault(driver_id, {})['rides_completed'] = 1
+    record(deltas)
+
+
+def rides_cancelled(driver_id, count=1):
+    record({driver_id: {'rides_cancelled': count}})
+
+
+def totals(user_id):
+    row = db.session.get(UserActivity, user_id)
+    return {counter: getattr(row, counter) if row else 0 for counter in COUNTERS}
+
+
+def rebuild():
+    """Recompute every user's totals from payments, bookings and rides (live and archived)."""
+    deltas = defaultdict(lambda: defaultdict(int))
+    # Each settled charge belongs to one booking; older rows get theirs filled in first
+    link_bookings()
+    paid_bookings = db.session.query(Payment.payer_id, Ride.driver_id, Payment.amount, Booking.seats_booked) \
+        .join(Ride, Ride.id == Payment.ride_id) \
+        .join(Booking, Booking.id == Payment.booking_id) \
+        .filter(settled()).subquery()
+
+    for rider_id, trips, seats, spent in db.session.query(
+            paid_bookings.c.payer_id, func.count(), func.sum(paid_bookings.c.seats_booked),
+            func.sum(paid_bookings.c.amount)).group_by(paid_bookings.c.payer_id):
+        deltas[rider_id].update(trips_paid=trips, seats_booked=int(seats or 0), spent=spent or 0.0)
+
+    for driver_id, seats, earned in db.session.query(
+            paid_bookings.c.driver_id, func.sum(paid_bookings.c.seats_booked),
+            func.sum(paid_bookings.c.amount)).group_by(paid_bookings.c.driver_id):
+        deltas[driver_id].update(seats_filled=int(seats or 0), earned=earned or 0.0)
+
+    for rider_id, trips in db.session.query(Booking.rider_id, func.count(Booking.id)) \
+            .join(Ride, Ride.id == Booking.ride_id) \
+            .filter(Booking.status == 'confirmed', Ride.status == 'completed').group_by(Booking.rider_id):
+        deltas[rider_id]['trips_completed'] = trips
+
+    # Finished rides nobody paid for may already have moved to the archive
+    rides = union_all(select(Ride.driver_id, Ride.status), select(ArchivedRide.driver_id, ArchivedRide.status)) \
+        .subquery()
+    for driver_id, status, count in db.session.query(rides.c.driver_id, rides.c.status, func.count()) \
+            .filter(rides.c.status.in_(('completed', 'cancelled'))).group_by(rides.c.driver_id, rides.c.status):
+        deltas[driver_id][f'rides_{status}'] = count
+
+    UserActivity.query.delete(synchronize_session=False)
+    rows = [dict({counter: 0 for counter in COUNTERS}, **changes, user_id=user_id)
+            for user_id, changes in deltas.items() if user_id is not None]
+    if rows:
+        db.session.execute(UserActivity.__table__.insert(), rows)
+    db.session.commit()
+    return len(rows)
@@ -0,0 +1,32 @@
+from datetime import date, timedelta
+from sqlalchemy import func
+from .extensions import db
+from .payments import settled
+from .models.models import User, Ride, Payment, Report
+
+
+def admin_summary(days=14):
+    # Every figure is a single aggregate query; nothing is counted in Python
+    users_by_verified = dict(db.session.query(User.verified, func.count(User.id)).group_by(User.verified).all())
+    rides_by_status = dict(db.session.query(Ride.status, func.count(Ride.id)).group_by(Ride.status).all())
+
+    since = date.today() - timedelta(days=days - 1)
+    rides_per_day = db.session.query(Ride.date, func.count(Ride.id)) \
+        .filter(Ride.date >= since).group_by(Ride.date).order_by(Ride.date).all()
+
+    revenue, payments = db.session.query(func.coalesce(func.sum(Payment.amount), 0.0), func.count(Payment.id)) \
+        .filter(settled()).one()
+
+    pending_reports = db.session.query(func.count(Report.id)).filter(Report.status == 'pending').scalar()
+
+    return {
+        'users_total': sum(users_by_verified.values()),
+        'users_verified': users_by_verified.get(True, 0),
+        'users_pending': users_by_verified.get(False, 0) + users_by_verified.get(None, 0),
+        'rides_total': sum(rides_by_status.values()),
+        'rides_by_status': rides_by_status,
+        'rides_per_day': rides_per_day,
+        'revenue': revenue,
+        'payments': payments,
+        'reports_pending': pending_reports,
+    }
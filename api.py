@@ -0,0 +1,94 @@
+import json
+from flask import Blueprint, Response, current_app, jsonify, request, stream_with_context
+from flask_login import current_user
+from . import fares, matching, search
+from .models.models import Landmark
+from .pagination import clamp_page_size
+
+api_bp = Blueprint('api', __name__)
+
+
+def ride_to_dict(ride):
+    return {
+        'id': ride.id,
+        'driver_id': ride.driver_id,
+        'origin': ride.origin,
+        'destination': ride.destination,
+        'date': ride.date.isoformat() if ride.date else None,
+        'time': ride.time.strftime('%H:%M') if ride.time else None,
+        'seats': ride.seats,
+        'price': ride.price,
+        'status': ride.status,
+        'origin_coords': [ride.origin_lat, ride.origin_lon] if ride.origin_lat is not None else None,
+        'destination_coords': [ride.destination_lat, ride.destination_lon] if ride.destination_lat is not None else None,
+    }
+
+
+@api_bp.route('/rides')
+def rides():
+    limit = clamp_page_size(request.args.get('limit'), current_app.config['RIDES_PAGE_SIZE'],
+                            current_app.config['RIDES_MAX_PAGE_SIZE'])
+    query, keyset = search.sort_from_args(search.search_from_args(request.args), request.args)
+    try:
+        page = keyset.page_query(query, request.args.get('cursor'), limit)
+    except ValueError:
+        return jsonify(error='Invalid cursor.'), 400
+
+    def generate():
+        # Rows are serialized as they come off the cursor; the response is
+        # never built up as one document in memory.
+        yield '{"rides":['
+        next_cursor = None
+        last = None
+        for i, ride in enumerate(page.yield_per(50)):
+            if i == limit:
+                next_cursor = keyset.encode(last)
+                break
+            yield (',' if i else '') + json.dumps(ride_to_dict(ride))
+            last = ride
+        yield '],"next_cursor":' + json.dumps(next_cursor) + '}'
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+
+@api_bp.route('/rides/match')
+def match_rides():
+    # e.g. ?origin=Covenant University Gate&destination=Ota Market&date=2030-01-02&time=07:30&seats=1
+    matches = matching.match_from_args(request.args)
+    if matches is None:
+        return jsonify(error='Origin and destination must be known landmarks or have coordinates.'), 400
+    return jsonify(matches=[dict(ride_to_dict(m.ride), detour_km=m.detour_km, minutes_off=m.minutes_off,
+                                 driver_rating=m.ride.driver.rating_avg, score=m.score) for m in matches])
+
+
+@api_bp.route('/landmarks')
+def landmarks():
+    # Prefix lookup for the search box, e.g. ?q=cov
+    prefix = search.normalize(request.args.get('q'))
+    query = Landmark.query
+    if prefix:
+        query = query.filter(Landmark.name_norm >= prefix, Landmark.name_norm < search.prefix_upper_bound(prefix))
+    results = query.order_by(Landmark.name_norm).limit(20).all()
+    return jsonify(landmarks=[{'name': l.name, 'lat': l.lat, 'lon': l.lon} for l in results])
+
+
+@api_bp.route('/fares/estimate')
+def fare_estimate():
+    # e.g. ?price=1500&seats=4&seats_booked=2&riders=3
+    try:
+        price = fares.parse_price(request.args['price'])
+        seats = int(request.args.get('seats', 4))
+        seats_booked = int(request.args.get('seats_booked', 1))
+        riders = request.args.get('riders', type=int)
+    except (KeyError, ValueError):
+        return jsonify(error='price must be a non-negative number; seats and seats_booked whole numbers.'), 400
+    if seats < 1 or not 1 <= seats_booked <= seats or (riders is not None and riders < 0):
+        return jsonify(error='Out of range.'), 400
+    return jsonify(fares.estimate(price, seats, seats_booked, riders))
+
+
+@api_bp.route('/fares/summary')
+def fare_summary():
+    if not current_user.is_authenticated:
+        return jsonify(error='Sign in to see your fare summary.'), 401
+    return jsonify(fares.summary(current_user.id))
@@ -1,13 +1,15 @@
 from flask import Blueprint, render_template, redirect, url_for, request, flash
 from flask_login import login_user, logout_user, login_required, current_user
 from .extensions import db, login_manager
+from . import passwords, ratings
+from .user_cache import user_cache
 from .models.models import User
 
 auth_bp = Blueprint('auth', __name__)
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.get(int(user_id))
 
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
@@ -19,7 +21,7 @@ def login():
         password = request.form.get('password')
         user = User.query.filter_by(email=email).first()
         
-        if user and user.check_password(password):
+        if user and passwords.verify(user, password):
             login_user(user)
             flash('Logged in successfully.', 'success')
             return redirect(url_for('main.index'))
@@ -49,9 +51,10 @@ def register():
             name=name,
             email=email,
             phone=phone,
-            student_staff_id=student_staff_id
+            student_staff_id=student_staff_id,
+            rating_score=ratings.bayesian_score(0, 0)
         )
-        new_user.set_password(password)
+        new_user.password_hash = passwords.hash_password(password)
         
         db.session.add(new_user)
         db.session.commit()
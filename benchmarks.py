@@ -0,0 +1,635 @@
+import itertools
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from datetime import time as clock
+from flask import current_app
+from socketio import KombuManager, RedisManager
+from socketio import Server as SocketIOServer
+from sqlalchemy import create_engine, event, func, insert, select, update
+from werkzeug.security import check_password_hash, generate_password_hash
+from .extensions import db
+from . import geo, matching, notifications, passwords, reservations, search, socketio
+from .chat_buffer import message_buffer
+from .database import pragma_listener
+from .models.models import Booking, Landmark, Message, Ride, RideSearchToken, User, new_message_uid
+
+# The load tests behind the `flask benchmark-*` commands (commands.py). Each
+# one works on throwaway rows (rolled back or deleted afterwards) or on a
+# scratch database, and returns a flat dict the command prints as key=value.
+# They raise ValueError when the database or config can't support the run.
+
+# Place names for synthetic rides when there are no landmarks to borrow from
+_PLACES = (
+    'Covenant University Gate', 'Ota Market', 'Sango Ota', 'Canaan Land', 'Lagos Ikeja', 'Agege Motor Road',
+    'Alagbado', 'Abeokuta Express', 'Idiroko Road', 'Atan Junction', 'Ifo Market', 'Ilogbo', 'Iyana Ipaja',
+    'Oshodi', 'Yaba', 'Lekki Phase One', 'Victoria Island', 'Ikorodu', 'Berger', 'Ojota',
+)
+
+
+def percentile(values, q, digits=2):
+    """The `q` quantile (0 to 1) of already sorted `values`, rounded; 0 when there are none."""
+    if not values:
+        return 0
+    return round(values[min(int(q * len(values)), len(values) - 1)], digits)
+
+
+def _elapsed_ms(started):
+    return (time.perf_counter() - started) * 1000
+
+
+def benchmark_search(synthetic, samples, pages, limit=20, seed=0):
+    """Time ride search and paging, old query shape against the token index.
+
+    With `synthetic`, that many random open rides (and their search tokens) are
+    inserted first and rolled back afterwards. Each sample searches a random
+    word prefix and fetches `pages` pages of `limit` rides: 'before' with the
+    leading-wildcard ILIKE and OFFSET paging this replaced, 'after' with the
+    token index and RIDE_KEYSET. Returns per-page latency percentiles in
+    milliseconds for both.
+    """
+    rng = random.Random(seed)
+    places = [row[0] for row in db.session.query(Landmark.name).limit(500)]
+    if len(places) < 2:
+        places = list(_PLACES)
+    driver_ids = [row[0] for row in db.session.query(User.id).limit(1000)]
+    if not driver_ids:
+        raise ValueError('Needs at least one user.')
+    today = date.today()
+
+    try:
+        next_id = (db.session.query(func.max(Ride.id)).scalar() or 0) + 1
+        rides, tokens = [], []
+        for ride_id in range(next_id, next_id + synthetic):
+            origin, destination = rng.sample(places, 2)
+            rides.append({'id': ride_id, 'driver_id': rng.choice(driver_ids), 'origin': origin,
+                          'destination': destination, 'status': 'open', 'seats': rng.randint(1, 4),
+                          'price': float(rng.randrange(200, 2000, 100)),
+                          'date': today + timedelta(days=rng.randrange(30)),
+                          'time': clock(rng.randrange(6, 22), rng.choice((0, 15, 30, 45)))})
+            tokens += [{'ride_id': ride_id, 'field': field, 'token': token}
+                       for field, text in (('origin', origin), ('destination', destination))
+                       for token in search.tokenize(text)]
+            if len(rides) == 5000:
+                db.session.execute(Ride.__table__.insert(), rides)
+                db.session.execute(RideSearchToken.__table__.insert(), tokens)
+                rides, tokens = [], []
+        if rides:
+            db.session.execute(Ride.__table__.insert(), rides)
+            db.session.execute(RideSearchToken.__table__.insert(), tokens)
+
+        words = [word for place in places for word in search.tokenize(place)]
+        timings = {'before': [], 'after': []}
+        for _ in range(samples):
+            prefix = rng.choice(words)[:3]
+            order = [Ride.date, Ride.time, Ride.id]
+            for page in range(pages):
+                started = time.perf_counter()
+                search.open_rides().filter(Ride.origin.ilike(f'%{prefix}%')).order_by(*order) \
+                    .offset(page * limit).limit(limit).all()
+                timings['before'].append(_elapsed_ms(started))
+
+            cursor = None
+            for page in range(pages):
+                started = time.perf_counter()
+                _, cursor = search.RIDE_KEYSET.paginate(search.search_rides(origin=prefix), cursor, limit)
+                timings['after'].append(_elapsed_ms(started))
+                if cursor is None:
+                    break
+    finally:
+        db.session.rollback()
+
+    result = {'rides': db.session.query(func.count(Ride.id)).scalar() + synthetic, 'samples': samples}
+    for label, values in timings.items():
+        values.sort()
+        result.update({f'{label}_p50_ms': percentile(values, 0.5), f'{label}_p99_ms': percentile(values, 0.99)})
+    return result
+
+
+def benchmark_matching(samples, synthetic=0, seed=0):
+    """Time matching.match() for `samples` random landmark-to-landmark requests.
+
+    With `synthetic`, that many random open rides between landmarks are
+    inserted first and rolled back afterwards, so latency can be measured at
+    catalog sizes the database doesn't have yet. Returns latency percentiles
+    in milliseconds and the mean number of candidates scored.
+    """
+    rng = random.Random(seed)
+    landmarks = db.session.query(Landmark.id, Landmark.name, Landmark.lat, Landmark.lon).all()
+    driver_ids = [row[0] for row in db.session.query(User.id).limit(1000)]
+    if len(landmarks) < 2 or not driver_ids:
+        raise ValueError('Needs at least two landmarks and one user.')
+    today = date.today()
+
+    try:
+        rows = []
+        for _ in range(synthetic):
+            (_, a, a_lat, a_lon), (_, b, b_lat, b_lon) = rng.sample(landmarks, 2)
+            rows.append({
+                'driver_id': rng.choice(driver_ids), 'origin': a, 'destination': b, 'status': 'open',
+                'date': today + timedelta(days=rng.randrange(7)),
+                'time': clock(rng.randrange(6, 22), rng.choice((0, 15, 30, 45))),
+                'seats': rng.randint(1, 4), 'price': float(rng.randrange(200, 2000, 100)),
+                'origin_lat': a_lat, 'origin_lon': a_lon, 'destination_lat': b_lat, 'destination_lon': b_lon,
+                'origin_cell': geo.cell_id(a_lat, a_lon), 'destination_cell': geo.cell_id(b_lat, b_lon),
+            })
+            if len(rows) == 5000:
+                db.session.execute(Ride.__table__.insert(), rows)
+                rows = []
+        if rows:
+            db.session.execute(Ride.__table__.insert(), rows)
+
+        timings = []
+        scored = matching.stats()['candidates']
+        for _ in range(samples):
+            (a_id, _, a_lat, a_lon), (b_id, _, b_lat, b_lon) = rng.sample(landmarks, 2)
+            on_date = today + timedelta(days=rng.randrange(7))
+            at_time = clock(rng.randrange(6, 22), rng.choice((0, 30)))
+            started = time.perf_counter()
+            matching.match((a_id, a_lat, a_lon), (b_id, b_lat, b_lon), on_date, at_time)
+            timings.append(_elapsed_ms(started))
+        scored = matching.stats()['candidates'] - scored
+    finally:
+        db.session.rollback()
+
+    timings.sort()
+    return {'samples': len(timings), 'p50_ms': percentile(timings, 0.5), 'p95_ms': percentile(timings, 0.95),
+            'p99_ms': percentile(timings, 0.99), 'max_ms': percentile(timings, 1),
+            'mean_candidates': round(scored / max(len(timings), 1), 1)}
+
+
+def _unguarded_reserve_seats(ride_id, seats):
+    # reservations.reserve_seats without its `seats >= n` guard: what an oversell looks like
+    Ride.query.filter(Ride.id == ride_id, Ride.status == 'open') \
+        .update({Ride.seats: Ride.seats - seats}, synchronize_session=False)
+    return True
+
+
+def _race(app, actions, workers):
+    # Runs (action, booking id) pairs over `workers` threads, each action in its own session
+    work = queue.Queue()
+    for item in actions:
+        work.put(item)
+    timings, outcomes, errors = [], {}, []
+
+    def worker():
+        with app.app_context():
+            while True:
+                try:
+                    action, booking_id = work.get_nowait()
+                except queue.Empty:
+                    return
+                started = time.perf_counter()
+                try:
+                    booking = Booking.query.get(booking_id)
+                    handler = reservations.approve_booking if action == 'approve' else reservations.reject_booking
+                    result = handler(booking)
+                except Exception as e:
+                    db.session.rollback()
+                    errors.append(repr(e))
+                    continue
+                finally:
+                    db.session.remove()
+                timings.append(_elapsed_ms(started))
+                outcomes[f'{action}_{result}'] = outcomes.get(f'{action}_{result}', 0) + 1
+
+    threads = [threading.Thread(target=worker) for _ in range(max(workers, 1))]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return timings, outcomes, errors, time.perf_counter() - started
+
+
+def _seat_counts(ride_id):
+    # (seats left on the ride, seats held by its bookings)
+    db.session.expire_all()
+    left = db.session.execute(select(Ride.seats).where(Ride.id == ride_id)).scalar()
+    held = sum(booking_seats or 1 for booking_seats, in db.session.execute(
+        select(Booking.seats_booked).where(Booking.ride_id == ride_id, Booking.status.in_(reservations.HOLDS_SEATS))))
+    return left, held
+
+
+def benchmark_reservations(riders, seats, workers, seed=0, unguarded=False):
+    """Stress approve/reject with `workers` threads racing over one ride.
+
+    A throwaway ride with `seats` seats gets one pending booking from each of
+    `riders` throwaway users. First every booking is approved twice, in a
+    shuffled order spread over the workers, each in its own session. With more
+    riders than seats most approvals must come back sold out: the seats held
+    by approved bookings may not exceed `seats`, and the ride's seats must
+    still be at least zero and add back up to `seats` with them. Then the
+    bookings left pending are approved again while every booking is rejected
+    twice, and the counts must add up once more. The rows are deleted at the
+    end. With `unguarded`, approvals use a seat decrement without the
+    `seats >= n` guard, to show that the check catches an oversell.
+    Returns latency percentiles in milliseconds, outcome counts and whether
+    the seat count came out consistent.
+    """
+    rng = random.Random(seed)
+    app = current_app._get_current_object()
+    tag = uuid.uuid4().hex[:12]
+    users = [User(name='Benchmark rider', email=f'bench-{tag}-{i}@example.invalid', password_hash='!')
+             for i in range(riders + 1)]
+    db.session.add_all(users)
+    db.session.flush()
+    ride = Ride(driver_id=users[0].id, origin='Benchmark', destination='Benchmark', seats=seats, price=0.0,
+                status='open')
+    db.session.add(ride)
+    db.session.flush()
+    bookings = [Booking(ride_id=ride.id, rider_id=user.id, status='pending', seats_booked=rng.randint(1, 2))
+                for user in users[1:]]
+    db.session.add_all(bookings)
+    db.session.commit()
+    ride_id, user_ids = ride.id, [user.id for user in users]
+    booking_ids = [booking.id for booking in bookings]
+
+    timings, outcomes, errors, elapsed = [], {}, [], 0.0
+    guarded = reservations.reserve_seats
+    if unguarded:
+        reservations.reserve_seats = _unguarded_reserve_seats
+    try:
+        approvals = [('approve', booking_id) for booking_id in booking_ids for _ in range(2)]
+        rng.shuffle(approvals)
+        race = _race(app, approvals, workers)
+        approved_left, approved_held = _seat_counts(ride_id)
+
+        pending = [booking_id for booking_id, in db.session.execute(
+            select(Booking.id).where(Booking.ride_id == ride_id, Booking.status == 'pending'))]
+        mixed = [('approve', booking_id) for booking_id in pending] + \
+                [('reject', booking_id) for booking_id in booking_ids for _ in range(2)]
+        rng.shuffle(mixed)
+        for phase in (race, _race(app, mixed, workers)):
+            timings += phase[0]
+            for key, count in phase[1].items():
+                outcomes[key] = outcomes.get(key, 0) + count
+            errors += phase[2]
+            elapsed += phase[3]
+        left, held = _seat_counts(ride_id)
+    finally:
+        reservations.reserve_seats = guarded
+        db.session.rollback()
+        Booking.query.filter_by(ride_id=ride_id).delete(synchronize_session=False)
+        Ride.query.filter_by(id=ride_id).delete(synchronize_session=False)
+        User.query.filter(User.id.in_(user_ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+    timings.sort()
+    consistent = (0 <= approved_left and approved_held <= seats and approved_left + approved_held == seats
+                  and 0 <= left and left + held == seats)
+    return dict({'operations': len(timings), 'ops_per_s': round(len(timings) / elapsed, 1) if elapsed else 0,
+                 'p50_ms': percentile(timings, 0.5), 'p95_ms': percentile(timings, 0.95),
+                 'max_ms': percentile(timings, 1), 'errors': len(errors),
+                 'approved_seats': approved_held, 'oversold': max(approved_held - seats, 0),
+                 'seats_left': left, 'seats_held': held, 'consistent': consistent}, **outcomes)
+
+
+def benchmark_sqlite(operations, writers, pragmas):
+    """Compare SQLite write throughput without and with `pragmas`.
+
+    Each profile gets a scratch database file with the app's schema. `writers`
+    threads then share `operations` transactions, alternating the booking path
+    (conditional seat decrement plus a booking INSERT) and the chat path (a
+    message INSERT). Returns operations per second, lock errors and p95 commit
+    latency for 'before' (SQLite defaults) and 'after', plus the speedup.
+    """
+    result = {}
+    for label, profile in (('before', {}), ('after', pragmas)):
+        directory = tempfile.mkdtemp()
+        engine = create_engine(f'sqlite:///{os.path.join(directory, "bench.db")}')
+        if profile:
+            event.listen(engine, 'connect', pragma_listener(profile))
+        try:
+            db.metadata.create_all(engine)
+            with engine.begin() as conn:
+                ride_id = conn.execute(insert(Ride).values(
+                    driver_id=1, origin='Benchmark', destination='Benchmark', seats=operations, price=0.0,
+                    status='open')).inserted_primary_key[0]
+            counter = itertools.count()
+            timings, errors = [], []
+
+            def writer():
+                while True:
+                    n = next(counter)
+                    if n >= operations:
+                        return
+                    started = time.perf_counter()
+                    try:
+                        with engine.begin() as conn:
+                            if n % 2:
+                                conn.execute(insert(Message).values(
+                                    ride_id=ride_id, sender_id=1, message=f'message {n}',
+                                    timestamp=datetime.utcnow(), uid=new_message_uid()))
+                            else:
+                                conn.execute(update(Ride).where(Ride.id == ride_id, Ride.seats >= 1)
+                                             .values(seats=Ride.seats - 1))
+                                conn.execute(insert(Booking).values(ride_id=ride_id, rider_id=n + 2,
+                                                                    status='approved', seats_booked=1))
+                    except Exception as e:
+                        errors.append(e)
+                        continue
+                    timings.append(_elapsed_ms(started))
+
+            threads = [threading.Thread(target=writer) for _ in range(max(writers, 1))]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            engine.dispose()
+            shutil.rmtree(directory, ignore_errors=True)
+
+        timings.sort()
+        result[f'{label}_ops_per_s'] = round(len(timings) / elapsed, 1) if elapsed else 0
+        result[f'{label}_errors'] = len(errors)
+        result[f'{label}_p95_ms'] = percentile(timings, 0.95)
+    result['speedup'] = round(result['after_ops_per_s'] / result['before_ops_per_s'], 2) \
+        if result['before_ops_per_s'] else 0
+    return result
+
+
+def _signed_in_client(app, user=None):
+    # An HTTP test client whose session belongs to `user` (or any user), for socket clients to share
+    user = user or User.query.first()
+    if user is None:
+        raise ValueError('Needs at least one user.')
+    http = app.test_client()
+    with http.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return http, user
+
+
+def benchmark_fanout(clients, messages, updates=50):
+    """Measure room fan-out in this process with `clients` Socket.IO test clients watching one ride.
+
+    Times `messages` broadcasts to the ride's room and checks every client got
+    each one, then publishes `updates` seat changes through the notifier to
+    show how many emits coalescing saves. Needs SOCKETIO_MESSAGE_QUEUE unset:
+    the test clients can't attach to a message queue.
+    Returns broadcast latency percentiles in milliseconds and deliveries per second.
+    """
+    app = current_app._get_current_object()
+    if app.config['SOCKETIO_MESSAGE_QUEUE']:
+        raise ValueError('Unset SOCKETIO_MESSAGE_QUEUE; test clients only attach to an in-process server.')
+    http, _ = _signed_in_client(app)
+
+    ride_id = 0  # no ride needs to exist for its room to be watched
+    sockets = [socketio.test_client(app, flask_test_client=http) for _ in range(clients)]
+    try:
+        for client in sockets:
+            client.emit('watch', {'ride_id': ride_id})
+            client.get_received()
+
+        timings = []
+        started = time.perf_counter()
+        for n in range(messages):
+            sent = time.perf_counter()
+            socketio.emit('ride', {'ride_id': ride_id, 'seats': n}, to=notifications.ride_room(ride_id))
+            timings.append(_elapsed_ms(sent))
+        elapsed = time.perf_counter() - started
+        delivered = sum(len(client.get_received()) for client in sockets)
+
+        notifier = notifications.notifier
+        before = notifier.stats()['emitted']
+        interval, notifier.interval = notifier.interval, max(notifier.interval, 0.01)
+        try:
+            for n in range(updates):
+                notifications.ride_changed(ride_id, seats=n)
+            notifier.flush()
+        finally:
+            notifier.interval = interval
+        emitted = notifier.stats()['emitted'] - before
+        coalesced_deliveries = sum(len(client.get_received()) for client in sockets)
+    finally:
+        for client in sockets:
+            client.disconnect()
+
+    timings.sort()
+    return {'clients': clients, 'messages': messages, 'delivered': delivered,
+            'complete': delivered == clients * messages,
+            'broadcast_p50_ms': percentile(timings, 0.5, 3), 'broadcast_p99_ms': percentile(timings, 0.99, 3),
+            'deliveries_per_s': round(delivered / elapsed) if elapsed else 0,
+            'seat_updates': updates, 'seat_emits': emitted, 'seat_deliveries': coalesced_deliveries}
+
+
+def _queue_manager(url, channel, write_only=False):
+    # The same choice Flask-SocketIO makes for SOCKETIO_MESSAGE_QUEUE
+    manager = RedisManager if url.startswith(('redis://', 'rediss://')) else KombuManager
+    return manager(url, channel=channel, write_only=write_only)
+
+
+def _publish(url, channel, room, messages):
+    # A worker without any clients of its own: only the message queue connects it to the receiver
+    emitter = _queue_manager(url, channel, write_only=True)
+    for n in range(messages):
+        emitter.emit('ride', {'n': n, 'sent': time.time()}, namespace='/', room=room)
+
+
+def benchmark_message_queue(url, messages, timeout=10.0):
+    """Check that an event emitted on one worker reaches a client on another through `url`.
+
+    The receiving worker is a Socket.IO server with its own queue manager and
+    one client in a ride room; the sending one is a write-only manager, as a
+    second worker process uses. For a real broker it runs in a child process;
+    memory:// only connects managers within a process, so there both sit in
+    this one. A private channel keeps the test events away from live workers.
+    Returns how many of `messages` arrived, whether in order, and the
+    send-to-receive latency percentiles in milliseconds.
+    """
+    channel = f'benchmark-{uuid.uuid4().hex[:12]}'
+    room = notifications.ride_room(0)
+    received, arrived = [], threading.Event()
+
+    def record(eio_sid, eio_packet):
+        event_name, payload = server.packet_class(encoded_packet=eio_packet.data).data
+        if event_name == 'ride':
+            received.append((payload, time.time()))
+            arrived.set()
+
+    server = SocketIOServer(client_manager=_queue_manager(url, channel), async_mode='threading')
+    server._send_eio_packet = record
+    sid = server.manager.connect(uuid.uuid4().hex, '/')
+    server.manager.enter_room(sid, '/', room)
+    server.manager.initialize()
+
+    # The receiver only gets what is published after its queue is bound; probe until it is
+    probe = _queue_manager(url, channel, write_only=True)
+    deadline = time.monotonic() + timeout
+    while not arrived.is_set():
+        if time.monotonic() > deadline:
+            raise ValueError(f'Nothing came back through {url} within {timeout}s.')
+        probe.emit('ride', {'n': -1, 'sent': time.time()}, namespace='/', room=room)
+        arrived.wait(0.05)
+    time.sleep(0.2)
+    del received[:]
+
+    cross_process = not url.startswith('memory://')
+    started = time.perf_counter()
+    deadline = time.monotonic() + timeout
+    if cross_process:
+        worker = multiprocessing.get_context('spawn').Process(target=_publish, args=(url, channel, room, messages))
+        worker.start()
+        worker.join(timeout)
+    else:
+        _publish(url, channel, room, messages)
+    while len(received) < messages and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    order = [payload['n'] for payload, _ in received]
+    timings = sorted((at - payload['sent']) * 1000 for payload, at in received)
+    return {'url': url, 'cross_process': cross_process, 'messages': messages, 'delivered': len(received),
+            'complete': sorted(order) == list(range(messages)), 'in_order': order == list(range(messages)),
+            'latency_p50_ms': percentile(timings, 0.5), 'latency_p99_ms': percentile(timings, 0.99),
+            'messages_per_s': round(len(received) / elapsed) if elapsed else 0}
+
+
+def benchmark_chat(messages, clients=10):
+    """Push `messages` chat messages through Socket.IO's message handler and MessageBuffer.
+
+    `clients` test clients signed in as a throwaway driver join the chat of a
+    throwaway ride and take turns sending, as fast as the handler accepts them.
+    The buffer is then flushed and the stored rows read back in history order
+    (timestamp, uid): every message must be there once, in the order it was
+    sent, and every client must have received every broadcast. Database
+    commits are counted while it runs. The rows are deleted at the end.
+    Returns messages per second, per-message latency percentiles in
+    milliseconds and commits per message.
+    """
+    app = current_app._get_current_object()
+    if app.config['SOCKETIO_MESSAGE_QUEUE']:
+        raise ValueError('Unset SOCKETIO_MESSAGE_QUEUE; test clients only attach to an in-process server.')
+    tag = uuid.uuid4().hex[:12]
+    driver = User(name='Benchmark driver', email=f'bench-{tag}@example.invalid', password_hash='!')
+    db.session.add(driver)
+    db.session.flush()
+    ride = Ride(driver_id=driver.id, origin='Benchmark', destination='Benchmark', seats=1, price=0.0, status='open')
+    db.session.add(ride)
+    db.session.commit()
+    ride_id, driver_id = ride.id, driver.id
+    http, _ = _signed_in_client(app, driver)
+
+    commits = [0]
+
+    def count_commit(conn):
+        commits[0] += 1
+
+    sockets = [socketio.test_client(app, flask_test_client=http) for _ in range(max(clients, 1))]
+    before = message_buffer.stats()
+    try:
+        for client in sockets:
+            client.emit('join', {'room': str(ride_id)})
+        for client in sockets:
+            client.get_received()
+
+        event.listen(db.engine, 'commit', count_commit)
+        try:
+            timings = []
+            started = time.perf_counter()
+            for n in range(messages):
+                sent = time.perf_counter()
+                sockets[n % len(sockets)].emit('message', {'room': str(ride_id), 'msg': f'benchmark {n}'})
+                timings.append(_elapsed_ms(sent))
+                # Lets the buffer's background flushes run, as they would between requests
+                socketio.sleep(0)
+            elapsed = time.perf_counter() - started
+            message_buffer.flush()
+        finally:
+            event.remove(db.engine, 'commit', count_commit)
+
+        # The test client unwraps the arguments of an event named 'message'
+        received = [[packet['args']['msg'] for packet in client.get_received() if packet['name'] == 'message']
+                    for client in sockets]
+        stored = [text for text, in db.session.execute(
+            select(Message.message).where(Message.ride_id == ride_id).order_by(Message.timestamp, Message.uid))]
+    finally:
+        for client in sockets:
+            client.disconnect()
+        message_buffer.discard(ride_id)
+        Message.query.filter_by(ride_id=ride_id).delete(synchronize_session=False)
+        Ride.query.filter_by(id=ride_id).delete(synchronize_session=False)
+        User.query.filter_by(id=driver_id).delete(synchronize_session=False)
+        db.session.commit()
+
+    sent_texts = [f'benchmark {n}' for n in range(messages)]
+    after = message_buffer.stats()
+    timings.sort()
+    return {'messages': messages, 'clients': len(sockets),
+            'messages_per_s': round(messages / elapsed) if elapsed else 0,
+            'p50_ms': percentile(timings, 0.5, 3), 'p99_ms': percentile(timings, 0.99, 3),
+            'stored': len(stored), 'lost': len(set(sent_texts) - set(stored)),
+            'duplicated': len(stored) - len(set(stored)), 'in_order': stored == sent_texts,
+            'broadcasts_complete': all(texts == sent_texts for texts in received),
+            'flushes': after['flushes'] - before['flushes'], 'commits': commits[0],
+            'commits_per_message': round(commits[0] / messages, 4) if messages else 0,
+            'complete': stored == sent_texts and all(texts == sent_texts for texts in received)}
+
+
+def benchmark_passwords(logins, probe_interval=0.01):
+    """Login storm: `logins` concurrent password checks, first on the hub, then offloaded.
+
+    A probe green thread stands in for a chat socket: it asks to wake every
+    `probe_interval` seconds and records how late it actually woke. It runs
+    while idle, while the checks are hashed inline on the hub (how logins
+    worked before) and while they go through passwords.verify. Returns logins
+    per second and probe lateness percentiles in milliseconds for each phase.
+    """
+    if current_app.config['SOCKETIO_ASYNC_MODE'] != 'eventlet':
+        raise ValueError('The hub only stalls under SOCKETIO_ASYNC_MODE=eventlet.')
+    import eventlet
+
+    app = current_app._get_current_object()
+    password_hash = generate_password_hash('benchmark', app.config['PASSWORD_HASH_METHOD'])
+    # Never added to the session; the hash is current, so verify() doesn't rewrite it
+    user = User(password_hash=password_hash)
+    phases = {
+        'idle': None,
+        'inline': lambda: check_password_hash(password_hash, 'benchmark'),
+        'offloaded': lambda: passwords.verify(user, 'benchmark'),
+    }
+
+    result = {'logins': logins}
+    for label, check in phases.items():
+        lateness, running = [], [True]
+
+        def probe():
+            while running[0]:
+                started = time.perf_counter()
+                eventlet.sleep(probe_interval)
+                lateness.append(_elapsed_ms(started) - probe_interval * 1000)
+
+        def login():
+            with app.app_context():
+                check()
+
+        prober = eventlet.spawn(probe)
+        started = time.perf_counter()
+        if check is None:
+            eventlet.sleep(0.5)
+        else:
+            pool = eventlet.GreenPool(max(logins, 1))
+            for _ in range(logins):
+                pool.spawn(login)
+            pool.waitall()
+        elapsed = time.perf_counter() - started
+        running[0] = False
+        prober.wait()
+
+        lateness.sort()
+        if check is not None:
+            result[f'{label}_logins_per_s'] = round(logins / elapsed, 1) if elapsed else 0
+        result.update({f'{label}_probe_p50_ms': percentile(lateness, 0.5),
+                       f'{label}_probe_p99_ms': percentile(lateness, 0.99),
+                       f'{label}_probe_max_ms': percentile(lateness, 1)})
+    return result
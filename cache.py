@@ -0,0 +1,174 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+from flask import make_response, request, session
+from flask_login import current_user
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_MODIFIED_KEY = 'catalog:modified'
+
+
+class SimpleBackend:
+    # In-process LRU with per-entry expiry; keys set without a timeout
+    # (catalog version bookkeeping) are pinned outside the LRU
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._pinned = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._pinned:
+                return self._pinned[key]
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        with self._lock:
+            if not timeout:
+                self._pinned[key] = value
+                return
+            self._data[key] = (time.monotonic() + timeout, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            self._pinned.pop(key, None)
+
+    def incr(self, key):
+        with self._lock:
+            self._pinned[key] = int(self._pinned.get(key, 0)) + 1
+            return self._pinned[key]
+
+
+class RedisBackend:
+    # Shared across workers, so an invalidation on one is seen by all
+    def __init__(self, url, prefix):
+        import redis
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def get(self, key):
+        value = self._client.get(self._prefix + key)
+        return value.decode() if value is not None else None
+
+    def set(self, key, value, timeout=None):
+        self._client.set(self._prefix + key, value, ex=int(timeout) if timeout else None)
+
+    def delete(self, key):
+        self._client.delete(self._prefix + key)
+
+    def incr(self, key):
+        return self._client.incr(self._prefix + key)
+
+
+class FragmentCache:
+    """Rendered-fragment cache with versioned invalidation.
+
+    Catalog fragments are keyed on a catalog version number; bump_catalog()
+    increments it, which orphans every older entry at once instead of
+    deleting keys one by one. Orphans age out through the LRU/TTL.
+    """
+
+    def __init__(self):
+        self.backend = None
+        self.timeout = 60
+
+    def init_app(self, app):
+        if app.config['CACHE_BACKEND'] == 'redis':
+            self.backend = RedisBackend(app.config['CACHE_REDIS_URL'], app.config['CACHE_KEY_PREFIX'])
+        else:
+            self.backend = SimpleBackend(app.config['CACHE_MAX_ENTRIES'])
+        self.timeout = app.config['CACHE_DEFAULT_TIMEOUT']
+        app.extensions['fragment_cache'] = self
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.backend.set(key, value, timeout or self.timeout)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def get_or_render(self, key, render):
+        value = self.get(key)
+        if value is None:
+            value = render()
+            self.set(key, value)
+        return value
+
+    def catalog_version(self):
+        # (version, last modified) of everything shown in ride listings
+        version = int(self.backend.get(CATALOG_VERSION_KEY) or 0)
+        modified = self.backend.get(CATALOG_MODIFIED_KEY)
+        if modified is None:
+            modified = _http_now()
+            self.backend.set(CATALOG_MODIFIED_KEY, modified)
+        return version, datetime.fromtimestamp(float(modified), timezone.utc)
+
+    def bump_catalog(self):
+        self.backend.set(CATALOG_MODIFIED_KEY, _http_now())
+        self.backend.incr(CATALOG_VERSION_KEY)
+
+
+def _http_now():
+    # HTTP dates have one-second resolution
+    return str(int(time.time()))
+
+
+def digest(*parts):
+    return hashlib.sha1('\x1f'.join(str(p) for p in parts).encode()).hexdigest()
+
+
+def conditional(response, etag, last_modified=None):
+    # Pages are per-user (nav bar), so only the browser may keep them,
+    # and it must revalidate; unchanged pages then cost a 304
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def cached_page(view):
+    """Cache a public page's HTML for anonymous visitors and answer
+    revalidations with 304. Flash messages and query strings bypass it."""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if request.args or session.get('_flashes'):
+            return view(*args, **kwargs)
+        if current_user.is_authenticated:
+            rv = view(*args, **kwargs)
+            if not isinstance(rv, str):
+                return rv
+            body = rv
+        else:
+            key = f'page:{request.endpoint}'
+            body = fragment_cache.get(key)
+            if body is None:
+                rv = view(*args, **kwargs)
+                if not isinstance(rv, str):
+                    return rv
+                body = rv
+                fragment_cache.set(key, body)
+        return conditional(make_response(body), digest(body))
+    return wrapped
+
+
+fragment_cache = FragmentCache()
@@ -0,0 +1,145 @@
+import atexit
+import logging
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import insert
+from . import socketio
+from .extensions import db
+from .models.models import Message, new_message_uid
+
+log = logging.getLogger(__name__)
+
+
+class MessageBuffer:
+    """Write-behind buffer for chat messages.
+
+    Messages are broadcast as soon as they arrive and written to the database
+    in bulk INSERTs, either every CHAT_FLUSH_INTERVAL seconds or as soon as
+    CHAT_FLUSH_BATCH_SIZE messages are waiting, so a chat burst costs one
+    commit instead of one per message. A batch that fails is retried row by
+    row and the rows that still fail are logged and dropped, so one bad row
+    can't wedge the queue; at most CHAT_MAX_PENDING messages wait, the oldest
+    being dropped beyond that.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._pending = []
+        self._inflight = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = None
+        self._stats = {
+            'enqueued': 0,
+            'flushed': 0,
+            'flushes': 0,
+            'flush_failures': 0,
+            'dropped': 0,
+            'overflowed': 0,
+            'last_batch_size': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+        }
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config['CHAT_WRITE_BEHIND']
+        self.interval = app.config['CHAT_FLUSH_INTERVAL']
+        self.batch_size = app.config['CHAT_FLUSH_BATCH_SIZE']
+        self.max_pending = app.config['CHAT_MAX_PENDING']
+        app.extensions['chat_buffer'] = self
+        atexit.register(self.flush)
+
+    def add(self, ride_id, sender_id, text):
+        row = {'ride_id': ride_id, 'sender_id': sender_id, 'message': text, 'timestamp': datetime.utcnow(),
+               'uid': new_message_uid()}
+        if not self.enabled:
+            db.session.execute(insert(Message), [row])
+            db.session.commit()
+            return row
+
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                # The database has been unreachable for a while; shed the oldest
+                del self._pending[0]
+                self._stats['overflowed'] += 1
+            self._pending.append(row)
+            self._stats['enqueued'] += 1
+            depth = len(self._pending)
+            if self._flusher is None:
+                self._flusher = socketio.start_background_task(self._run)
+        if depth >= self.batch_size:
+            socketio.start_background_task(self.flush)
+        return row
+
+    def pending_for(self, ride_id):
+        # Messages accepted but not yet committed, so readers can merge them in
+        with self._lock:
+            return [row for row in self._inflight + self._pending if row['ride_id'] == ride_id]
+
+    def discard(self, ride_id):
+        """Drop a ride's unwritten messages, e.g. before deleting the ride. Returns how many."""
+        # Holding the flush lock means none of them is halfway into the database
+        with self._flush_lock, self._lock:
+            kept = [row for row in self._pending if row['ride_id'] != ride_id]
+            dropped = len(self._pending) - len(kept)
+            self._pending = kept
+            return dropped
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._inflight = batch
+            if not batch:
+                return 0
+
+            start = time.perf_counter()
+            with self.app.app_context():
+                try:
+                    db.session.execute(insert(Message), batch)
+                    db.session.commit()
+                    written = len(batch)
+                except Exception:
+                    db.session.rollback()
+                    log.exception('Failed to write %d chat messages; retrying one at a time', len(batch))
+                    written = self._write_rows(batch)
+
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._lock:
+                self._inflight = []
+                if written < len(batch):
+                    self._stats['flush_failures'] += 1
+                    self._stats['dropped'] += len(batch) - written
+                self._stats['flushed'] += written
+                self._stats['flushes'] += 1
+                self._stats['last_batch_size'] = len(batch)
+                self._stats['last_flush_ms'] = elapsed_ms
+                self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], elapsed_ms)
+            return written
+
+    def _write_rows(self, rows):
+        written = 0
+        for row in rows:
+            try:
+                db.session.execute(insert(Message), [row])
+                db.session.commit()
+                written += 1
+            except Exception:
+                db.session.rollback()
+                log.error('Dropped chat message for ride %s from user %s: %r',
+                          row['ride_id'], row['sender_id'], row['message'], exc_info=True)
+        return written
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, queue_depth=len(self._pending) + len(self._inflight))
+
+
+message_buffer = MessageBuffer()
@@ -0,0 +1,96 @@
+from datetime import datetime
+from sqlalchemy.orm import joinedload
+from .chat_buffer import message_buffer
+from .pagination import Keyset
+from .models.models import Booking, Message, Ride, User
+
+# Clients page and resync with an opaque (timestamp, uid) cursor. The uid is
+# given to a message as it is sent, so buffered and stored messages share one
+# order even when timestamps tie, and clients de-duplicate by it.
+# (ride_id, timestamp, uid) is indexed so each page is a short range scan.
+
+
+def _key(row):
+    return (row['timestamp'], row['uid']) if isinstance(row, dict) else (row.timestamp, row.uid)
+
+
+OLDER = Keyset((Message.timestamp, Message.uid), (datetime.fromisoformat, str), key=_key, descending=(True, True))
+NEWER = Keyset((Message.timestamp, Message.uid), (datetime.fromisoformat, str), key=_key)
+
+
+def can_access(ride_id, user):
+    if not user.is_authenticated:
+        return False
+    ride = Ride.query.get(ride_id)
+    if ride is None:
+        return False
+    return ride.driver_id == user.id or Booking.query.filter_by(
+        ride_id=ride_id, rider_id=user.id, status='confirmed').first() is not None
+
+
+def parse_cursor(cursor):
+    # Both keysets encode the same way
+    try:
+        return tuple(NEWER.decode(cursor))
+    except ValueError:
+        return None
+
+
+def encode_cursor(row):
+    return NEWER.encode(row)
+
+
+def _serialize(rows):
+    # rows are Message objects or buffered dicts, oldest first
+    names = {}
+    buffered_senders = {row['sender_id'] for row in rows if isinstance(row, dict)}
+    if buffered_senders:
+        names = dict(User.query.with_entities(User.id, User.name).filter(User.id.in_(buffered_senders)).all())
+    out = []
+    for row in rows:
+        if isinstance(row, dict):
+            sender, text, ts, uid = names.get(row['sender_id'], ''), row['message'], row['timestamp'], row['uid']
+        else:
+            sender, text, ts, uid = row.sender.name if row.sender else '', row.message, row.timestamp, row.uid
+        out.append({
+            'id': uid,
+            'msg': text,
+            'sender': sender,
+            'timestamp': ts.strftime('%Y-%m-%d %H:%M:%S'),
+            'cursor': encode_cursor(row),
+        })
+    return out
+
+
+def _query(ride_id):
+    return Message.query.options(joinedload(Message.sender)).filter(Message.ride_id == ride_id)
+
+
+def _merge(ride_id, query, keep=lambda row: True):
+    # The buffer is read before the database. A flush committing in between
+    # then puts a message in both (dropped here by uid) rather than in neither.
+    pending = [row for row in message_buffer.pending_for(ride_id) if keep(row)]
+    stored = query.all()
+    uids = {row.uid for row in stored}
+    return stored, sorted(stored + [row for row in pending if row['uid'] not in uids], key=_key)
+
+
+def latest(ride_id, limit):
+    # The newest `limit` messages, oldest first, plus whether older ones exist
+    stored, rows = _merge(ride_id, _query(ride_id).order_by(*OLDER.order_by()).limit(limit))
+    has_more = len(stored) == limit or len(rows) > limit
+    return _serialize(rows[-limit:]), has_more
+
+
+def before(ride_id, cursor, limit):
+    stored, rows = _merge(ride_id, _query(ride_id).filter(OLDER.after(cursor)).order_by(*OLDER.order_by()).limit(limit),
+                          lambda row: _key(row) < cursor)
+    has_more = len(stored) == limit or len(rows) > limit
+    return _serialize(rows[-limit:]), has_more
+
+
+def since(ride_id, cursor, limit):
+    stored, rows = _merge(ride_id, _query(ride_id).filter(NEWER.after(cursor)).order_by(*NEWER.order_by()).limit(limit),
+                          lambda row: _key(row) > cursor)
+    has_more = len(stored) == limit or len(rows) > limit
+    return _serialize(rows[:limit]), has_more
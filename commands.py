@@ -0,0 +1,256 @@
+import csv
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from .extensions import db
+from .cache import fragment_cache
+from . import activity, benchmarks, maintenance, matching, media, payments, ratings, schedules, schema, search
+from .models.models import Landmark
+
+
+@click.command('upgrade-schema')
+@with_appcontext
+def upgrade_schema_command():
+    """Bring an existing database up to the current models: tables, columns, indexes. Safe to re-run."""
+    report = schema.upgrade()
+    for key in ('tables', 'columns', 'indexes', 'dropped', 'failed'):
+        click.echo(f'{key}: {", ".join(report[key]) or "-"}')
+    click.echo('backfilled: ' + (' '.join(f'{key}={value}' for key, value in report['backfilled'].items()) or '-'))
+    click.echo(f'originals moved out of static/: {media.move_legacy_originals()}')
+    if report['columns'] or report['tables']:
+        click.echo('Then run reindex-rides, rebuild-ratings, rebuild-activity and build-landmark-distances '
+                   'to fill in the derived data.')
+    if report['failed']:
+        raise click.ClickException('Some unique indexes could not be created; remove the duplicate rows and re-run.')
+
+
+@click.command('reindex-rides')
+@with_appcontext
+def reindex_rides_command():
+    """Rebuild the ride search token index from the rides table."""
+    count = search.reindex_all()
+    click.echo(f'Indexed {count} rides.')
+
+
+@click.command('import-landmarks')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@with_appcontext
+def import_landmarks_command(path):
+    """Load campus landmarks from a CSV with name,lat,lon columns."""
+    existing = {l.name_norm: l for l in Landmark.query.all()}
+    count = 0
+    with open(path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            name_norm = search.normalize(row['name'])
+            if not name_norm:
+                continue
+            landmark = existing.get(name_norm)
+            if landmark is None:
+                landmark = existing[name_norm] = Landmark(name_norm=name_norm)
+                db.session.add(landmark)
+            landmark.name = row['name'].strip()
+            landmark.lat = float(row['lat'])
+            landmark.lon = float(row['lon'])
+            count += 1
+    db.session.commit()
+    click.echo(f'Imported {count} landmarks. Run reindex-rides to geocode existing rides '
+               'and build-landmark-distances for matching.')
+
+
+@click.command('benchmark-search')
+@click.option('--synthetic', type=int, default=100000, show_default=True,
+              help='Random open rides to add for the run; they are rolled back afterwards.')
+@click.option('--samples', type=int, default=50, show_default=True, help='Searches to time.')
+@click.option('--pages', type=int, default=5, show_default=True, help='Pages fetched per search.')
+@with_appcontext
+def benchmark_search_command(synthetic, samples, pages):
+    """Compare ride search latency: wildcard ILIKE with OFFSET paging against the token index with keysets."""
+    try:
+        result = benchmarks.benchmark_search(synthetic, samples, pages)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(' '.join(f'{key}={value}' for key, value in result.items()))
+
+
+@click.command('build-landmark-distances')
+@with_appcontext
+def build_landmark_distances_command():
+    """Precompute the distance between every pair of landmarks for ride matching."""
+    count = matching.build_distances()
+    click.echo(f'Stored {count} landmark distances.')
+
+
+@click.command('benchmark-matching')
+@click.option('--samples', type=int, default=200, show_default=True, help='Match requests to time.')
+@click.option('--synthetic', type=int, default=0, show_default=True,
+              help='Random open rides to add for the run; they are rolled back afterwards.')
+@with_appcontext
+def benchmark_matching_command(samples, synthetic):
+    """Measure ride matching latency against the current (or a synthetic) catalog."""
+    try:
+        result = benchmarks.benchmark_matching(samples, synthetic)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(' '.join(f'{key}={value}' for key, value in result.items()))
+
+
+@click.command('benchmark-reservations')
+@click.option('--riders', type=int, default=200, show_default=True, help='Bookings competing for the ride.')
+@click.option('--seats', type=int, default=50, show_default=True, help='Seats the ride starts with.')
+@click.option('--workers', type=int, default=8, show_default=True, help='Concurrent approvers/rejecters.')
+@click.option('--unguarded', is_flag=True,
+              help='Drop the seats >= n guard from approvals, to check the run catches oversells. Should fail.')
+@with_appcontext
+def benchmark_reservations_command(riders, seats, workers, unguarded):
+    """Race approvals and rejections on one ride and check no seat is oversold, lost or double-counted."""
+    result = benchmarks.benchmark_reservations(riders, seats, workers, unguarded=unguarded)
+    click.echo(' '.join(f'{key}={value}' for key, value in result.items()))
+    if not result['consistent']:
+        raise SystemExit(1)
+
+
+@click.command('benchmark-sqlite')
+@click.option('--operations', type=int, default=2000, show_default=True, help='Write transactions per profile.')
+@click.option('--writers', type=int, default=8, show_default=True, help='Concurrent writer threads.')
+@with_appcontext
+def benchmark_sqlite_command(operations, writers):
+    """Compare booking and chat write throughput on SQLite with and without SQLITE_PRAGMAS."""
+    result = benchmarks.benchmark_sqlite(operations, writers, current_app.config['SQLITE_PRAGMAS'])
+    click.echo(' '.join(f'{key}={value}' for key, value in result.items()))
+
+
+@click.command('benchmark-fanout')
+@click.option('--clients', type=int, default=500, show_default=True, help='Sockets watching the room.')
+@click.option('--messages', type=int, default=200, show_default=True, help='Broadcasts to time.')
+@with_appcontext
+def benchmark_fanout_command(clients, messages):
+    """Measure Socket.IO room fan-out and notifier coalescing in this process."""
+    try:
+        result = benchmarks.benchmark_fanout(clients, messages)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(' '.join(f'{key}={value}' for key, value in result.items()))
+    if not result['complete']:
+        raise SystemExit(1)
+
+
+@click.command('benchmark-message-queue')
+@click.option('--url', help='Defaults to SOCKETIO_MESSAGE_QUEUE.')
+@click.option('--messages', type=int, default=200, show_default=True, help='Events to send across.')
+@click.option('--timeout', type=float, default=10.0, show_default=True, help='Seconds to wait for them.')
+@with_appcontext
+def benchmark_message_queue_command(url, messages, timeout):
+    """Check that events emitted on one worker reach clients on another through the message queue."""
+    url = url or current_app.config['SOCKETIO_MESSAGE_QUEUE']
+    if not url:
+        raise click.ClickException('Set SOCKETIO_MESSAGE_QUEUE or pass --url.')
+    try:
+        result = benchmarks.benchmark_message_queue(url, messages, timeout)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(' '.join(f'{key}={value}' for key, value in result.items()))
+    if not result['complete']:
+        raise SystemExit(1)
+
+
+@click.command('benchmark-chat')
+@click.option('--messages', type=int, default=5000, show_default=True, help='Chat messages to send.')
+@click.option('--clients', type=int, default=10, show_default=True, help='Socket.IO test clients taking turns.')
+@with_appcontext
+def benchmark_chat_command(messages, clients):
+    """Send chat messages through the Socket.IO handler and write-behind buffer; check none are lost or reordered."""
+    try:
+        result = benchmarks.benchmark_chat(messages, clients)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(' '.join(f'{key}={value}' for key, value in result.items()))
+    if not result['complete']:
+        raise SystemExit(1)
+
+
+@click.command('benchmark-passwords')
+@click.option('--logins', type=int, default=100, show_default=True, help='Concurrent password checks.')
+@with_appcontext
+def benchmark_passwords_command(logins):
+    """Run a login storm and show how late the event loop gets with hashing inline vs offloaded."""
+    try:
+        result = benchmarks.benchmark_passwords(logins)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(' '.join(f'{key}={value}' for key, value in result.items()))
+
+
+@click.command('rebuild-ratings')
+@with_appcontext
+def rebuild_ratings_command():
+    """Recompute every user's rating aggregates from the ratings table."""
+    count = ratings.rebuild_aggregates()
+    fragment_cache.bump_catalog()
+    click.echo(f'Rebuilt ratings for {count} users.')
+
+
+@click.command('rebuild-activity')
+@with_appcontext
+def rebuild_activity_command():
+    """Recompute every user's dashboard totals from payments, bookings and rides."""
+    count = activity.rebuild()
+    click.echo(f'Rebuilt activity totals for {count} users.')
+
+
+@click.command('maintain-rides')
+@click.option('--archive-after-days', type=int, help='Defaults to ARCHIVE_AFTER_DAYS.')
+@click.option('--purge-after-days', type=int, help='Defaults to ARCHIVE_RETENTION_DAYS.')
+@click.option('--chunk-size', type=int, help='Defaults to MAINTENANCE_CHUNK_SIZE.')
+@with_appcontext
+def maintain_rides_command(archive_after_days, purge_after_days, chunk_size):
+    """Expire past rides, archive finished ones and purge old archives. Run it from cron."""
+    config = current_app.config
+    metrics = maintenance.run(
+        archive_after_days if archive_after_days is not None else config['ARCHIVE_AFTER_DAYS'],
+        purge_after_days if purge_after_days is not None else config['ARCHIVE_RETENTION_DAYS'],
+        chunk_size or config['MAINTENANCE_CHUNK_SIZE'],
+    )
+    click.echo(' '.join(f'{key}={value}' for key, value in metrics.items()))
+
+
+@click.command('reconcile-payments')
+@click.option('--show', type=int, default=20, show_default=True, help='Mismatched bookings to list.')
+@with_appcontext
+def reconcile_payments_command(show):
+    """Check the payment ledger against bookings. Exits non-zero when anything is off."""
+    found, problems = payments.reconcile_payments()
+    for problem in problems[:show]:
+        click.echo(' '.join(f'{key}={value}' for key, value in problem.items()))
+    click.echo(' '.join(f'{key}={value}' for key, value in found.items()))
+    if problems:
+        raise SystemExit(1)
+
+
+@click.command('generate-schedules')
+@with_appcontext
+def generate_schedules_command():
+    """Generate upcoming rides for recurring schedules. Run it daily from cron."""
+    due, created = schedules.generate_due(current_app.config['SCHEDULE_WINDOW_DAYS'])
+    if created:
+        fragment_cache.bump_catalog()
+    click.echo(f'Generated {created} rides for {due} schedules.')
+
+
+def init_app(app):
+    app.cli.add_command(upgrade_schema_command)
+    app.cli.add_command(reindex_rides_command)
+    app.cli.add_command(import_landmarks_command)
+    app.cli.add_command(benchmark_search_command)
+    app.cli.add_command(build_landmark_distances_command)
+    app.cli.add_command(benchmark_matching_command)
+    app.cli.add_command(benchmark_reservations_command)
+    app.cli.add_command(benchmark_sqlite_command)
+    app.cli.add_command(benchmark_fanout_command)
+    app.cli.add_command(benchmark_message_queue_command)
+    app.cli.add_command(benchmark_chat_command)
+    app.cli.add_command(benchmark_passwords_command)
+    app.cli.add_command(rebuild_ratings_command)
+    app.cli.add_command(rebuild_activity_command)
+    app.cli.add_command(maintain_rides_command)
+    app.cli.add_command(reconcile_payments_command)
+    app.cli.add_command(generate_schedules_command)
@@ -1,8 +1,154 @@
 import os
 
+# Engine/pool settings per database; picked from the URL scheme unless DB_ENGINE_PROFILE is set
+ENGINE_PROFILES = {
+    # Lock waits are set by the busy_timeout pragma (SQLITE_PRAGMAS)
+    'sqlite': {},
+    'postgres': {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_pre_ping': True,
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    },
+}
+
+def _database_url(url):
+    # SQLAlchemy only accepts the postgresql:// spelling
+    if url.startswith('postgres://'):
+        return 'postgresql://' + url[len('postgres://'):]
+    return url
+
+def _engine_profile(url):
+    return os.environ.get('DB_ENGINE_PROFILE') or ('sqlite' if url.startswith('sqlite') else 'postgres')
+
+def _replica_binds(urls):
+    binds = {}
+    for i, url in enumerate(u.strip() for u in urls.split(',') if u.strip()):
+        url = _database_url(url)
+        binds[f'replica_{i}'] = {'url': url, **ENGINE_PROFILES[_engine_profile(url)]}
+    return binds
+
 class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'hard-to-guess-string'
-    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///rideshare.db'
+    # Werkzeug hash method for new passwords, e.g. scrypt:32768:8:1 or pbkdf2:sha256:1000000.
+    # Existing users are rehashed on their next login after this changes.
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    # Password hashes computed at once (native threads); keep it at or below the CPU count
+    PASSWORD_HASH_CONCURRENCY = int(os.environ.get('PASSWORD_HASH_CONCURRENCY', 4))
+    SQLALCHEMY_DATABASE_URI = _database_url(os.environ.get('DATABASE_URL') or 'sqlite:///rideshare.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    DB_ENGINE_PROFILE = _engine_profile(SQLALCHEMY_DATABASE_URI)
+    SQLALCHEMY_ENGINE_OPTIONS = ENGINE_PROFILES[DB_ENGINE_PROFILE]
+    # Comma-separated read replicas of DATABASE_URL; @read_only views query them
+    SQLALCHEMY_BINDS = _replica_binds(os.environ.get('DATABASE_REPLICA_URLS', ''))
+    # After a user's own write their reads stay on the primary for this long,
+    # so they never see a replica that hasn't caught up yet
+    REPLICA_READ_YOUR_WRITES_SECONDS = float(os.environ.get('REPLICA_READ_YOUR_WRITES_SECONDS', 10))
+    # Applied to every new SQLite connection (see database.py).
+    # `flask benchmark-sqlite` compares write throughput with and without them.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',  # readers no longer block the writer
+        'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000)),  # how long a writer waits for the lock
+        'synchronous': 'NORMAL',  # safe with WAL, avoids an fsync per commit
+    }
     UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static/uploads')
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max upload size
+    # Uploaded originals keep their EXIF (GPS included), so they live outside static/
+    MEDIA_ORIGINALS_FOLDER = os.environ.get(
+        'MEDIA_ORIGINALS_FOLDER', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance/originals'))
+    # Profile photo variants (square, px) served from /media; see media.py
+    MEDIA_SIZES = (64, 160, 320)
+    MEDIA_QUALITY = int(os.environ.get('MEDIA_QUALITY', 82))
+    MEDIA_MAX_AGE = 365 * 24 * 3600  # names are content hashes, so never stale
+    
+    # Ride listing and /api/rides page sizes (keyset paginated)
+    RIDES_PAGE_SIZE = int(os.environ.get('RIDES_PAGE_SIZE', 20))
+    RIDES_MAX_PAGE_SIZE = int(os.environ.get('RIDES_MAX_PAGE_SIZE', 100))
+    # Ride matching (matching.py): rides whose route passes within MATCH_RADIUS_KM of both
+    # of the rider's ends and leaving within MATCH_TIME_WINDOW_MINUTES of the requested time
+    # are scored, at most MATCH_MAX_CANDIDATES of them; those that would have to go more
+    # than MATCH_MAX_DETOUR_KM out of their way are dropped. Off the landmark distance table
+    # (`flask build-landmark-distances`), distance is great-circle times MATCH_ROAD_FACTOR.
+    MATCH_RADIUS_KM = float(os.environ.get('MATCH_RADIUS_KM', 5))
+    MATCH_MAX_DETOUR_KM = float(os.environ.get('MATCH_MAX_DETOUR_KM', 10))
+    MATCH_TIME_WINDOW_MINUTES = int(os.environ.get('MATCH_TIME_WINDOW_MINUTES', 90))
+    MATCH_MAX_CANDIDATES = int(os.environ.get('MATCH_MAX_CANDIDATES', 500))
+    MATCH_RESULTS = int(os.environ.get('MATCH_RESULTS', 20))
+    MATCH_ROAD_FACTOR = float(os.environ.get('MATCH_ROAD_FACTOR', 1.3))
+    MATCH_TABLE_TTL = float(os.environ.get('MATCH_TABLE_TTL', 600))  # seconds
+    # Rides and bookings per page on the dashboard
+    DASHBOARD_PAGE_SIZE = int(os.environ.get('DASHBOARD_PAGE_SIZE', 10))
+    
+    # Raise instrumentation.QueryBudgetExceeded when a view runs more SQL than its @query_budget
+    ENFORCE_QUERY_BUDGETS = os.environ.get('ENFORCE_QUERY_BUDGETS') == '1'
+    # Log requests slower than this, with their SQL (0 disables)
+    SLOW_REQUEST_THRESHOLD_MS = float(os.environ.get('SLOW_REQUEST_THRESHOLD_MS', 0))
+    # When set, /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    
+    # Accounts allowed into /admin, comma-separated
+    ADMIN_EMAILS = [e.strip().lower() for e in os.environ.get('ADMIN_EMAILS', 'admin@covenant.edu.ng').split(',')
+                    if e.strip()]
+    # Rows per page in the admin tables
+    ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', 50))
+    
+    # Bayesian driver score: RATING_PRIOR_WEIGHT virtual ratings of RATING_PRIOR_MEAN stars.
+    # Run `flask rebuild-ratings` after changing these.
+    RATING_PRIOR_MEAN = float(os.environ.get('RATING_PRIOR_MEAN', 3.5))
+    RATING_PRIOR_WEIGHT = int(os.environ.get('RATING_PRIOR_WEIGHT', 5))
+    
+    # Chat messages are broadcast immediately and written in batches
+    CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', '1') == '1'
+    CHAT_FLUSH_INTERVAL = float(os.environ.get('CHAT_FLUSH_INTERVAL', 0.5))  # seconds
+    CHAT_FLUSH_BATCH_SIZE = int(os.environ.get('CHAT_FLUSH_BATCH_SIZE', 200))
+    CHAT_MAX_PENDING = int(os.environ.get('CHAT_MAX_PENDING', 10000))
+    
+    # Socket.IO. Set SOCKETIO_MESSAGE_QUEUE (redis://, amqp://, or memory:// as a
+    # single-process stand-in) to run several workers; needs the redis or kombu package.
+    SOCKETIO_ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE', 'eventlet')
+    SOCKETIO_MESSAGE_QUEUE = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+    SOCKETIO_CHANNEL = os.environ.get('SOCKETIO_CHANNEL', 'rideshare360')
+    # Cookie the load balancer can pin long-polling clients to a worker with
+    SOCKETIO_COOKIE = os.environ.get('SOCKETIO_COOKIE', 'io')
+    
+    # Chat messages sent on open and per history/sync page
+    CHAT_HISTORY_PAGE_SIZE = int(os.environ.get('CHAT_HISTORY_PAGE_SIZE', 50))
+    
+    # Flask-Login user loader cache (per process); 0 disables it
+    USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 4096))
+    USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))  # seconds
+    
+    # Rendered fragment/page cache: 'simple' (per process) or 'redis' (shared across workers)
+    CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'simple')
+    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+    CACHE_KEY_PREFIX = 'rideshare360:'
+    CACHE_DEFAULT_TIMEOUT = int(os.environ.get('CACHE_DEFAULT_TIMEOUT', 60))  # seconds
+    CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 2048))
+    
+    # Background jobs (jobs.py): in-process workers, or RQ workers when JOBS_BROKER_URL
+    # is set (needs the rq package and `rq worker <JOBS_QUEUE_NAME>`)
+    JOBS_WORKERS = int(os.environ.get('JOBS_WORKERS', 4))
+    JOBS_MAX_RETRIES = int(os.environ.get('JOBS_MAX_RETRIES', 3))
+    JOBS_RETRY_BACKOFF = float(os.environ.get('JOBS_RETRY_BACKOFF', 2))  # seconds, doubled per retry
+    JOBS_BROKER_URL = os.environ.get('JOBS_BROKER_URL')
+    JOBS_QUEUE_NAME = os.environ.get('JOBS_QUEUE_NAME', 'rideshare360')
+    # Run jobs inline in the request (debugging)
+    JOBS_EAGER = os.environ.get('JOBS_EAGER') == '1'
+    
+    # `flask maintain-rides`: finished rides move to the archive tables this many days
+    # after departure, and archived rows are deleted after ARCHIVE_RETENTION_DAYS
+    ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 90))
+    ARCHIVE_RETENTION_DAYS = int(os.environ.get('ARCHIVE_RETENTION_DAYS', 730))
+    MAINTENANCE_CHUNK_SIZE = int(os.environ.get('MAINTENANCE_CHUNK_SIZE', 500))
+    
+    # Recurring rides are listed this many days ahead; `flask generate-schedules` tops it up
+    SCHEDULE_WINDOW_DAYS = int(os.environ.get('SCHEDULE_WINDOW_DAYS', 14))
+    
+    # Savings figures assume a solo trip costs this many seat prices (fares.py);
+    # per-user fare summaries are cached for FARE_SUMMARY_TTL seconds
+    FARE_SOLO_MULTIPLIER = float(os.environ.get('FARE_SOLO_MULTIPLIER', 3.0))
+    FARE_SUMMARY_TTL = int(os.environ.get('FARE_SUMMARY_TTL', 300))
+    
+    # Booking/ride push updates are batched for this long; repeats within it are merged (0 sends at once)
+    NOTIFY_COALESCE_INTERVAL = float(os.environ.get('NOTIFY_COALESCE_INTERVAL', 0.25))  # seconds
@@ -0,0 +1,103 @@
+import logging
+import random
+import time
+from functools import wraps
+from flask import current_app, g, has_request_context, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.sql.dml import UpdateBase
+
+log = logging.getLogger(__name__)
+
+REPLICA_PREFIX = 'replica_'
+PRIMARY_UNTIL_KEY = '_primary_until'
+
+
+class RoutingSession(Session):
+    """Sends reads made inside @read_only views to a replica bind.
+
+    Everything else uses the primary: writes, flushes, reads outside
+    read-only views, and reads by a user inside their read-your-writes
+    window (see mark_write()).
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not isinstance(clause, UpdateBase) and _use_replica():
+            replicas = [engine for key, engine in self._db.engines.items()
+                        if key is not None and key.startswith(REPLICA_PREFIX)]
+            if replicas:
+                return random.choice(replicas)
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _use_replica():
+    if not has_request_context() or not g.get('_read_only') or g.get('_wrote'):
+        return False
+    return session.get(PRIMARY_UNTIL_KEY, 0) < time.time()
+
+
+def read_only(view):
+    """Allow the view's queries to be served by a read replica."""
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        g._read_only = True
+        return view(*args, **kwargs)
+    return wrapped
+
+
+def mark_write():
+    # Pin this request, and the user's next few, to the primary
+    if has_request_context():
+        g._wrote = True
+
+
+def _on_flush(db_session, flush_context):
+    mark_write()
+
+
+def _on_execute(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        mark_write()
+
+
+def _remember_writes(response):
+    if g.get('_wrote') and current_app.config['SQLALCHEMY_BINDS']:
+        session[PRIMARY_UNTIL_KEY] = time.time() + current_app.config['REPLICA_READ_YOUR_WRITES_SECONDS']
+    return response
+
+
+def pragma_listener(pragmas):
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+    return on_connect
+
+
+def _green_psycopg2():
+    # psycopg2 is a C driver and would block the whole eventlet hub while it
+    # waits on the server; psycogreen makes it yield instead
+    try:
+        from psycogreen.eventlet import patch_psycopg
+    except ImportError:
+        log.warning('psycogreen is not installed; PostgreSQL queries will block the eventlet hub')
+        return
+    patch_psycopg()
+
+
+def init_app(app):
+    from .extensions import db
+    with app.app_context():
+        engines = db.engines.values()
+    # Replicas are included, so they get the same connection setup as the primary
+    for engine in engines:
+        if engine.dialect.name == 'sqlite' and engine.url.database not in (None, '', ':memory:'):
+            event.listen(engine, 'connect', pragma_listener(app.config['SQLITE_PRAGMAS']))
+        elif engine.dialect.driver == 'psycopg2' and app.config['SOCKETIO_ASYNC_MODE'] == 'eventlet':
+            _green_psycopg2()
+
+    if not event.contains(RoutingSession, 'after_flush', _on_flush):
+        event.listen(RoutingSession, 'after_flush', _on_flush)
+        event.listen(RoutingSession, 'do_orm_execute', _on_execute)
+    app.after_request(_remember_writes)
@@ -0,0 +1,112 @@
+import json
+import math
+from flask import current_app
+from sqlalchemy import case, func
+from .extensions import db
+from .cache import fragment_cache
+from .payments import settled
+from .models.models import Payment, Ride
+
+# Ride.price is per seat. A booking costs price x seats_booked, which is what
+# the rider is charged (views.pay_booking). Savings compare that with going
+# alone: a solo trip over the same route is taken to cost FARE_SOLO_MULTIPLIER
+# seat prices, whoever pays it.
+
+
+def parse_price(value):
+    """A per-seat price from user input. Raises ValueError unless it is a finite, non-negative number."""
+    price = float(value)
+    if not math.isfinite(price) or price < 0:
+        raise ValueError(f'invalid price: {value!r}')
+    return price
+
+
+def rider_cost(price, seats):
+    return round((price or 0) * (seats or 1), 2)
+
+
+def solo_cost(price):
+    return round((price or 0) * current_app.config['FARE_SOLO_MULTIPLIER'], 2)
+
+
+def estimate(price, seats_offered, seats_booked=1, riders=None):
+    """Fare split for one ride: what a booking costs, what it saves, and the driver's take.
+
+    `riders` is how many seats end up sold; it defaults to every seat offered.
+    """
+    riders = seats_offered if riders is None else min(riders, seats_offered)
+    cost = rider_cost(price, seats_booked)
+    solo = solo_cost(price)
+    return {
+        'price': price,
+        'seats_booked': seats_booked,
+        'rider_cost': cost,
+        'solo_cost': solo,
+        'savings': round(max(solo - cost, 0), 2),
+        'driver_earnings': rider_cost(price, riders),
+    }
+
+
+def _empty():
+    return {'trips': 0, 'spent': 0.0, 'saved': 0.0, 'rides_driven': 0, 'earned': 0.0}
+
+
+def totals(user_ids):
+    """Fare totals for many users at once, from settled (unrefunded) charges.
+
+    Two GROUP BY queries however many users are asked for: one over what each
+    user paid as a rider, one over what each user's rides took as a driver.
+    Returns {user_id: summary}, with an empty summary for users with no history.
+    """
+    user_ids = list(user_ids)
+    result = {user_id: _empty() for user_id in user_ids}
+    if not user_ids:
+        return result
+
+    solo = Ride.price * current_app.config['FARE_SOLO_MULTIPLIER']
+    saved = case((solo > Payment.amount, solo - Payment.amount), else_=0)
+    paid = db.session.query(Payment.payer_id, func.count(Payment.id),
+                            func.coalesce(func.sum(Payment.amount), 0.0), func.coalesce(func.sum(saved), 0.0)) \
+        .join(Ride, Ride.id == Payment.ride_id) \
+        .filter(Payment.payer_id.in_(user_ids), settled()) \
+        .group_by(Payment.payer_id)
+    for user_id, trips, spent, saving in paid:
+        result[user_id].update(trips=trips, spent=round(spent, 2), saved=round(saving, 2))
+
+    earned = db.session.query(Ride.driver_id, func.count(func.distinct(Ride.id)),
+                              func.coalesce(func.sum(Payment.amount), 0.0)) \
+        .join(Payment, Payment.ride_id == Ride.id) \
+        .filter(Ride.driver_id.in_(user_ids), settled()) \
+        .group_by(Ride.driver_id)
+    for user_id, rides, amount in earned:
+        result[user_id].update(rides_driven=rides, earned=round(amount, 2))
+    return result
+
+
+def _key(user_id):
+    return f'fares:{user_id}'
+
+
+def summaries(user_ids):
+    """Cached totals(): only users missing from the cache are recomputed, in one batch."""
+    result, missing = {}, []
+    for user_id in user_ids:
+        cached = fragment_cache.get(_key(user_id))
+        if cached is None:
+            missing.append(user_id)
+        else:
+            result[user_id] = json.loads(cached)
+    for user_id, summary in totals(missing).items():
+        fragment_cache.set(_key(user_id), json.dumps(summary), current_app.config['FARE_SUMMARY_TTL'])
+        result[user_id] = summary
+    return result
+
+
+def summary(user_id):
+    return summaries([user_id])[user_id]
+
+
+def invalidate(*user_ids):
+    # Call after a payment changes, for the payer and the ride's driver
+    for user_id in set(user_ids):
+        fragment_cache.delete(_key(user_id))
@@ -0,0 +1,136 @@
+import math
+from sqlalchemy import and_, or_
+from .models.models import Landmark, Ride
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.32
+
+# Rides are bucketed into a fixed lat/lon grid (~1.1km cells at the equator).
+# Changing this requires `flask reindex-rides` to recompute stored cells.
+CELL_DEGREES = 0.01
+_GRID_COLUMNS = int(round(360 / CELL_DEGREES)) + 1
+
+# Beyond this many cells an IN list stops paying off; fall back to a
+# bounding box on the raw coordinates instead.
+MAX_CELLS = 400
+MAX_RADIUS_KM = 50.0
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def _row_col(lat, lon):
+    return int(math.floor((lat + 90) / CELL_DEGREES)), int(math.floor((lon + 180) / CELL_DEGREES))
+
+
+def cell_id(lat, lon):
+    if lat is None or lon is None:
+        return None
+    row, col = _row_col(lat, lon)
+    return row * _GRID_COLUMNS + col
+
+
+def _bounding_box(lat, lon, km):
+    dlat = km / KM_PER_DEGREE
+    dlon = km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    return lat - dlat, lat + dlat, lon - dlon, lon + dlon
+
+
+def cells_within(lat, lon, km):
+    # Every grid cell touching the bounding box of the circle, or None if
+    # that would be too many to be useful as an index probe
+    min_lat, max_lat, min_lon, max_lon = _bounding_box(lat, lon, km)
+    row0, col0 = _row_col(min_lat, min_lon)
+    row1, col1 = _row_col(max_lat, max_lon)
+    if (row1 - row0 + 1) * (col1 - col0 + 1) > MAX_CELLS:
+        return None
+    return [row * _GRID_COLUMNS + col for row in range(row0, row1 + 1) for col in range(col0, col1 + 1)]
+
+
+def _float(value):
+    try:
+        return float(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
+def coordinates_from(values, field):
+    # Reads e.g. origin_lat/origin_lon from request.form or request.args
+    lat = _float(values.get(f'{field}_lat'))
+    lon = _float(values.get(f'{field}_lon'))
+    if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None, None
+    return lat, lon
+
+
+def geocode(name_norm):
+    if not name_norm:
+        return None
+    landmark = Landmark.query.filter_by(name_norm=name_norm).first()
+    return (landmark.lat, landmark.lon) if landmark else None
+
+
+def landmark_table():
+    return {l.name_norm: (l.lat, l.lon) for l in Landmark.query.all()}
+
+
+def locate_ride(ride, normalize, landmarks=None):
+    # Fills missing coordinates from the landmark table and refreshes the
+    # grid cells used by near()
+    for field in ('origin', 'destination'):
+        lat, lon = getattr(ride, f'{field}_lat'), getattr(ride, f'{field}_lon')
+        if lat is None or lon is None:
+            key = normalize(getattr(ride, field))
+            point = landmarks.get(key) if landmarks is not None else geocode(key)
+            lat, lon = point or (None, None)
+            setattr(ride, f'{field}_lat', lat)
+            setattr(ride, f'{field}_lon', lon)
+        setattr(ride, f'{field}_cell', cell_id(lat, lon))
+
+
+def near(query, field, lat, lon, km):
+    ride_lat = getattr(Ride, f'{field}_lat')
+    ride_lon = getattr(Ride, f'{field}_lon')
+    cell = getattr(Ride, f'{field}_cell')
+
+    cells = cells_within(lat, lon, km)
+    if cells is not None:
+        query = query.filter(cell.in_(cells))
+    else:
+        min_lat, max_lat, min_lon, max_lon = _bounding_box(lat, lon, km)
+        query = query.filter(ride_lat.between(min_lat, max_lat), ride_lon.between(min_lon, max_lon))
+
+    # Equirectangular distance is plain arithmetic, so it runs on any
+    # backend, and is accurate to well under 1% at campus scale.
+    dy = (ride_lat - lat) * KM_PER_DEGREE
+    dx = (ride_lon - lon) * (KM_PER_DEGREE * math.cos(math.radians(lat)))
+    return query.filter(and_(ride_lat.isnot(None), dy * dy + dx * dx <= km * km))
+
+
+def along_route(query, lat, lon, km):
+    # Rides whose origin-to-destination bounding box, grown by km, holds the
+    # point: a cheap superset of the rides that pass within km of it on the way.
+    # Rides without coordinates drop out, as in near().
+    min_lat, max_lat, min_lon, max_lon = _bounding_box(lat, lon, km)
+    for low, high, axis in ((min_lat, max_lat, 'lat'), (min_lon, max_lon, 'lon')):
+        start, end = getattr(Ride, f'origin_{axis}'), getattr(Ride, f'destination_{axis}')
+        query = query.filter(or_(start >= low, end >= low), or_(start <= high, end <= high))
+    return query
+
+
+def point_from_args(args, field, normalize):
+    # (lat, lon, km) when the request asks for a radius search on field
+    km = _float(args.get(f'{field}_km')) or _float(args.get('radius'))
+    if not km or km <= 0:
+        return None
+    lat, lon = coordinates_from(args, field)
+    if lat is None:
+        point = geocode(normalize(args.get(field)))
+        if point is None:
+            return None
+        lat, lon = point
+    return lat, lon, min(km, MAX_RADIUS_KM)
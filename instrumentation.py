@@ -0,0 +1,219 @@
+import logging
+import threading
+import time
+from functools import wraps
+from flask import Response, abort, current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+log = logging.getLogger(__name__)
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    # g lives on the app context, so each request / Socket.IO event counts separately
+    if has_app_context():
+        g._query_count = g.get('_query_count', 0) + 1
+
+
+def query_count():
+    return g.get('_query_count', 0)
+
+
+def query_budget(limit):
+    """Fail a view that issues more than ``limit`` SQL statements.
+
+    Only enforced when ENFORCE_QUERY_BUDGETS is set (e.g. in tests), so a
+    lazy load slipping into a template shows up as a failure rather than as
+    a slow page in production. Statements run before the view, such as the
+    login user lookup, are not counted.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            start = query_count()
+            rv = view(*args, **kwargs)
+            used = query_count() - start
+            if used > limit and current_app.config['ENFORCE_QUERY_BUDGETS']:
+                raise QueryBudgetExceeded(f'{view.__name__} issued {used} queries (budget {limit})')
+            return rv
+        return wrapped
+    return decorator
+
+
+# Request, SQL and Socket.IO metrics, exposed in Prometheus text format at
+# /metrics. Figures are per process; scrape each worker.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # seconds
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+MAX_LOGGED_STATEMENTS = 50
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, labels, value):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self, name, label_names):
+        for labels, series in sorted(self._series.items()):
+            base = _labels(label_names, labels)
+            for bound, count in zip(self.buckets, series):
+                yield f'{name}_bucket{{{base},le="{bound}"}} {count}'
+            yield f'{name}_bucket{{{base},le="+Inf"}} {series[-1]}'
+            yield f'{name}_sum{{{base}}} {series[-2]}'
+            yield f'{name}_count{{{base}}} {series[-1]}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values):
+    return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.request_seconds = Histogram(LATENCY_BUCKETS)
+        self.request_queries = Histogram(QUERY_BUCKETS)
+        self.socket_seconds = Histogram(LATENCY_BUCKETS)
+        self.requests = {}  # (endpoint, method, status) -> count
+        self.sql_seconds = {}  # endpoint -> total seconds
+        self.socket_errors = {}  # event -> count
+        self.sources = {}  # prefix -> callable returning a dict of numbers
+
+    def observe_request(self, endpoint, method, status, seconds, queries, sql_seconds):
+        with self._lock:
+            self.request_seconds.observe((endpoint, method), seconds)
+            self.request_queries.observe((endpoint,), queries)
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.sql_seconds[endpoint] = self.sql_seconds.get(endpoint, 0.0) + sql_seconds
+
+    def observe_event(self, name, seconds, failed=False):
+        with self._lock:
+            self.socket_seconds.observe((name,), seconds)
+            if failed:
+                self.socket_errors[name] = self.socket_errors.get(name, 0) + 1
+
+    def register(self, prefix, stats):
+        """Export another component's stats() dict as rideshare_<prefix>_<key> gauges."""
+        self.sources[prefix] = stats
+
+    def render(self):
+        lines = []
+        with self._lock:
+            lines.append('# TYPE rideshare_http_request_duration_seconds histogram')
+            lines.extend(self.request_seconds.render('rideshare_http_request_duration_seconds', ('endpoint', 'method')))
+            lines.append('# TYPE rideshare_http_requests_total counter')
+            for labels, count in sorted(self.requests.items()):
+                lines.append(f'rideshare_http_requests_total{{{_labels(("endpoint", "method", "status"), labels)}}} {count}')
+            lines.append('# TYPE rideshare_db_queries_per_request histogram')
+            lines.extend(self.request_queries.render('rideshare_db_queries_per_request', ('endpoint',)))
+            lines.append('# TYPE rideshare_db_query_seconds_total counter')
+            for endpoint, seconds in sorted(self.sql_seconds.items()):
+                lines.append(f'rideshare_db_query_seconds_total{{{_labels(("endpoint",), (endpoint,))}}} {seconds}')
+            lines.append('# TYPE rideshare_socketio_event_duration_seconds histogram')
+            lines.extend(self.socket_seconds.render('rideshare_socketio_event_duration_seconds', ('event',)))
+            lines.append('# TYPE rideshare_socketio_event_errors_total counter')
+            for name, count in sorted(self.socket_errors.items()):
+                lines.append(f'rideshare_socketio_event_errors_total{{{_labels(("event",), (name,))}}} {count}')
+            sources = list(self.sources.items())
+
+        for prefix, stats in sources:
+            for key, value in sorted(stats().items()):
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    name = f'rideshare_{prefix}_{key}'
+                    lines.append(f'# TYPE {name} gauge')
+                    lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._query_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_query(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, '_query_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    if has_app_context():
+        g._sql_seconds = g.get('_sql_seconds', 0.0) + elapsed
+        statements = g.get('_sql_statements')
+        if statements is not None and len(statements) < MAX_LOGGED_STATEMENTS:
+            statements.append((elapsed, statement))
+
+
+def timed_event(name):
+    """Record a Socket.IO handler's run time under ``name``. Place below @socketio.on."""
+    def decorator(handler):
+        @wraps(handler)
+        def wrapped(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                rv = handler(*args, **kwargs)
+            except Exception:
+                metrics.observe_event(name, time.perf_counter() - start, failed=True)
+                raise
+            metrics.observe_event(name, time.perf_counter() - start)
+            return rv
+        return wrapped
+    return decorator
+
+
+def _start_request():
+    g._request_start = time.perf_counter()
+    if current_app.config['SLOW_REQUEST_THRESHOLD_MS']:
+        g._sql_statements = []
+
+
+def _finish_request(response):
+    start = g.pop('_request_start', None)
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    endpoint = request.endpoint or 'unmatched'
+    queries, sql_seconds = query_count(), g.get('_sql_seconds', 0.0)
+    metrics.observe_request(endpoint, request.method, response.status_code, elapsed, queries, sql_seconds)
+
+    threshold = current_app.config['SLOW_REQUEST_THRESHOLD_MS']
+    if threshold and elapsed * 1000 >= threshold:
+        statements = '\n'.join(f'  {seconds * 1000:8.1f} ms  {sql}' for seconds, sql in g.get('_sql_statements') or ())
+        log.warning('Slow request: %s %s (%s) took %.1f ms, %d queries in %.1f ms\n%s',
+                    request.method, request.full_path, endpoint, elapsed * 1000, queries, sql_seconds * 1000,
+                    statements)
+    return response
+
+
+def metrics_view():
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+from . import socketio
+from .extensions import db
+
+log = logging.getLogger(__name__)
+
+
+class JobQueue:
+    """Background jobs for side effects that don't need to finish before the response.
+
+    Handlers are registered by name with @jobs.job() and queued with
+    jobs.enqueue(name, *args). Arguments must be plain values (ids, not ORM
+    objects), since the job runs later in its own app context and session.
+    Jobs run on JOBS_WORKERS in-process workers, or on RQ workers when
+    JOBS_BROKER_URL is set; failed jobs are retried JOBS_MAX_RETRIES times
+    with exponential backoff. JOBS_EAGER runs them inline instead.
+    """
+
+    def __init__(self):
+        self.app = None
+        self._handlers = {}
+        self._queue = None
+        self._workers = []
+        self._rq = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'enqueued': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'retried': 0,
+            'max_run_ms': 0.0,
+        }
+
+    def init_app(self, app):
+        self.app = app
+        self.eager = app.config['JOBS_EAGER']
+        self.worker_count = app.config['JOBS_WORKERS']
+        self.max_retries = app.config['JOBS_MAX_RETRIES']
+        self.backoff = app.config['JOBS_RETRY_BACKOFF']
+        # A queue matching the Socket.IO async mode, so idle workers yield under eventlet
+        self._queue = socketio.server.eio.create_queue()
+        if app.config['JOBS_BROKER_URL'] and not self.eager:
+            import redis
+            from rq import Queue
+            self._rq = Queue(app.config['JOBS_QUEUE_NAME'],
+                             connection=redis.Redis.from_url(app.config['JOBS_BROKER_URL']))
+        app.extensions['jobs'] = self
+
+    def job(self, name):
+        def register(func):
+            self._handlers[name] = func
+            return func
+        return register
+
+    def enqueue(self, name, *args, **kwargs):
+        if name not in self._handlers:
+            raise KeyError(f'Unknown job {name!r}')
+        with self._lock:
+            self._stats['enqueued'] += 1
+
+        if self.eager:
+            self._execute(name, args, kwargs, self.max_retries)
+        elif self._rq is not None:
+            from rq import Retry
+            intervals = [self.backoff * 2 ** i for i in range(self.max_retries)]
+            self._rq.enqueue(perform, name, args, kwargs,
+                             retry=Retry(max=self.max_retries, interval=intervals) if self.max_retries else None)
+        else:
+            self._start_workers()
+            self._queue.put((name, args, kwargs, 0))
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._workers) < self.worker_count:
+                self._workers.append(socketio.start_background_task(self._work))
+
+    def _work(self):
+        while True:
+            name, args, kwargs, attempt = self._queue.get()
+            if not self._execute(name, args, kwargs, attempt):
+                self._retry_later(name, args, kwargs, attempt + 1)
+
+    def _retry_later(self, name, args, kwargs, attempt):
+        def requeue():
+            socketio.sleep(self.backoff * 2 ** (attempt - 1))
+            self._queue.put((name, args, kwargs, attempt))
+        with self._lock:
+            self._stats['retried'] += 1
+        socketio.start_background_task(requeue)
+
+    def _execute(self, name, args, kwargs, attempt):
+        # True when the job is done: it succeeded, or it failed for the last time
+        start = time.perf_counter()
+        with self.app.app_context():
+            try:
+                self._handlers[name](*args, **kwargs)
+            except Exception:
+                db.session.rollback()
+                final = attempt >= self.max_retries
+                log.exception('Job %s%r failed (attempt %d)%s', name, args, attempt + 1,
+                              '; giving up' if final else '; will retry')
+                if final:
+                    with self._lock:
+                        self._stats['failed'] += 1
+                return final
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            self._stats['succeeded'] += 1
+            self._stats['max_run_ms'] = max(self._stats['max_run_ms'], elapsed_ms)
+        return True
+
+    def run(self, name, args, kwargs):
+        # Used by RQ workers; exceptions propagate so RQ can schedule the retry
+        with self.app.app_context():
+            self._handlers[name](*args, **kwargs)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, queue_depth=self._queue.qsize() if self._queue else 0, workers=len(self._workers))
+
+
+def perform(name, args, kwargs):
+    """Entry point for `rq worker <JOBS_QUEUE_NAME>`, which runs outside the web app."""
+    if jobs.app is None:
+        from . import create_app
+        create_app()
+    jobs.run(name, args, kwargs)
+
+
+jobs = JobQueue()
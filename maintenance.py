@@ -0,0 +1,136 @@
+import time as _time
+from datetime import datetime, timedelta
+from sqlalchemy import and_, delete, exists, insert, literal, or_, select, update
+from .extensions import db
+from . import payments, reservations, search
+from .cache import fragment_cache
+from .models.models import (ArchivedBooking, ArchivedMessage, ArchivedRide, Booking, Message, Payment,
+                            Rating, Report, Ride)
+
+# Ride lifecycle maintenance, meant to run from cron (`flask maintain-rides`).
+# Every step works on chunks of ids and commits after each one, so no statement
+# locks more than one chunk's rows and an interrupted run just resumes next time.
+
+FINISHED = ('completed', 'cancelled', 'expired')
+
+# Figures from the most recent run in this process
+last_run = {}
+
+
+def _chunks(query, chunk_size):
+    # Repeatedly yields the next chunk of ids; the caller must make them stop matching
+    while True:
+        ids = [row[0] for row in query.limit(chunk_size)]
+        if not ids:
+            return
+        yield ids
+
+
+def expire_rides(now, chunk_size):
+    """Mark open rides whose departure has passed as expired, and their pending requests with them."""
+    due = or_(Ride.date < now.date(), and_(Ride.date == now.date(), Ride.time < now.time()))
+    query = db.session.query(Ride.id).filter(Ride.status == 'open', due).order_by(Ride.id)
+    rides = bookings = 0
+    for ids in _chunks(query, chunk_size):
+        rides += db.session.execute(
+            update(Ride).where(Ride.id.in_(ids), Ride.status == 'open').values(status='expired')).rowcount
+        bookings += db.session.execute(
+            update(Booking).where(Booking.ride_id.in_(ids), Booking.status == 'pending')
+            .values(status='expired')).rowcount
+        db.session.commit()
+    return rides, bookings
+
+
+def sweep_cancelled(chunk_size):
+    """Finish cancellations whose cancel_ride_bookings job never completed.
+
+    The job runs on a non-durable queue, so a restart or a final failed
+    retry can leave live bookings or unrefunded charges on a cancelled ride.
+    Re-running the (idempotent) job here catches them on the next cron run.
+    """
+    unfinished = or_(
+        exists().where(Booking.ride_id == Ride.id, Booking.status.in_(reservations.LIVE_STATUSES)),
+        exists().where(Payment.ride_id == Ride.id, payments.settled()),
+    )
+    query = db.session.query(Ride.id).filter(Ride.status == 'cancelled', unfinished).order_by(Ride.id)
+    swept = 0
+    for ids in _chunks(query, chunk_size):
+        reservations.cancel_ride_bookings(*ids)
+        swept += len(ids)
+    return swept
+
+
+def _move(model, archive, condition, archived_at):
+    # INSERT ... SELECT into the archive table, then DELETE the same rows
+    columns = [column.key for column in model.__table__.columns]
+    db.session.execute(insert(archive).from_select(
+        columns + ['archived_at'],
+        select(*model.__table__.columns, literal(archived_at, db.DateTime)).where(condition)))
+    return db.session.execute(delete(model).where(condition)).rowcount
+
+
+def archive_rides(before, now, chunk_size):
+    """Move finished rides that departed before `before` to the archive tables.
+
+    Chat messages are archived for every such ride. The ride itself and its
+    bookings only leave when no payment, rating or report refers to it;
+    those records are kept live and so is the ride they point at.
+    """
+    moved = {'rides': 0, 'bookings': 0, 'messages': 0}
+    last_id = 0
+    while True:
+        ids = [row[0] for row in db.session.query(Ride.id)
+               .filter(Ride.id > last_id, Ride.status.in_(FINISHED), Ride.date < before)
+               .order_by(Ride.id).limit(chunk_size)]
+        if not ids:
+            return moved
+        last_id = ids[-1]
+
+        moved['messages'] += _move(Message, ArchivedMessage, Message.ride_id.in_(ids), now)
+        referenced = or_(
+            exists().where(Payment.ride_id == Ride.id),
+            exists().where(Rating.ride_id == Ride.id),
+            exists().where(Report.ride_id == Ride.id),
+        )
+        free = [row[0] for row in db.session.query(Ride.id).filter(Ride.id.in_(ids), ~referenced)]
+        if free:
+            moved['bookings'] += _move(Booking, ArchivedBooking, Booking.ride_id.in_(free), now)
+            search.unindex_rides(free)
+            moved['rides'] += _move(Ride, ArchivedRide, Ride.id.in_(free), now)
+        db.session.commit()
+
+
+def purge_archives(before, chunk_size):
+    """Delete archived rows that were archived before `before`."""
+    purged = 0
+    for archive in (ArchivedMessage, ArchivedBooking, ArchivedRide):
+        query = db.session.query(archive.id).filter(archive.archived_at < before).order_by(archive.id)
+        for ids in _chunks(query, chunk_size):
+            purged += db.session.execute(delete(archive).where(archive.id.in_(ids))).rowcount
+            db.session.commit()
+    return purged
+
+
+def run(archive_after_days, purge_after_days, chunk_size, now=None):
+    # Ride dates and times are entered as local wall-clock time
+    now = now or datetime.now()
+    start = _time.perf_counter()
+    swept = sweep_cancelled(chunk_size)
+    expired_rides, expired_bookings = expire_rides(now, chunk_size)
+    archived = archive_rides(now.date() - timedelta(days=archive_after_days), now, chunk_size)
+    purged = purge_archives(now - timedelta(days=purge_after_days), chunk_size)
+    if expired_rides or archived['rides']:
+        fragment_cache.bump_catalog()
+
+    last_run.clear()
+    last_run.update({
+        'swept_cancelled_rides': swept,
+        'expired_rides': expired_rides,
+        'expired_bookings': expired_bookings,
+        'archived_rides': archived['rides'],
+        'archived_bookings': archived['bookings'],
+        'archived_messages': archived['messages'],
+        'purged_rows': purged,
+        'seconds': round(_time.perf_counter() - start, 3),
+    })
+    return dict(last_run)
@@ -0,0 +1,195 @@
+import heapq
+import threading
+import time as _time
+from collections import namedtuple
+from datetime import date, datetime, time, timedelta
+from flask import current_app
+from sqlalchemy.orm import contains_eager
+from .extensions import db
+from . import geo, ratings, search
+from .models.models import Landmark, LandmarkDistance, Ride
+
+# Rider-to-ride matching. Candidates are pruned in SQL by the ride date and a
+# time window (served by ix_rides_status_date_time) and by route: the box
+# spanned by the ride's origin and destination, grown by MATCH_RADIUS_KM, has
+# to hold both of the rider's ends (geo.along_route). That keeps rides that
+# start or end elsewhere but pass by on the way, such as an A to C ride for a
+# rider going B to D, or one that can pick the rider up en route. Each candidate
+# is then costed in Python: how far the driver has to go out of their way to
+# pick the rider up and drop them off (more than MATCH_MAX_DETOUR_KM and it is
+# not a match), how far its departure is from the requested time, its driver's
+# rating score and how many seats it has to spare. Lowest cost ranks first.
+
+DETOUR_KM_COST = 1.0  # per km added to the driver's route
+HOUR_OFF_COST = 2.0  # per hour between the ride's departure and the requested time
+STAR_COST = 0.5  # per star the driver's rating score is below 5
+SPARE_SEAT_CREDIT = 0.2  # per seat left after the booking, up to MAX_SPARE_SEATS
+MAX_SPARE_SEATS = 3
+
+Match = namedtuple('Match', 'ride detour_km minutes_off score')
+
+_stats = {'matches': 0, 'candidates': 0, 'seconds': 0.0}
+_stats_lock = threading.Lock()
+
+
+class DistanceTable:
+    """Landmark coordinates and precomputed landmark-to-landmark distances, in memory.
+
+    Places are (landmark id or None, lat, lon). Between two landmarks the
+    stored distance is used; anywhere else it is the great-circle distance
+    times MATCH_ROAD_FACTOR. The table is reloaded every MATCH_TABLE_TTL
+    seconds so a rebuild from the CLI reaches every worker.
+    """
+
+    def __init__(self):
+        self._points = {}  # name_norm -> (id, lat, lon)
+        self._km = {}  # (smaller id, larger id) -> km
+        self._expires = 0.0
+        self.road_factor = 1.3
+        self.ttl = 600.0
+
+    def init_app(self, app):
+        self.road_factor = app.config['MATCH_ROAD_FACTOR']
+        self.ttl = app.config['MATCH_TABLE_TTL']
+        app.extensions['distance_table'] = self
+
+    def _ensure_loaded(self):
+        if _time.monotonic() < self._expires:
+            return
+        points = {name: (id_, lat, lon) for name, id_, lat, lon in
+                  db.session.query(Landmark.name_norm, Landmark.id, Landmark.lat, Landmark.lon)}
+        km = {(a, b): d for a, b, d in
+              db.session.query(LandmarkDistance.from_id, LandmarkDistance.to_id, LandmarkDistance.km)}
+        self._points, self._km = points, km
+        self._expires = _time.monotonic() + self.ttl
+
+    def reset(self):
+        self._expires = 0.0
+
+    def place(self, name, lat=None, lon=None):
+        """Locate a named place, preferring explicit coordinates. None if it can't be placed."""
+        self._ensure_loaded()
+        landmark = self._points.get(search.normalize(name))
+        if lat is not None and lon is not None:
+            return (landmark[0] if landmark else None, lat, lon)
+        return landmark
+
+    def ride_places(self, ride):
+        return (self.place(ride.origin, ride.origin_lat, ride.origin_lon),
+                self.place(ride.destination, ride.destination_lat, ride.destination_lon))
+
+    def km(self, a, b):
+        if a[0] is not None and b[0] is not None:
+            if a[0] == b[0]:
+                return 0.0
+            stored = self._km.get((min(a[0], b[0]), max(a[0], b[0])))
+            if stored is not None:
+                return stored
+        return geo.haversine_km(a[1], a[2], b[1], b[2]) * self.road_factor
+
+    def stats(self):
+        return {'landmarks': len(self._points), 'pairs': len(self._km)}
+
+
+distances = DistanceTable()
+
+
+def build_distances(chunk_size=5000):
+    """Recompute every landmark pair's distance. Returns the number of pairs stored."""
+    LandmarkDistance.query.delete(synchronize_session=False)
+    landmarks = db.session.query(Landmark.id, Landmark.lat, Landmark.lon).order_by(Landmark.id).all()
+    factor = current_app.config['MATCH_ROAD_FACTOR']
+    rows = []
+    count = 0
+    for i, (a, a_lat, a_lon) in enumerate(landmarks):
+        for b, b_lat, b_lon in landmarks[i + 1:]:
+            rows.append({'from_id': a, 'to_id': b, 'km': geo.haversine_km(a_lat, a_lon, b_lat, b_lon) * factor})
+            if len(rows) == chunk_size:
+                db.session.execute(LandmarkDistance.__table__.insert(), rows)
+                count += len(rows)
+                rows = []
+    if rows:
+        db.session.execute(LandmarkDistance.__table__.insert(), rows)
+        count += len(rows)
+    db.session.commit()
+    distances.reset()
+    return count
+
+
+def candidates(origin, destination, on_date, at_time=None, seats=1):
+    config = current_app.config
+    radius = config['MATCH_RADIUS_KM']
+    query = search.open_rides().filter(Ride.seats >= seats, Ride.date == on_date)
+    query = geo.along_route(query, origin[1], origin[2], radius)
+    query = geo.along_route(query, destination[1], destination[2], radius)
+    if at_time is not None:
+        # The window is clipped to the requested day
+        window = timedelta(minutes=config['MATCH_TIME_WINDOW_MINUTES'])
+        moment = datetime.combine(on_date, at_time)
+        earliest = max(moment - window, datetime.combine(on_date, time.min))
+        latest = min(moment + window, datetime.combine(on_date, time.max))
+        query = query.filter(Ride.time.between(earliest.time(), latest.time()))
+    return query.join(Ride.driver).options(contains_eager(Ride.driver)) \
+        .order_by(Ride.time, Ride.id).limit(config['MATCH_MAX_CANDIDATES'])
+
+
+def score(ride, origin, destination, at_time=None, seats=1):
+    start, end = distances.ride_places(ride)
+    direct = distances.km(start, end)
+    via = distances.km(start, origin) + distances.km(origin, destination) + distances.km(destination, end)
+    detour = max(via - direct, 0.0)
+    minutes_off = 0.0
+    if at_time is not None and ride.time is not None:
+        gap = datetime.combine(ride.date, ride.time) - datetime.combine(ride.date, at_time)
+        minutes_off = abs(gap.total_seconds()) / 60
+    # The Bayesian score, so one 5-star trip doesn't outrank a long record and unrated drivers sit at the prior
+    rating = ride.driver.rating_score
+    if rating is None:
+        rating = ratings.bayesian_score(0, 0)
+    cost = (detour * DETOUR_KM_COST + minutes_off / 60 * HOUR_OFF_COST + (5 - rating) * STAR_COST
+            - min(ride.seats - seats, MAX_SPARE_SEATS) * SPARE_SEAT_CREDIT)
+    return Match(ride, round(detour, 2), round(minutes_off), round(cost, 3))
+
+
+def match(origin, destination, on_date, at_time=None, seats=1, limit=None):
+    """Rank open rides for a rider going from `origin` to `destination` (places), best first."""
+    started = _time.perf_counter()
+    rides = candidates(origin, destination, on_date, at_time, seats).all()
+    max_detour = current_app.config['MATCH_MAX_DETOUR_KM']
+    scored = (score(ride, origin, destination, at_time, seats) for ride in rides)
+    ranked = heapq.nsmallest(limit or current_app.config['MATCH_RESULTS'],
+                             (m for m in scored if m.detour_km <= max_detour),
+                             key=lambda m: (m.score, m.ride.id))
+    with _stats_lock:
+        _stats['matches'] += 1
+        _stats['candidates'] += len(rides)
+        _stats['seconds'] += _time.perf_counter() - started
+    return ranked
+
+
+def _parse(value, fmt):
+    try:
+        return datetime.strptime(value, fmt) if value else None
+    except ValueError:
+        return None
+
+
+def match_from_args(args):
+    """Run match() for ?origin=&destination=&date=&time=&seats= (or *_lat/*_lon).
+
+    Returns None when either end can't be placed on the map.
+    """
+    origin = distances.place(args.get('origin'), *geo.coordinates_from(args, 'origin'))
+    destination = distances.place(args.get('destination'), *geo.coordinates_from(args, 'destination'))
+    if origin is None or destination is None:
+        return None
+    on_date = _parse(args.get('date'), '%Y-%m-%d')
+    at_time = _parse(args.get('time'), '%H:%M')
+    seats = max(args.get('seats', 1, type=int) or 1, 1)
+    return match(origin, destination, on_date.date() if on_date else date.today(),
+                 at_time.time() if at_time else None, seats)
+
+
+def stats():
+    with _stats_lock:
+        return dict(_stats, **distances.stats())
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from flask import current_app, url_for
+from PIL import Image, ImageOps
+from .extensions import db
+from .jobs import jobs
+from .models.models import User
+from .user_cache import user_cache
+
+# Uploads are stored once under the SHA-256 of their bytes (so identical photos
+# share a file) and served as square WebP/JPEG variants from /media, whose names
+# never change content and can therefore be cached forever. Originals are never
+# served: they sit outside static/ because they still carry EXIF, GPS included.
+# The variants are re-encoded without it.
+
+CHUNK_SIZE = 64 * 1024
+FORMATS = (('WEBP', 'webp'), ('JPEG', 'jpg'))
+
+
+def originals_folder():
+    return current_app.config['MEDIA_ORIGINALS_FOLDER']
+
+
+def move_legacy_originals():
+    """Move originals stored by older releases out of static/. Returns how many moved."""
+    legacy = os.path.join(current_app.config['UPLOAD_FOLDER'], 'originals')
+    if not os.path.isdir(legacy) or os.path.abspath(legacy) == os.path.abspath(originals_folder()):
+        return 0
+    folder = originals_folder()
+    os.makedirs(folder, exist_ok=True)
+    moved = 0
+    for name in os.listdir(legacy):
+        source = os.path.join(legacy, name)
+        if name.endswith('.part'):
+            os.remove(source)
+            continue
+        # shutil.move, since the new folder may be on another filesystem
+        shutil.move(source, os.path.join(folder, name))
+        moved += 1
+    os.rmdir(legacy)
+    return moved
+
+
+def variants_folder():
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'media')
+
+
+def save_upload(file):
+    """Stream an uploaded photo to disk. Returns its content hash, or None if it isn't an image."""
+    folder = originals_folder()
+    os.makedirs(folder, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                out.write(chunk)
+        try:
+            with Image.open(tmp) as image:
+                image.verify()
+        except (OSError, SyntaxError, Image.DecompressionBombError):
+            return None
+        photo_hash = digest.hexdigest()
+        os.replace(tmp, os.path.join(folder, photo_hash))
+        tmp = None
+        return photo_hash
+    finally:
+        if tmp is not None:
+            os.remove(tmp)
+
+
+def variant_name(photo_hash, size, ext):
+    return f'{photo_hash}-{size}.{ext}'
+
+
+def _render_variants(source, folder, photo_hash, sizes, quality):
+    os.makedirs(folder, exist_ok=True)
+    with Image.open(source) as image:
+        image = ImageOps.exif_transpose(image).convert('RGB')
+        for size in sizes:
+            thumb = ImageOps.fit(image, (size, size), Image.LANCZOS)
+            for fmt, ext in FORMATS:
+                path = os.path.join(folder, variant_name(photo_hash, size, ext))
+                if os.path.exists(path):
+                    continue
+                # Write then rename so a half-written variant is never served
+                fd, tmp = tempfile.mkstemp(dir=folder, suffix='.part')
+                with os.fdopen(fd, 'wb') as out:
+                    thumb.save(out, fmt, quality=quality, optimize=True)
+                os.replace(tmp, path)
+
+
+@jobs.job('make_photo_variants')
+def make_photo_variants(user_id, photo_hash):
+    # Switch the user to the new photo only once every size exists
+    args = (os.path.join(originals_folder(), photo_hash), variants_folder(), photo_hash,
+            current_app.config['MEDIA_SIZES'], current_app.config['MEDIA_QUALITY'])
+    if current_app.config['SOCKETIO_ASYNC_MODE'] == 'eventlet':
+        # Resizing is CPU-bound; keep it off the eventlet hub
+        from eventlet import tpool
+        tpool.execute(_render_variants, *args)
+    else:
+        _render_variants(*args)
+
+    # photo_url only ever held pre-pipeline uploads, which this replaces
+    User.query.filter_by(id=user_id).update({User.photo_hash: photo_hash, User.photo_url: None},
+                                            synchronize_session=False)
+    db.session.commit()
+    user_cache.invalidate(user_id)
+
+
+def photo_size(px):
+    # Smallest variant that stays sharp at 2x pixel density
+    sizes = sorted(current_app.config['MEDIA_SIZES'])
+    return next((size for size in sizes if size >= 2 * px), sizes[-1])
+
+
+def media_url(photo_hash, size, ext):
+    return url_for('main.media_file', filename=variant_name(photo_hash, size, ext))
+
+
+def init_app(app):
+    app.add_template_global(photo_size)
+    app.add_template_global(media_url)
@@ -1,6 +1,6 @@
+import uuid
 from datetime import datetime
 from ..extensions import db
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 
 class User(UserMixin, db.Model):
@@ -13,15 +13,13 @@ class User(UserMixin, db.Model):
     verified = db.Column(db.Boolean, default=False)
     password_hash = db.Column(db.String(256), nullable=False)
     photo_url = db.Column(db.String(256), nullable=True)
+    photo_hash = db.Column(db.String(64), nullable=True) # SHA-256 of the original, see media.py
     rating_avg = db.Column(db.Float, default=0.0)
+    rating_sum = db.Column(db.Integer, default=0)
+    rating_count = db.Column(db.Integer, default=0)
+    rating_score = db.Column(db.Float, nullable=True) # Bayesian average, see ratings.py
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
-    def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
-
-    def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
-
 
 class Ride(db.Model):
     __tablename__ = 'rides'
@@ -35,6 +33,47 @@ class Ride(db.Model):
     price = db.Column(db.Float)
     status = db.Column(db.String(32), default='open')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    origin_lat = db.Column(db.Float, nullable=True)
+    origin_lon = db.Column(db.Float, nullable=True)
+    destination_lat = db.Column(db.Float, nullable=True)
+    destination_lon = db.Column(db.Float, nullable=True)
+    origin_cell = db.Column(db.BigInteger, nullable=True) # see geo.cell_id
+    destination_cell = db.Column(db.BigInteger, nullable=True)
+    schedule_id = db.Column(db.Integer, db.ForeignKey('ride_schedules.id'), nullable=True) # set on generated instances
+
+    driver = db.relationship('User', foreign_keys=[driver_id], backref=db.backref('rides_offered', lazy='dynamic'))
+
+    __table_args__ = (
+        db.Index('ix_rides_status_date_time', 'status', 'date', 'time'),
+        db.Index('ix_rides_status_seats', 'status', 'seats'),
+        db.Index('ix_rides_origin_cell', 'origin_cell', 'status', 'date'),
+        db.Index('ix_rides_destination_cell', 'destination_cell', 'status', 'date'),
+        db.Index('ix_rides_schedule_date', 'schedule_id', 'date'),
+        db.Index('ix_rides_driver_id', 'driver_id', 'id'),
+    )
+
+
+class RideSchedule(db.Model):
+    __tablename__ = 'ride_schedules'
+    id = db.Column(db.Integer, primary_key=True)
+    driver_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    origin = db.Column(db.String(256))
+    destination = db.Column(db.String(256))
+    weekdays = db.Column(db.Integer, nullable=False) # bit 0 = Monday ... bit 6 = Sunday
+    time = db.Column(db.Time)
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=True) # open-ended when null
+    seats = db.Column(db.Integer)
+    price = db.Column(db.Float)
+    status = db.Column(db.String(32), default='active') # active, cancelled
+    generated_until = db.Column(db.Date, nullable=True) # last date rides were generated for
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    origin_lat = db.Column(db.Float, nullable=True)
+    origin_lon = db.Column(db.Float, nullable=True)
+    destination_lat = db.Column(db.Float, nullable=True)
+    destination_lon = db.Column(db.Float, nullable=True)
+
+    driver = db.relationship('User', foreign_keys=[driver_id])
 
 
 class Booking(db.Model):
@@ -46,6 +85,18 @@ class Booking(db.Model):
     requested_at = db.Column(db.DateTime, default=datetime.utcnow)
     seats_booked = db.Column(db.Integer, default=1)
 
+    ride = db.relationship('Ride', backref=db.backref('bookings', passive_deletes=True))
+    rider = db.relationship('User', foreign_keys=[rider_id])
+
+    __table_args__ = (
+        db.UniqueConstraint('ride_id', 'rider_id', name='uq_bookings_ride_rider'),
+        db.Index('ix_bookings_rider_id', 'rider_id', 'id'),
+    )
+
+
+def new_message_uid():
+    return uuid.uuid4().hex
+
 
 class Message(db.Model):
     __tablename__ = 'messages'
@@ -54,6 +105,15 @@ class Message(db.Model):
     sender_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     message = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # Given when the message is sent, before the write-behind buffer stores it,
+    # so clients can page and de-duplicate by it (see chat_history.py)
+    uid = db.Column(db.String(32), nullable=False, default=new_message_uid)
+
+    sender = db.relationship('User', foreign_keys=[sender_id])
+
+    __table_args__ = (
+        db.Index('ix_messages_ride_timestamp_uid', 'ride_id', 'timestamp', 'uid'),
+    )
 
 
 class Rating(db.Model):
@@ -66,17 +126,39 @@ class Rating(db.Model):
     comment = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    rater = db.relationship('User', foreign_keys=[rater_id])
+    ratee = db.relationship('User', foreign_keys=[ratee_id])
+
+
+def new_transaction_id():
+    return f'TXN-{uuid.uuid4().hex}'
+
 
 class Payment(db.Model):
+    # Append-only ledger (see payments.py): a refund is a new row with a negative
+    # amount pointing at the charge it reverses, never an edit of the charge
     __tablename__ = 'payments'
     id = db.Column(db.Integer, primary_key=True)
     ride_id = db.Column(db.Integer, db.ForeignKey('rides.id'))
+    booking_id = db.Column(db.Integer, db.ForeignKey('bookings.id', ondelete='SET NULL'), nullable=True)
     payer_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    kind = db.Column(db.String(16), nullable=False, default='charge') # charge, refund
     amount = db.Column(db.Float)
     status = db.Column(db.String(32), default='pending')
-    transaction_id = db.Column(db.String(128), nullable=True)
+    transaction_id = db.Column(db.String(128), unique=True, nullable=False, default=new_transaction_id)
+    idempotency_key = db.Column(db.String(128), unique=True, nullable=True)
+    refund_of = db.Column(db.Integer, db.ForeignKey('payments.id'), unique=True, nullable=True)
     paid_at = db.Column(db.DateTime, nullable=True)
 
+    ride = db.relationship('Ride')
+    payer = db.relationship('User', foreign_keys=[payer_id])
+
+    __table_args__ = (
+        db.Index('ix_payments_booking_kind', 'booking_id', 'kind'),
+        db.Index('ix_payments_ride_payer', 'ride_id', 'payer_id'),
+        db.Index('ix_payments_payer_status', 'payer_id', 'status'),
+    )
+
 
 class Report(db.Model):
     __tablename__ = 'reports'
@@ -88,3 +170,99 @@ class Report(db.Model):
     description = db.Column(db.Text, nullable=True)
     status = db.Column(db.String(32), default='pending') # pending, resolved
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    reporter = db.relationship('User', foreign_keys=[reporter_id])
+    reported_user = db.relationship('User', foreign_keys=[reported_user_id])
+    ride = db.relationship('Ride')
+
+
+class RideSearchToken(db.Model):
+    __tablename__ = 'ride_search_tokens'
+    id = db.Column(db.Integer, primary_key=True)
+    ride_id = db.Column(db.Integer, db.ForeignKey('rides.id'), nullable=False, index=True)
+    field = db.Column(db.String(16), nullable=False) # origin, destination
+    token = db.Column(db.String(64), nullable=False)
+
+    __table_args__ = (
+        db.Index('ix_ride_search_tokens_lookup', 'field', 'token', 'ride_id'),
+    )
+
+
+class Landmark(db.Model):
+    __tablename__ = 'landmarks'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(256), nullable=False)
+    name_norm = db.Column(db.String(256), unique=True, nullable=False) # search.normalize(name)
+    lat = db.Column(db.Float, nullable=False)
+    lon = db.Column(db.Float, nullable=False)
+
+
+class LandmarkDistance(db.Model):
+    # Travel distance between two landmarks, one row per unordered pair
+    # (from_id < to_id); built by `flask build-landmark-distances`, read by matching.py
+    __tablename__ = 'landmark_distances'
+    from_id = db.Column(db.Integer, db.ForeignKey('landmarks.id', ondelete='CASCADE'), primary_key=True)
+    to_id = db.Column(db.Integer, db.ForeignKey('landmarks.id', ondelete='CASCADE'), primary_key=True)
+    km = db.Column(db.Float, nullable=False)
+
+
+class UserActivity(db.Model):
+    # Per-user running totals, kept up to date by activity.py as payments, completions
+    # and cancellations happen; `flask rebuild-activity` recomputes them from scratch
+    __tablename__ = 'user_activity'
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    trips_paid = db.Column(db.Integer, nullable=False, default=0)
+    trips_completed = db.Column(db.Integer, nullable=False, default=0)
+    seats_booked = db.Column(db.Integer, nullable=False, default=0)
+    spent = db.Column(db.Float, nullable=False, default=0.0)
+    rides_completed = db.Column(db.Integer, nullable=False, default=0)
+    rides_cancelled = db.Column(db.Integer, nullable=False, default=0)
+    seats_filled = db.Column(db.Integer, nullable=False, default=0)
+    earned = db.Column(db.Float, nullable=False, default=0.0)
+
+
+# Archive tables (see maintenance.py): same columns as the live tables, no foreign
+# keys, plus when the row was moved so old archives can be purged in order.
+
+class ArchivedRide(db.Model):
+    __tablename__ = 'rides_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    driver_id = db.Column(db.Integer, index=True)
+    origin = db.Column(db.String(256))
+    destination = db.Column(db.String(256))
+    date = db.Column(db.Date)
+    time = db.Column(db.Time)
+    seats = db.Column(db.Integer)
+    price = db.Column(db.Float)
+    status = db.Column(db.String(32))
+    created_at = db.Column(db.DateTime)
+    origin_lat = db.Column(db.Float, nullable=True)
+    origin_lon = db.Column(db.Float, nullable=True)
+    destination_lat = db.Column(db.Float, nullable=True)
+    destination_lon = db.Column(db.Float, nullable=True)
+    origin_cell = db.Column(db.BigInteger, nullable=True)
+    destination_cell = db.Column(db.BigInteger, nullable=True)
+    schedule_id = db.Column(db.Integer, nullable=True)
+    archived_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class ArchivedBooking(db.Model):
+    __tablename__ = 'bookings_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    ride_id = db.Column(db.Integer, index=True)
+    rider_id = db.Column(db.Integer, index=True)
+    status = db.Column(db.String(32))
+    requested_at = db.Column(db.DateTime)
+    seats_booked = db.Column(db.Integer)
+    archived_at = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class ArchivedMessage(db.Model):
+    __tablename__ = 'messages_archive'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    ride_id = db.Column(db.Integer, index=True)
+    sender_id = db.Column(db.Integer)
+    message = db.Column(db.Text)
+    timestamp = db.Column(db.DateTime)
+    uid = db.Column(db.String(32))
+    archived_at = db.Column(db.DateTime, nullable=False, index=True)
@@ -0,0 +1,87 @@
+import atexit
+import threading
+from . import socketio
+
+# Rooms: every signed-in socket joins user:<id>; pages showing a ride join
+# ride:<id> with the 'watch' event (socketio_handlers.py).
+
+
+def user_room(user_id):
+    return f'user:{user_id}'
+
+
+def ride_room(ride_id):
+    return f'ride:{ride_id}'
+
+
+class Notifier:
+    """Coalescing Socket.IO publisher for booking and ride updates.
+
+    Events are held for NOTIFY_COALESCE_INTERVAL seconds and only the latest
+    per (room, event, key) is sent, so a run of seat changes on a popular ride
+    reaches its watchers as one update instead of one per booking.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        self.interval = 0.25
+        self._stats = {'published': 0, 'emitted': 0, 'coalesced': 0}
+
+    def init_app(self, app):
+        self.interval = app.config['NOTIFY_COALESCE_INTERVAL']
+        app.extensions['notifier'] = self
+        atexit.register(self.flush)
+
+    def publish(self, room, event, payload, key=None):
+        with self._lock:
+            self._stats['published'] += 1
+            if self.interval <= 0:
+                self._stats['emitted'] += 1
+        if self.interval <= 0:
+            socketio.emit(event, payload, to=room)
+            return
+        with self._lock:
+            previous = self._pending.get((room, event, key))
+            if previous is not None:
+                # Later fields win, earlier ones not resent are kept
+                self._stats['coalesced'] += 1
+                payload = dict(previous, **payload)
+            self._pending[(room, event, key)] = payload
+            if self._flusher is None:
+                self._flusher = socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            self._stats['emitted'] += len(batch)
+        for (room, event, _), payload in batch.items():
+            socketio.emit(event, payload, to=room)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, pending=len(self._pending))
+
+
+notifier = Notifier()
+
+
+def booking_changed(user_id, booking_id, ride_id, status, message):
+    notifier.publish(user_room(user_id), 'booking',
+                     {'booking_id': booking_id, 'ride_id': ride_id, 'status': status, 'msg': message},
+                     key=booking_id)
+
+
+def ride_changed(ride_id, status=None, seats=None):
+    payload = {'ride_id': ride_id}
+    if status is not None:
+        payload['status'] = status
+    if seats is not None:
+        payload['seats'] = seats
+    notifier.publish(ride_room(ride_id), 'ride', payload, key=ride_id)
@@ -0,0 +1,64 @@
+import base64
+import json
+from sqlalchemy import and_, or_
+
+
+def clamp_page_size(requested, default, maximum):
+    try:
+        size = int(requested) if requested else default
+    except (TypeError, ValueError):
+        size = default
+    return max(1, min(size, maximum))
+
+
+class Keyset:
+    """Cursor (keyset) pagination over a unique, ordered tuple of columns.
+
+    Pages are fetched with ``WHERE (cols) > (last row)`` instead of OFFSET, so
+    every page costs the same no matter how deep the client has scrolled.
+    """
+
+    def __init__(self, columns, parsers, key, descending=None):
+        self.columns = columns
+        self.parsers = parsers
+        self.key = key
+        self.descending = descending or (False,) * len(columns)
+
+    def order_by(self):
+        return [col.desc() if desc else col.asc() for col, desc in zip(self.columns, self.descending)]
+
+    def after(self, values):
+        # (a, b, c) > (x, y, z) spelled out as OR-ed prefixes so it works on
+        # every backend and lets the planner use the leading index columns.
+        clauses = []
+        for i, (col, desc) in enumerate(zip(self.columns, self.descending)):
+            equal = [c == v for c, v in zip(self.columns[:i], values[:i])]
+            clauses.append(and_(*equal, col < values[i] if desc else col > values[i]))
+        return or_(*clauses)
+
+    def encode(self, row):
+        values = [v.isoformat() if hasattr(v, 'isoformat') else v for v in self.key(row)]
+        raw = json.dumps(values, separators=(',', ':')).encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def decode(self, cursor):
+        # Raises ValueError for malformed or tampered cursors
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            values = json.loads(raw)
+            if not isinstance(values, list) or len(values) != len(self.parsers):
+                raise ValueError('cursor has the wrong shape')
+            return [parse(v) for parse, v in zip(self.parsers, values)]
+        except (TypeError, json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise ValueError('invalid cursor') from e
+
+    def page_query(self, query, cursor, limit):
+        # Fetches one extra row so callers can tell whether a next page exists
+        if cursor:
+            query = query.filter(self.after(self.decode(cursor)))
+        return query.order_by(*self.order_by()).limit(limit + 1)
+
+    def paginate(self, query, cursor, limit):
+        rows = self.page_query(query, cursor, limit).all()
+        next_cursor = self.encode(rows[limit - 1]) if len(rows) > limit else None
+        return rows[:limit], next_cursor
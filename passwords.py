@@ -0,0 +1,62 @@
+import threading
+from flask import current_app
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, generate_password_hash
+from .extensions import db
+from .user_cache import user_cache
+
+# Password hashing is deliberately slow CPU work. Under eventlet it would run on
+# the hub and freeze every other green thread (chat sockets included) for its
+# duration, so it runs on eventlet's native thread pool instead, where hashlib
+# releases the GIL. The semaphore caps how many hashes run at once so a login
+# storm queues up rather than starving the rest of the app of CPU.
+
+_slots = threading.BoundedSemaphore(4)
+
+
+def init_app(app):
+    global _slots
+    size = app.config['PASSWORD_HASH_CONCURRENCY']
+    if app.config['SOCKETIO_ASYNC_MODE'] == 'eventlet':
+        # A green semaphore, so a login waiting for a slot yields to the hub
+        # even where threading hasn't been monkey-patched
+        from eventlet.semaphore import BoundedSemaphore
+        _slots = BoundedSemaphore(size)
+    else:
+        _slots = threading.BoundedSemaphore(size)
+
+
+def _canonical(method):
+    # Werkzeug fills in default parameters, and stores the full form in the hash
+    parts = method.split(':')
+    if parts[0] == 'scrypt' and len(parts) == 1:
+        return 'scrypt:32768:8:1'
+    if parts[0] == 'pbkdf2' and len(parts) < 3:
+        return f'pbkdf2:{parts[1] if len(parts) > 1 else "sha256"}:{DEFAULT_PBKDF2_ITERATIONS}'
+    return method
+
+
+def _offload(func, *args):
+    with _slots:
+        if current_app.config['SOCKETIO_ASYNC_MODE'] == 'eventlet':
+            from eventlet import tpool
+            return tpool.execute(func, *args)
+        return func(*args)
+
+
+def hash_password(password):
+    return _offload(generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def needs_rehash(password_hash):
+    return password_hash.split('$', 1)[0] != _canonical(current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def verify(user, password):
+    """Check a login password, upgrading the stored hash if PASSWORD_HASH_METHOD has changed."""
+    if not password or not _offload(check_password_hash, user.password_hash, password):
+        return False
+    if needs_rehash(user.password_hash):
+        user.password_hash = hash_password(password)
+        db.session.commit()
+        user_cache.invalidate(user.id)
+    return True
@@ -0,0 +1,163 @@
+import logging
+from datetime import datetime
+from sqlalchemy import and_, case, exists, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from .extensions import db
+from .jobs import jobs
+from .models.models import Booking, Payment, Ride, new_transaction_id
+
+log = logging.getLogger(__name__)
+
+# The payments table is an append-only ledger. A booking is charged once: the
+# charge carries an idempotency key (the client's Idempotency-Key, or one
+# derived from the booking) and confirming the booking is a conditional
+# UPDATE, so a double-submitted or retried payment finds the first charge
+# instead of writing a second. Refunds are new rows with negative amounts and
+# refund_of pointing at the charge, unique so a charge is reversed at most once.
+
+# Figures from the most recent reconciliation in this process
+last_run = {}
+
+
+def settled():
+    """Filter for charges that went through and have not been refunded."""
+    refund = aliased(Payment)
+    return and_(Payment.kind == 'charge', Payment.status == 'completed',
+                ~exists().where(refund.refund_of == Payment.id))
+
+
+class DuplicateKey(ValueError):
+    pass
+
+
+def charge(booking, amount, key=None):
+    """Charge an approved booking and confirm it. Returns (payment, created).
+
+    When the booking was already paid, by this request's earlier attempt or a
+    concurrent duplicate, the existing charge comes back with created=False.
+    Does not commit.
+    """
+    confirmed = Booking.query.filter_by(id=booking.id, status='approved') \
+        .update({Booking.status: 'confirmed'}, synchronize_session=False)
+    if not confirmed:
+        return Payment.query.filter_by(booking_id=booking.id, kind='charge').first(), False
+
+    payment = Payment(ride_id=booking.ride_id, booking_id=booking.id, payer_id=booking.rider_id, kind='charge',
+                      amount=amount, status='completed', idempotency_key=key or f'charge:{booking.id}',
+                      paid_at=datetime.utcnow())
+    db.session.add(payment)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        raise DuplicateKey('That idempotency key was already used for another payment.')
+    return payment, True
+
+
+def _refund(condition):
+    charges = db.session.execute(
+        select(Payment.id, Payment.ride_id, Payment.payer_id, Payment.amount, Payment.booking_id)
+        .where(condition, settled())).all()
+    now = datetime.utcnow()
+    rows = [{'ride_id': ride_id, 'booking_id': booking_id, 'payer_id': payer_id, 'kind': 'refund',
+             'amount': -amount, 'status': 'completed', 'transaction_id': new_transaction_id(),
+             'idempotency_key': f'refund:{charge_id}', 'refund_of': charge_id, 'paid_at': now}
+            for charge_id, ride_id, payer_id, amount, booking_id in charges]
+    if rows:
+        db.session.execute(Payment.__table__.insert(), rows)
+    return [(ride_id, payer_id, amount, booking_id) for _, ride_id, payer_id, amount, booking_id in charges]
+
+
+def refund_rides(ride_ids):
+    """Append a refund for every settled charge on these rides. Returns (ride_id, payer_id, amount, booking_id) rows.
+
+    One SELECT and one multi-row INSERT however many riders there are. Does not commit.
+    """
+    return _refund(Payment.ride_id.in_(ride_ids))
+
+
+def refund_bookings(booking_ids):
+    """refund_rides() for individual bookings."""
+    return _refund(Payment.booking_id.in_(booking_ids))
+
+
+def link_bookings():
+    """Fill in booking_id on payments recorded before the ledger had it, matching on (ride, payer).
+
+    Databases from before uq_bookings_ride_rider can hold several bookings for
+    one (ride, payer); those payments are left unlinked rather than guessed at,
+    and reconcile() counts them as 'unlinked'.
+    """
+    same = and_(Booking.ride_id == Payment.ride_id, Booking.rider_id == Payment.payer_id)
+    matches = select(func.count(Booking.id)).where(same).scalar_subquery()
+    booking = select(func.min(Booking.id)).where(same).scalar_subquery()
+    return db.session.execute(
+        update(Payment).where(Payment.booking_id.is_(None), matches == 1).values(booking_id=booking)
+        .execution_options(synchronize_session=False)).rowcount
+
+
+def reconcile(limit=100):
+    """Check the ledger against bookings in one GROUP BY pass.
+
+    A confirmed booking must hold exactly one unrefunded charge and net to
+    that charge's amount, so every earlier charge was refunded in full. It is
+    not compared with the ride's price, which the driver may have changed
+    since the rider paid. Any other booking must net to zero, and so must
+    every booking on a cancelled ride (its cancellation should have refunded
+    the charge). Returns counts per problem and up to `limit` offending bookings.
+    """
+    charges = func.sum(case((Payment.kind == 'charge', 1), else_=0))
+    refunds = func.sum(case((Payment.kind == 'refund', 1), else_=0))
+    net = func.coalesce(func.sum(Payment.amount), 0.0)
+    expected = func.coalesce(func.sum(case((settled(), Payment.amount), else_=0.0)), 0.0)
+    confirmed = Booking.status == 'confirmed'
+    cancelled = Ride.status == 'cancelled'
+    rows = db.session.query(Booking.id, Booking.status, Ride.status, charges - refunds, net, expected) \
+        .join(Ride, Ride.id == Booking.ride_id) \
+        .outerjoin(Payment, and_(Payment.booking_id == Booking.id, Payment.status == 'completed')) \
+        .group_by(Booking.id, Booking.status, Ride.status) \
+        .having(or_(
+            charges - refunds > 1,
+            and_(cancelled, charges - refunds > 0),
+            and_(confirmed, charges - refunds != 1),
+            and_(~confirmed, func.abs(net) > 0.005),
+            and_(confirmed, func.abs(net - expected) > 0.005),
+        )).all()
+
+    found = {'duplicate_charges': 0, 'charged_on_cancelled': 0, 'unpaid_confirmed': 0,
+             'paid_unconfirmed': 0, 'amount_mismatch': 0}
+    problems = []
+    for booking_id, status, ride_status, open_charges, held, due in rows:
+        if open_charges > 1:
+            problem = 'duplicate_charges'
+        elif ride_status == 'cancelled' and open_charges > 0:
+            problem = 'charged_on_cancelled'
+        elif status == 'confirmed' and open_charges < 1:
+            problem = 'unpaid_confirmed'
+        elif status != 'confirmed':
+            problem = 'paid_unconfirmed'
+        else:
+            problem = 'amount_mismatch'
+        found[problem] += 1
+        if len(problems) < limit:
+            problems.append({'booking_id': booking_id, 'status': status, 'problem': problem,
+                             'held': round(held, 2), 'due': round(due or 0, 2)})
+    found['unlinked'] = db.session.query(func.count(Payment.id)).filter(Payment.booking_id.is_(None)).scalar()
+    return found, problems
+
+
+@jobs.job('reconcile_payments')
+def reconcile_payments():
+    linked = link_bookings()
+    db.session.commit()
+    found, problems = reconcile()
+    last_run.clear()
+    last_run.update(found, linked=linked)
+    for problem in problems:
+        log.warning('Ledger mismatch: %s', problem)
+    return dict(last_run), problems
+
+
+def stats():
+    return dict(last_run)
@@ -0,0 +1,57 @@
+from flask import current_app
+from sqlalchemy import func, update
+from .extensions import db
+from .models.models import User, Rating
+from .user_cache import user_cache
+
+
+def bayesian_score(rating_sum, rating_count):
+    # Shrinks averages built on few ratings towards the prior, so one 5-star
+    # trip does not outrank a driver with fifty 4.8s
+    mean = current_app.config['RATING_PRIOR_MEAN']
+    weight = current_app.config['RATING_PRIOR_WEIGHT']
+    return (mean * weight + rating_sum) / (weight + rating_count)
+
+
+def record_rating(ratee_id, stars):
+    # Single atomic UPDATE; the right-hand sides all see the pre-update row,
+    # so concurrent ratings cannot lose increments
+    mean = current_app.config['RATING_PRIOR_MEAN']
+    weight = current_app.config['RATING_PRIOR_WEIGHT']
+    rating_sum = func.coalesce(User.rating_sum, 0) + stars
+    rating_count = func.coalesce(User.rating_count, 0) + 1
+    User.query.filter_by(id=ratee_id).update({
+        User.rating_sum: rating_sum,
+        User.rating_count: rating_count,
+        User.rating_avg: rating_sum * 1.0 / rating_count,
+        User.rating_score: (mean * weight + rating_sum) * 1.0 / (weight + rating_count),
+    }, synchronize_session=False)
+
+
+def rebuild_aggregates():
+    # One GROUP BY pass over ratings, then a bulk primary-key UPDATE
+    totals = db.session.query(Rating.ratee_id, func.sum(Rating.stars), func.count(Rating.id)) \
+        .group_by(Rating.ratee_id).all()
+
+    User.query.update({
+        User.rating_sum: 0,
+        User.rating_count: 0,
+        User.rating_avg: 0.0,
+        User.rating_score: bayesian_score(0, 0),
+    }, synchronize_session=False)
+
+    rows = [
+        {
+            'id': ratee_id,
+            'rating_sum': int(stars),
+            'rating_count': count,
+            'rating_avg': stars / count,
+            'rating_score': bayesian_score(stars, count),
+        }
+        for ratee_id, stars, count in totals if ratee_id is not None
+    ]
+    if rows:
+        db.session.execute(update(User), rows)
+    db.session.commit()
+    user_cache.clear()
+    return len(rows)
@@ -0,0 +1,149 @@
+import threading
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+from .extensions import db
+from . import activity, fares, notifications, payments
+from .jobs import jobs
+from .models.models import Booking, Ride
+
+# Booking states a ride cancellation has to cancel (and refund, once paid)
+LIVE_STATUSES = ('pending', 'approved', 'confirmed')
+
+# Booking states a driver can still reject, and those that hold seats on the ride
+REJECTABLE_STATUSES = LIVE_STATUSES
+HOLDS_SEATS = ('approved', 'confirmed')
+
+APPROVED = 'approved'
+REJECTED = 'rejected'
+SOLD_OUT = 'sold_out'
+CONFLICT = 'conflict'
+
+# Process-wide contention counters
+_stats = {
+    'booking_requests': 0,
+    'duplicate_bookings': 0,
+    'approve_attempts': 0,
+    'approved': 0,
+    'sold_out': 0,
+    'conflicts': 0,
+    'seats_reserved': 0,
+    'seats_released': 0,
+    'rejected': 0,
+}
+_lock = threading.Lock()
+
+
+def _count(key, n=1):
+    with _lock:
+        _stats[key] += n
+
+
+def stats():
+    with _lock:
+        return dict(_stats)
+
+
+def reserve_seats(ride_id, seats):
+    # Conditional decrement: the check and the write are one statement, so two
+    # drivers' clicks (or two workers) can never take the count below zero
+    rows = Ride.query.filter(Ride.id == ride_id, Ride.status == 'open', Ride.seats >= seats) \
+        .update({Ride.seats: Ride.seats - seats}, synchronize_session=False)
+    return rows == 1
+
+
+def release_seats(ride_id, seats):
+    # Only call in the same transaction as the conditional UPDATE that took the
+    # booking out of HOLDS_SEATS, so the seats go back exactly once
+    Ride.query.filter(Ride.id == ride_id).update({Ride.seats: Ride.seats + seats}, synchronize_session=False)
+    _count('seats_released', seats)
+
+
+def request_booking(ride, rider_id, seats=1):
+    # Relies on uq_bookings_ride_rider instead of SELECT-then-INSERT;
+    # returns None when the rider already has a booking for this ride
+    _count('booking_requests')
+    booking = Booking(ride_id=ride.id, rider_id=rider_id, status='pending', seats_booked=seats)
+    db.session.add(booking)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        _count('duplicate_bookings')
+        return None
+    return booking
+
+
+def approve_booking(booking):
+    _count('approve_attempts')
+    seats = booking.seats_booked or 1
+
+    # Claim the booking first so a double-submitted approval cannot take seats twice
+    claimed = Booking.query.filter_by(id=booking.id, status='pending') \
+        .update({Booking.status: 'approved'}, synchronize_session=False)
+    if not claimed:
+        db.session.rollback()
+        _count('conflicts')
+        return CONFLICT
+
+    if not reserve_seats(booking.ride_id, seats):
+        db.session.rollback()
+        _count('sold_out')
+        return SOLD_OUT
+
+    db.session.commit()
+    _count('approved')
+    _count('seats_reserved', seats)
+    return APPROVED
+
+
+def reject_booking(booking):
+    """Reject a booking, giving back its seats and refunding it if it held any.
+
+    The status change is conditional on the status the booking was read with,
+    so a double-submitted rejection, or one racing an approval or a payment,
+    gets CONFLICT instead of releasing seats twice or leaving a charge behind.
+    """
+    previous, rider_id, driver_id = booking.status, booking.rider_id, booking.ride.driver_id
+    if previous not in REJECTABLE_STATUSES:
+        _count('conflicts')
+        return CONFLICT
+    rejected = Booking.query.filter_by(id=booking.id, status=previous) \
+        .update({Booking.status: 'rejected'}, synchronize_session=False)
+    if not rejected:
+        db.session.rollback()
+        _count('conflicts')
+        return CONFLICT
+
+    seats = booking.seats_booked or 1
+    if previous in HOLDS_SEATS:
+        release_seats(booking.ride_id, seats)
+    refunded = payments.refund_bookings([booking.id]) if previous == 'confirmed' else []
+    if refunded:
+        activity.refunded([(payer_id, driver_id, amount, seats) for _, payer_id, amount, _ in refunded])
+    db.session.commit()
+    if refunded:
+        fares.invalidate(rider_id, driver_id)
+    _count('rejected')
+    return REJECTED
+
+
+@jobs.job('cancel_ride_bookings')
+def cancel_ride_bookings(*ride_ids):
+    # Fan-out for cancelled rides: one set-based UPDATE and one refund INSERT however
+    # many riders there are. Safe to retry; cancelled bookings and refunded charges are left alone.
+    cancelled = db.session.execute(
+        update(Booking).where(Booking.ride_id.in_(ride_ids), Booking.status.in_(LIVE_STATUSES))
+        .values(status='cancelled')
+        .returning(Booking.id, Booking.ride_id, Booking.rider_id, Booking.seats_booked)).all()
+    refunded = payments.refund_rides(ride_ids)
+    if refunded:
+        seats = {(ride_id, rider_id): seats for _, ride_id, rider_id, seats in cancelled}
+        drivers = dict(db.session.execute(select(Ride.id, Ride.driver_id).where(Ride.id.in_(ride_ids))).all())
+        activity.refunded([(payer_id, drivers[ride_id], amount, seats.get((ride_id, payer_id), 0))
+                           for ride_id, payer_id, amount, _ in refunded])
+    db.session.commit()
+    if refunded:
+        fares.invalidate(*(payer_id for _, payer_id, _, _ in refunded), *drivers.values())
+    for booking_id, ride_id, rider_id, _ in cancelled:
+        notifications.booking_changed(rider_id, booking_id, ride_id, 'cancelled',
+                                      'The driver cancelled this ride. Any payment has been refunded.')
@@ -1,6 +1,12 @@
-import sys
 import os
 
+# Green the stdlib (sockets for the message queue client, DB drivers) before anything else is imported
+if os.environ.get('SOCKETIO_ASYNC_MODE', 'eventlet') == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+
+import sys
+
 # Add the parent directory to sys.path to allow importing 'app'
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
@@ -10,8 +16,10 @@ app = create_app()
 
 if __name__ == '__main__':
     with app.app_context():
-        from app.extensions import db
-        db.create_all()
-        print("Database tables created.")
+        # Creates a new database, or brings an old one up to date (same as `flask upgrade-schema`)
+        from app import media, schema
+        schema.upgrade()
+        media.move_legacy_originals()
+        print("Database schema up to date.")
     
     socketio.run(app, debug=True, port=5001)
@@ -0,0 +1,151 @@
+from datetime import date, datetime, timedelta
+from sqlalchemy import case, func, insert, update
+from .extensions import db
+from . import fares, geo, search
+from .models.models import Ride, RideSchedule, RideSearchToken
+
+# A schedule's rides are generated a rolling window ahead (SCHEDULE_WINDOW_DAYS)
+# rather than all at once, so open-ended schedules never flood the catalog;
+# `flask generate-schedules` from cron keeps the window topped up.
+
+WEEKDAY_NAMES = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+# Fields that carry over from the schedule to each generated ride
+_RIDE_FIELDS = ('origin', 'destination', 'time', 'seats', 'price',
+                'origin_lat', 'origin_lon', 'destination_lat', 'destination_lon')
+
+
+def weekdays_mask(days):
+    return sum(1 << int(day) for day in days if str(day).isdigit() and 0 <= int(day) < 7)
+
+
+def weekdays_label(mask):
+    return ', '.join(name for i, name in enumerate(WEEKDAY_NAMES) if mask & (1 << i))
+
+
+def update_from_form(schedule, form, editing=False):
+    """Copy the schedule form onto `schedule`. Raises ValueError on bad input.
+
+    The weekday pattern and start date are fixed once rides exist for them;
+    changing those means cancelling the schedule and creating a new one.
+    """
+    schedule.origin = form.get('origin')
+    schedule.destination = form.get('destination')
+    try:
+        schedule.time = datetime.strptime((form.get('time') or '')[:5], '%H:%M').time()
+        schedule.seats = int(form.get('seats'))
+        schedule.price = fares.parse_price(form.get('price'))
+        end = form.get('end_date')
+        schedule.end_date = datetime.strptime(end, '%Y-%m-%d').date() if end else None
+        if not editing:
+            schedule.start_date = datetime.strptime(form.get('start_date') or '', '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise ValueError('Invalid date, time, seats or price (a number, zero or more).')
+    if schedule.seats < 1:
+        raise ValueError('Seats must be at least 1.')
+    schedule.origin_lat, schedule.origin_lon = geo.coordinates_from(form, 'origin')
+    schedule.destination_lat, schedule.destination_lon = geo.coordinates_from(form, 'destination')
+    if not editing:
+        schedule.weekdays = weekdays_mask(form.getlist('weekdays'))
+        if not schedule.weekdays:
+            raise ValueError('Pick at least one day of the week.')
+    if schedule.end_date is not None and schedule.end_date < schedule.start_date:
+        raise ValueError('The end date is before the start date.')
+
+
+def _template_ride(schedule):
+    # A transient ride holding what every instance shares, geocoded once
+    ride = Ride(driver_id=schedule.driver_id, schedule_id=schedule.id, status='open',
+                **{field: getattr(schedule, field) for field in _RIDE_FIELDS})
+    geo.locate_ride(ride, search.normalize)
+    return ride
+
+
+def generate(schedule, until):
+    """Insert the schedule's rides from where it last stopped up to `until`. Returns how many."""
+    start = max(schedule.start_date, date.today(),
+                schedule.generated_until + timedelta(days=1) if schedule.generated_until else date.min)
+    end = min(until, schedule.end_date or until)
+    if schedule.status != 'active' or start > end:
+        return 0
+
+    days = [start + timedelta(days=i) for i in range((end - start).days + 1)]
+    days = [day for day in days if schedule.weekdays & (1 << day.weekday())]
+    schedule.generated_until = end
+    if not days:
+        return 0
+
+    template = _template_ride(schedule)
+    shared = {column.key: getattr(template, column.key) for column in Ride.__table__.columns
+              if column.key not in ('id', 'date', 'created_at')}
+    # One multi-row INSERT ... RETURNING for all the dates, then one for their search tokens
+    ride_ids = db.session.execute(insert(Ride).returning(Ride.id),
+                                  [dict(shared, date=day) for day in days]).scalars().all()
+    _index(ride_ids, template)
+    return len(ride_ids)
+
+
+def _index(ride_ids, template):
+    # Instances share origin and destination, so their tokens differ only by ride_id
+    tokens = [(field, token) for field in search.SEARCH_FIELDS for token in search.tokenize(getattr(template, field))]
+    rows = [{'ride_id': ride_id, 'field': field, 'token': token} for ride_id in ride_ids for field, token in tokens]
+    if rows:
+        db.session.execute(RideSearchToken.__table__.insert(), rows)
+
+
+def generate_due(window_days):
+    """Top up every active schedule whose generated window ends before today + window_days."""
+    until = date.today() + timedelta(days=window_days)
+    due = RideSchedule.query.filter(
+        RideSchedule.status == 'active',
+        (RideSchedule.generated_until.is_(None)) | (RideSchedule.generated_until < until),
+        (RideSchedule.end_date.is_(None)) | ((RideSchedule.end_date >= date.today()) &
+                                             (RideSchedule.end_date > func.coalesce(RideSchedule.generated_until, date.min))),
+    ).order_by(RideSchedule.id).all()
+    created = 0
+    for schedule in due:
+        created += generate(schedule, until)
+        db.session.commit()
+    return len(due), created
+
+
+def _future_open(schedule_id):
+    # Upcoming instances nobody has started: open and not yet departed
+    return (Ride.schedule_id == schedule_id, Ride.date >= date.today(), Ride.status == 'open')
+
+
+def propagate(schedule, old_seats):
+    """Apply an edited schedule to its upcoming rides in one UPDATE.
+
+    Seats shift by the change in capacity, so seats already reserved on an
+    instance stay reserved. Instances past a moved-up end date are cancelled
+    by a second UPDATE. Returns (updated ids, cancelled ids).
+    """
+    template = _template_ride(schedule)
+    delta = schedule.seats - old_seats
+    values = {field: getattr(template, field)
+              for field in _RIDE_FIELDS + ('origin_cell', 'destination_cell') if field != 'seats'}
+    values['seats'] = case((Ride.seats + delta < 0, 0), else_=Ride.seats + delta)
+    ride_ids = db.session.execute(
+        update(Ride).where(*_future_open(schedule.id)).values(**values).returning(Ride.id)).scalars().all()
+
+    # A shortened date range drops the instances that now fall outside it
+    if schedule.end_date is not None:
+        dropped = db.session.execute(
+            update(Ride).where(*_future_open(schedule.id), Ride.date > schedule.end_date)
+            .values(status='cancelled').returning(Ride.id)).scalars().all()
+        if schedule.generated_until and schedule.generated_until > schedule.end_date:
+            schedule.generated_until = schedule.end_date
+    else:
+        dropped = []
+
+    search.unindex_rides(ride_ids)
+    _index(ride_ids, template)
+    return ride_ids, dropped
+
+
+def cancel(schedule):
+    """Cancel the schedule and, in one UPDATE, all of its upcoming rides. Returns their ids."""
+    schedule.status = 'cancelled'
+    return db.session.execute(
+        update(Ride).where(*_future_open(schedule.id)).values(status='cancelled').returning(Ride.id)).scalars().all()
@@ -0,0 +1,138 @@
+import logging
+from sqlalchemy import String, UniqueConstraint, cast, inspect, literal, select, text, update
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import aliased
+from .extensions import db
+from . import payments
+from .models.models import ArchivedMessage, Message, Payment
+
+log = logging.getLogger(__name__)
+
+# Brings a database created by an older release up to the current models.
+# db.create_all() only creates missing tables; it never adds a column or an
+# index to a table that already exists. Every step here checks the live schema
+# first, so running it again is a no-op.
+#
+# Columns are added nullable (SQLite can't add a NOT NULL column without a
+# constant default), then backfilled; on PostgreSQL they are made NOT NULL
+# afterwards. Unique columns and constraints on existing tables become unique
+# indexes, since SQLite can't ALTER a constraint in either.
+
+# Indexes that later releases replaced
+OBSOLETE_INDEXES = {'messages': ('ix_messages_ride_timestamp_id',)}
+
+
+def _quote(name):
+    return db.engine.dialect.identifier_preparer.quote(name)
+
+
+def _column_ddl(column):
+    ddl = f'{_quote(column.name)} {column.type.compile(dialect=db.engine.dialect)}'
+    for fk in column.foreign_keys:
+        ddl += f' REFERENCES {_quote(fk.column.table.name)} ({_quote(fk.column.name)})'
+        if fk.ondelete:
+            ddl += f' ON DELETE {fk.ondelete}'
+    return ddl
+
+
+def _unique_sets(inspector, table_name):
+    # Column tuples the live table already enforces as unique
+    found = {tuple(c['column_names']) for c in inspector.get_unique_constraints(table_name)}
+    found |= {tuple(i['column_names']) for i in inspector.get_indexes(table_name) if i.get('unique')}
+    found |= {tuple(inspector.get_pk_constraint(table_name)['constrained_columns'])}
+    return found
+
+
+def _wanted_uniques(table):
+    # Column(unique=True) shows up here too, as an unnamed UniqueConstraint
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint) and constraint.columns:
+            columns = tuple(c.name for c in constraint.columns)
+            yield constraint.name or f'uq_{table.name}_{"_".join(columns)}', columns
+
+
+def _backfill(conn, added):
+    counts = {}
+    for column in added:
+        default = column.default
+        if default is not None and default.is_scalar:
+            counts[f'{column.table.name}.{column.name}'] = conn.execute(
+                update(column.table).where(column.is_(None)).values({column: default.arg})).rowcount
+
+    # Values that must be unique per row, derived from the primary key
+    for model in (Message, ArchivedMessage):
+        counts[f'{model.__tablename__}.uid'] = conn.execute(
+            update(model).where(model.uid.is_(None)).values(uid=literal('m') + cast(model.id, String))).rowcount
+    # Old transaction ids were timestamps and may repeat; keep the first, renumber the rest
+    earlier = aliased(Payment)
+    repeated = select(earlier.id).where(earlier.transaction_id == Payment.transaction_id, earlier.id < Payment.id) \
+        .exists()
+    counts['payments.transaction_id'] = conn.execute(
+        update(Payment).where(Payment.transaction_id.is_(None) | repeated)
+        .values(transaction_id=literal('TXN-legacy-') + cast(Payment.id, String))).rowcount
+    return {key: value for key, value in counts.items() if value}
+
+
+def upgrade():
+    """Create missing tables, columns and indexes and backfill them. Returns what was done."""
+    engine = db.engine
+    report = {'tables': [], 'columns': [], 'indexes': [], 'dropped': [], 'backfilled': {}, 'failed': []}
+
+    existing = set(inspect(engine).get_table_names())
+    missing = [table for table in db.metadata.sorted_tables if table.name not in existing]
+    db.metadata.create_all(engine, tables=missing)
+    report['tables'] = [table.name for table in missing]
+
+    inspector = inspect(engine)
+    old_tables = [table for table in db.metadata.sorted_tables if table.name in existing]
+    added = []
+    with engine.begin() as conn:
+        for table in old_tables:
+            have = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in have:
+                    conn.execute(text(f'ALTER TABLE {_quote(table.name)} ADD COLUMN {_column_ddl(column)}'))
+                    added.append(column)
+        report['columns'] = [f'{column.table.name}.{column.name}' for column in added]
+        report['backfilled'] = _backfill(conn, added)
+        if engine.dialect.name == 'postgresql':
+            for column in added:
+                if not column.nullable and not column.primary_key:
+                    conn.execute(text(f'ALTER TABLE {_quote(column.table.name)} '
+                                      f'ALTER COLUMN {_quote(column.name)} SET NOT NULL'))
+
+    # One transaction per index, so duplicate data behind one unique index
+    # is reported without holding back the others
+    inspector = inspect(engine)
+    for table in old_tables:
+        index_names = {index['name'] for index in inspector.get_indexes(table.name)}
+        for name in OBSOLETE_INDEXES.get(table.name, ()):
+            if name in index_names:
+                with engine.begin() as conn:
+                    conn.execute(text(f'DROP INDEX {_quote(name)}'))
+                report['dropped'].append(name)
+        statements = [(index.name, index) for index in table.indexes if index.name not in index_names]
+        unique = _unique_sets(inspector, table.name)
+        statements += [(name, text(f'CREATE UNIQUE INDEX {_quote(name)} ON {_quote(table.name)} '
+                                   f'({", ".join(_quote(c) for c in columns)})'))
+                       for name, columns in _wanted_uniques(table)
+                       if columns not in unique and name not in index_names]
+        for name, statement in statements:
+            try:
+                with engine.begin() as conn:
+                    if isinstance(statement, db.Index):
+                        statement.create(conn)
+                    else:
+                        conn.execute(statement)
+                report['indexes'].append(name)
+            except SQLAlchemyError as e:
+                log.error('Could not create index %s: %s', name, e)
+                report['failed'].append(name)
+
+    if 'payments' in existing:
+        # Ledger rows from before payments had booking_id
+        linked = payments.link_bookings()
+        db.session.commit()
+        if linked:
+            report['backfilled']['payments.booking_id'] = linked
+    return report
@@ -0,0 +1,157 @@
+import re
+from datetime import date, datetime, time
+from sqlalchemy import func, select
+from sqlalchemy.orm import contains_eager
+from .extensions import db
+from . import geo
+from .models.models import Ride, RideSearchToken, User
+from .pagination import Keyset
+
+SEARCH_FIELDS = ('origin', 'destination')
+MAX_TOKEN_LENGTH = 64
+
+_non_word = re.compile(r'[^0-9a-z]+')
+
+# Listing order; (date, time) leads ix_rides_status_date_time and id breaks ties
+RIDE_KEYSET = Keyset(
+    (Ride.date, Ride.time, Ride.id),
+    (date.fromisoformat, time.fromisoformat, int),
+    key=lambda ride: (ride.date, ride.time, ride.id),
+)
+
+# sort=rating: best Bayesian driver score first, then soonest
+RATING_KEYSET = Keyset(
+    (func.coalesce(User.rating_score, 0.0), Ride.date, Ride.time, Ride.id),
+    (float, date.fromisoformat, time.fromisoformat, int),
+    key=lambda ride: (ride.driver.rating_score or 0.0, ride.date, ride.time, ride.id),
+    descending=(True, False, False, False),
+)
+
+
+def normalize(text):
+    return ' '.join(_non_word.sub(' ', (text or '').lower()).split())
+
+
+def tokenize(text):
+    # Order-preserving de-duplication so the same word is only indexed once
+    tokens = dict.fromkeys(t[:MAX_TOKEN_LENGTH] for t in normalize(text).split())
+    return list(tokens)
+
+
+def _token_rows(ride):
+    return [
+        {'ride_id': ride.id, 'field': field, 'token': token}
+        for field in SEARCH_FIELDS
+        for token in tokenize(getattr(ride, field))
+    ]
+
+
+def index_ride(ride):
+    # Must be called after the ride has an id (i.e. after a flush)
+    geo.locate_ride(ride, normalize)
+    unindex_rides([ride.id])
+    rows = _token_rows(ride)
+    if rows:
+        db.session.execute(RideSearchToken.__table__.insert(), rows)
+
+
+def unindex_rides(ride_ids):
+    RideSearchToken.query.filter(RideSearchToken.ride_id.in_(ride_ids)).delete(synchronize_session=False)
+
+
+def reindex_all(batch_size=1000):
+    RideSearchToken.query.delete(synchronize_session=False)
+    landmarks = geo.landmark_table()
+    indexed = 0
+    last_id = 0
+    while True:
+        batch = Ride.query.filter(Ride.id > last_id).order_by(Ride.id).limit(batch_size).all()
+        if not batch:
+            break
+        for ride in batch:
+            geo.locate_ride(ride, normalize, landmarks)
+        rows = [row for ride in batch for row in _token_rows(ride)]
+        if rows:
+            db.session.execute(RideSearchToken.__table__.insert(), rows)
+        indexed += len(batch)
+        last_id = batch[-1].id
+        db.session.commit()
+    db.session.commit()
+    return indexed
+
+
+def prefix_upper_bound(prefix):
+    # Smallest string greater than every string starting with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _matching_ride_ids(field, token):
+    return select(RideSearchToken.ride_id).where(
+        RideSearchToken.field == field,
+        RideSearchToken.token >= token,
+        RideSearchToken.token < prefix_upper_bound(token),
+    )
+
+
+def open_rides():
+    # Open rides with available seats; served by ix_rides_status_date_time
+    return Ride.query.filter(Ride.status == 'open', Ride.seats > 0)
+
+
+def match_text(query, field, text):
+    # Every word typed must prefix-match a word of the field, e.g. "cov uni"
+    # matches "Covenant University". Range scans on the token index replace
+    # the leading-wildcard ILIKE that forced a full table scan.
+    for token in tokenize(text):
+        query = query.filter(Ride.id.in_(_matching_ride_ids(field, token)))
+    return query
+
+
+def search_rides(origin=None, destination=None, on_date=None):
+    query = match_text(open_rides(), 'origin', origin)
+    query = match_text(query, 'destination', destination)
+    if on_date:
+        query = query.filter(Ride.date == on_date)
+    # Ordering is applied by RIDE_KEYSET when the page is fetched
+    return query
+
+
+def _parse(value, fmt):
+    if value:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return None
+
+
+def search_from_args(args):
+    query = open_rides()
+
+    # A radius (origin_km/destination_km or radius) switches a field from
+    # text matching to the spatial grid index, around either explicit
+    # coordinates or the landmark named in the text box.
+    for field in SEARCH_FIELDS:
+        point = geo.point_from_args(args, field, normalize)
+        if point:
+            query = geo.near(query, field, *point)
+        else:
+            query = match_text(query, field, args.get(field))
+
+    on_date = _parse(args.get('date'), '%Y-%m-%d')
+    if on_date:
+        query = query.filter(Ride.date == on_date.date())
+    time_from = _parse(args.get('time_from'), '%H:%M')
+    if time_from:
+        query = query.filter(Ride.time >= time_from.time())
+    time_to = _parse(args.get('time_to'), '%H:%M')
+    if time_to:
+        query = query.filter(Ride.time <= time_to.time())
+    return query
+
+
+def sort_from_args(query, args):
+    # Returns the query and the keyset that orders and pages it
+    if args.get('sort') == 'rating':
+        return query.join(Ride.driver).options(contains_eager(Ride.driver)), RATING_KEYSET
+    return query, RIDE_KEYSET
@@ -1,33 +1,85 @@
 from . import socketio
-from flask_socketio import emit, join_room, leave_room
+from flask import current_app
+from flask_socketio import emit, join_room, leave_room, rooms
 from flask_login import current_user
-from .extensions import db
-from .models.models import Message, User
+from . import chat_history, notifications
+from .chat_buffer import message_buffer
+from .instrumentation import timed_event
+
+def _ride_id(room):
+    try:
+        return int(room)
+    except (TypeError, ValueError):
+        return None
+
+def _emit_page(event, room, messages, has_more):
+    # Sent only to the requesting client
+    emit(event, {'room': room, 'messages': messages, 'has_more': has_more})
+
+@socketio.on('connect')
+@timed_event('connect')
+def on_connect(auth=None):
+    # Booking updates for this user, from any page
+    if current_user.is_authenticated:
+        join_room(notifications.user_room(current_user.id))
+
+@socketio.on('watch')
+@timed_event('watch')
+def on_watch(data):
+    # Seat and status updates for a ride page the client is showing
+    ride_id = _ride_id(data.get('ride_id'))
+    if current_user.is_authenticated and ride_id is not None:
+        join_room(notifications.ride_room(ride_id))
 
 @socketio.on('join')
+@timed_event('join')
 def on_join(data):
     room = data.get('room')
+    ride_id = _ride_id(room)
+    if ride_id is None or not chat_history.can_access(ride_id, current_user):
+        return
     join_room(room)
     emit('status', {'msg': f'{current_user.name} has joined the chat.'}, room=room)
+    
+    # Reconnecting clients pass the cursor of the last message they hold
+    cursor = chat_history.parse_cursor(data.get('since'))
+    if cursor:
+        limit = current_app.config['CHAT_HISTORY_PAGE_SIZE']
+        _emit_page('sync', room, *chat_history.since(ride_id, cursor, limit))
+
+@socketio.on('sync')
+@timed_event('sync')
+def on_sync(data):
+    room = data.get('room')
+    cursor = chat_history.parse_cursor(data.get('since'))
+    if room in rooms() and cursor:
+        limit = current_app.config['CHAT_HISTORY_PAGE_SIZE']
+        _emit_page('sync', room, *chat_history.since(int(room), cursor, limit))
+
+@socketio.on('history')
+@timed_event('history')
+def on_history(data):
+    room = data.get('room')
+    cursor = chat_history.parse_cursor(data.get('before'))
+    if room in rooms() and cursor:
+        limit = current_app.config['CHAT_HISTORY_PAGE_SIZE']
+        _emit_page('history', room, *chat_history.before(int(room), cursor, limit))
 
 @socketio.on('message')
+@timed_event('message')
 def on_message(data):
     room = data.get('room')
     msg_content = data.get('msg')
     
-    if current_user.is_authenticated:
-        # Save message to DB
-        new_message = Message(
-            ride_id=int(room),
-            sender_id=current_user.id,
-            message=msg_content
-        )
-        db.session.add(new_message)
-        db.session.commit()
+    # Only clients that passed the access check in on_join may post
+    if current_user.is_authenticated and room in rooms():
+        # Queued for a batched write; broadcast without waiting on the DB
+        row = message_buffer.add(int(room), current_user.id, msg_content)
         
         emit('message', {
+            'id': row['uid'],
             'msg': msg_content, 
             'sender': current_user.name,
-            'timestamp': new_message.timestamp.strftime('%Y-%m-%d %H:%M:%S')
+            'timestamp': row['timestamp'].strftime('%Y-%m-%d %H:%M:%S'),
+            'cursor': chat_history.encode_cursor(row)
         }, room=room)
-
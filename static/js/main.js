@@ -14,4 +14,50 @@ document.addEventListener('DOMContentLoaded', function() {
             }, 500); // Wait for fade out to complete
         }, 1000); // 1 second delay
     });
-});
\ No newline at end of file
+});
+
+// Live booking and ride updates (notifications.py). The socket.io client is
+// only loaded for signed-in users.
+window.rideSocket = window.io ? io() : null;
+
+if (window.rideSocket) {
+    const socket = window.rideSocket;
+
+    function showNotice(text) {
+        const container = document.querySelector('.container.mt-5');
+        if (!container) return;
+        const alert = document.createElement('div');
+        alert.className = 'alert alert-info alert-dismissible fade show shadow-sm border-0';
+        alert.setAttribute('role', 'alert');
+        alert.textContent = text;
+        const close = document.createElement('button');
+        close.type = 'button';
+        close.className = 'btn-close';
+        close.setAttribute('data-bs-dismiss', 'alert');
+        alert.appendChild(close);
+        container.prepend(alert);
+    }
+
+    function setText(selector, text) {
+        document.querySelectorAll(selector).forEach(function (el) { el.textContent = text; });
+    }
+
+    socket.on('connect', function () {
+        // Rooms are per connection, so re-watch after every reconnect
+        const rides = new Set();
+        document.querySelectorAll('[data-ride-status], [data-ride-seats]').forEach(function (el) {
+            rides.add(el.dataset.rideStatus || el.dataset.rideSeats);
+        });
+        rides.forEach(function (id) { socket.emit('watch', { ride_id: id }); });
+    });
+
+    socket.on('booking', function (data) {
+        setText('[data-booking-status="' + data.booking_id + '"]', data.status.toUpperCase());
+        if (data.msg) showNotice(data.msg);
+    });
+
+    socket.on('ride', function (data) {
+        if (data.status) setText('[data-ride-status="' + data.ride_id + '"]', data.status.toUpperCase());
+        if (data.seats !== undefined) setText('[data-ride-seats="' + data.ride_id + '"]', data.seats);
+    });
+}
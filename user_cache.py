@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import OrderedDict
+from sqlalchemy.orm import make_transient_to_detached
+from .extensions import db
+from .models.models import User
+
+
+class UserCache:
+    """Bounded LRU + TTL cache for the Flask-Login user loader.
+
+    Column values are cached rather than ORM instances, and are merged back
+    into the current session without a SELECT, so request code can still
+    modify and commit the user as usual. Entries are dropped explicitly via
+    invalidate() whenever a user row changes; the TTL bounds staleness for
+    changes made by other workers.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_size = 4096
+        self.ttl = 60.0
+        self.hits = 0
+        self.misses = 0
+
+    def init_app(self, app):
+        self.max_size = app.config['USER_CACHE_SIZE']
+        self.ttl = app.config['USER_CACHE_TTL']
+        app.extensions['user_cache'] = self
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                values = entry[1]
+            else:
+                self.misses += 1
+                values = None
+
+        if values is None:
+            user = db.session.get(User, user_id)
+            if user is not None:
+                self._store(user_id, {c.key: getattr(user, c.key) for c in User.__table__.columns})
+            return user
+
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def _store(self, user_id, values):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, values)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+user_cache = UserCache()
@@ -1,14 +1,41 @@
-from flask import Blueprint, render_template, redirect, url_for, request, flash, abort, current_app
+from flask import Blueprint, render_template, redirect, url_for, request, flash, abort, current_app, make_response, send_from_directory, session
 from flask_login import login_required, current_user
 from .extensions import db
-from .models.models import User, Ride, Booking, Message, Payment, Rating, Report
-from datetime import datetime
-import os
-from werkzeug.utils import secure_filename
+from . import activity, analytics, chat_history, fares, geo, matching, media, notifications, payments, ratings, reservations, schedules, search
+from .cache import cached_page, conditional, digest, fragment_cache
+from .database import read_only
+from .instrumentation import query_budget
+from .jobs import jobs
+from .user_cache import user_cache
+from .chat_buffer import message_buffer
+from .pagination import Keyset, clamp_page_size
+from .models.models import User, Ride, RideSchedule, Booking, Message, Payment, Rating, Report
+from datetime import datetime, timedelta
+from functools import wraps
+from sqlalchemy import or_
+from sqlalchemy.orm import joinedload
+from markupsafe import Markup
 
 main_bp = Blueprint('main', __name__)
 
+# Dashboard lists, newest first; they lead ix_rides_driver_id and ix_bookings_rider_id
+RECENT_RIDES = Keyset((Ride.id,), (int,), key=lambda ride: (ride.id,), descending=(True,))
+RECENT_BOOKINGS = Keyset((Booking.id,), (int,), key=lambda booking: (booking.id,), descending=(True,))
+
+def is_admin(user):
+    return user.is_authenticated and (user.email or '').lower() in current_app.config['ADMIN_EMAILS']
+
+def admin_required(view):
+    # Goes under @login_required; refuses before the view touches the database
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        if not is_admin(current_user):
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapped
+
 @main_bp.route('/')
+@cached_page
 def index():
     if current_user.is_authenticated:
         return redirect(url_for('main.dashboard'))
@@ -16,10 +43,28 @@ def index():
 
 @main_bp.route('/dashboard')
 @login_required
+@query_budget(3)
+@read_only
 def dashboard():
-    my_rides = Ride.query.filter_by(driver_id=current_user.id).all()
-    my_bookings = Booking.query.filter_by(rider_id=current_user.id).all()
-    return render_template('dashboard.html', my_rides=my_rides, my_bookings=my_bookings)
+    # Totals come from the user's activity row; the lists are one keyset page each
+    limit = current_app.config['DASHBOARD_PAGE_SIZE']
+    pages = {}
+    for name, keyset, query in (
+        ('rides', RECENT_RIDES, Ride.query.filter_by(driver_id=current_user.id)),
+        ('bookings', RECENT_BOOKINGS, Booking.query.options(joinedload(Booking.ride)).filter_by(rider_id=current_user.id)),
+    ):
+        try:
+            pages[name] = keyset.paginate(query, request.args.get(f'{name}_cursor'), limit)
+        except ValueError:
+            pages[name] = keyset.paginate(query, None, limit)
+    
+    def next_url(name):
+        cursor = pages[name][1]
+        return url_for('main.dashboard', **dict(request.args.to_dict(), **{f'{name}_cursor': cursor})) if cursor else None
+    
+    return render_template('dashboard.html', totals=activity.totals(current_user.id),
+                           my_rides=pages['rides'][0], my_bookings=pages['bookings'][0],
+                           rides_next=next_url('rides'), bookings_next=next_url('bookings'))
 
 @main_bp.route('/profile/edit', methods=['GET', 'POST'])
 @login_required
@@ -29,79 +74,114 @@ def edit_profile():
         current_user.phone = request.form.get('phone')
         current_user.student_staff_id = request.form.get('student_staff_id')
         db.session.commit()
+        user_cache.invalidate(current_user.id)
         flash('Profile updated successfully.', 'success')
         return redirect(url_for('main.profile'))
     return render_template('edit_profile.html')
 
 @main_bp.route('/rides')
+@query_budget(3)
+@read_only
 def rides():
-    origin = request.args.get('origin')
-    destination = request.args.get('destination')
-    date_str = request.args.get('date')
-    
-    # Filter for open rides with available seats
-    query = Ride.query.filter(Ride.status == 'open', Ride.seats > 0)
+    limit = clamp_page_size(request.args.get('limit'), current_app.config['RIDES_PAGE_SIZE'],
+                            current_app.config['RIDES_MAX_PAGE_SIZE'])
+    version, modified = fragment_cache.catalog_version()
     
-    if origin:
-        query = query.filter(Ride.origin.ilike(f'%{origin}%'))
-    if destination:
-        query = query.filter(Ride.destination.ilike(f'%{destination}%'))
-    if date_str:
+    def render_results():
+        if request.args.get('sort') == 'match':
+            # Ranked rather than paged; the first call in a while also loads the distance table
+            matches = matching.match_from_args(request.args)
+            if matches is not None:
+                return render_template('_ride_results.html', rides=[m.ride for m in matches],
+                                       matches={m.ride.id: m for m in matches}, next_url=None)
+        query, keyset = search.sort_from_args(search.search_from_args(request.args), request.args)
         try:
-            date_obj = datetime.strptime(date_str, '%Y-%m-%d').date()
-            query = query.filter(Ride.date == date_obj)
+            rides, next_cursor = keyset.paginate(query, request.args.get('cursor'), limit)
         except ValueError:
-            pass
-            
-    rides = query.order_by(Ride.date, Ride.time).all()
-    return render_template('rides.html', rides=rides)
+            # Stale or mangled cursor: start again from the first page
+            rides, next_cursor = keyset.paginate(query, None, limit)
+        
+        next_url = None
+        if next_cursor:
+            args = request.args.to_dict()
+            args['cursor'] = next_cursor
+            next_url = url_for('main.rides', **args)
+        return render_template('_ride_results.html', rides=rides, next_url=next_url)
+    
+    # Results depend only on the search and the catalog version, so equivalent
+    # searches share one rendered fragment until a ride or booking changes
+    params = sorted(
+        (k, search.normalize(v) if k in search.SEARCH_FIELDS else v.strip())
+        for k, v in request.args.items(multi=True) if k != 'limit' and v.strip()
+    )
+    key = f'rides:{version}:{limit}:{digest(*params)}'
+    results_html = Markup(fragment_cache.get_or_render(key, render_results))
+    
+    response = make_response(render_template('rides.html', results_html=results_html))
+    if session.get('_flashes'):
+        return response
+    # Tag what was actually sent, so anything that changes the page changes its ETag
+    return conditional(response, digest(response.get_data(as_text=True)), modified)
 
 @main_bp.route('/bookings/<int:booking_id>/approve')
 @login_required
+@query_budget(4)
 def approve_booking(booking_id):
-    booking = Booking.query.get_or_404(booking_id)
-    ride = Ride.query.get(booking.ride_id)
-    if ride.driver_id != current_user.id:
+    booking = Booking.query.options(joinedload(Booking.ride)).get_or_404(booking_id)
+    ride_id, rider_id = booking.ride_id, booking.rider_id
+    if booking.ride.driver_id != current_user.id:
         abort(403)
     
-    if ride.seats <= 0:
-        flash('No seats available to approve this booking.', 'danger')
-        return redirect(url_for('main.ride_details', ride_id=ride.id))
-
-    booking.status = 'approved'
-    ride.seats -= 1 # Decrement seat count upon approval
-    db.session.commit()
-    flash('Booking approved. Rider can now pay.', 'success')
-    return redirect(url_for('main.ride_details', ride_id=ride.id))
+    result = reservations.approve_booking(booking)
+    if result == reservations.SOLD_OUT:
+        flash('Not enough seats left to approve this booking.', 'danger')
+    elif result == reservations.CONFLICT:
+        flash('This booking is no longer pending.', 'info')
+    else:
+        fragment_cache.bump_catalog()
+        notifications.booking_changed(rider_id, booking_id, ride_id, 'approved',
+                                      'Your booking was approved. You can pay now.')
+        notifications.ride_changed(ride_id, seats=booking.ride.seats)
+        flash('Booking approved. Rider can now pay.', 'success')
+    return redirect(url_for('main.ride_details', ride_id=ride_id))
 
 @main_bp.route('/bookings/<int:booking_id>/pay', methods=['POST'])
 @login_required
+@query_budget(5)
 def pay_booking(booking_id):
-    booking = Booking.query.get_or_404(booking_id)
+    booking = Booking.query.options(joinedload(Booking.ride)).get_or_404(booking_id)
     if booking.rider_id != current_user.id:
         flash('Unauthorized action.', 'danger')
         return redirect(url_for('main.dashboard'))
     
+    if booking.status == 'confirmed':
+        flash('This booking is already paid.', 'info')
+        return redirect(url_for('main.receipt', booking_id=booking.id))
     if booking.status != 'approved':
         flash('Booking must be approved by driver before payment.', 'warning')
         return redirect(url_for('main.ride_details', ride_id=booking.ride_id))
         
-    ride = Ride.query.get(booking.ride_id)
+    ride = booking.ride
     
-    # Simulate payment
-    payment = Payment(
-        ride_id=ride.id,
-        payer_id=current_user.id,
-        amount=ride.price,
-        status='completed',
-        transaction_id=f'TXN-{datetime.utcnow().timestamp()}',
-        paid_at=datetime.utcnow()
-    )
+    # Simulate payment. A resubmitted form or a retry with the same
+    # Idempotency-Key gets the original charge back rather than a second one.
+    try:
+        payment, created = payments.charge(booking, fares.rider_cost(ride.price, booking.seats_booked),
+                                           request.headers.get('Idempotency-Key'))
+    except payments.DuplicateKey as e:
+        flash(str(e), 'danger')
+        return redirect(url_for('main.ride_details', ride_id=booking.ride_id))
+    if not created:
+        db.session.rollback()
+        flash('This booking is already paid.', 'info')
+        return redirect(url_for('main.receipt', booking_id=booking_id))
     
-    booking.status = 'confirmed'
-    # ride.seats -= booking.seats_booked # Removed: Seats already deducted on approval
-    db.session.add(payment)
+    activity.paid(current_user.id, ride.driver_id, payment.amount, booking.seats_booked)
+    driver_id, ride_id, rider_id, rider_name = ride.driver_id, ride.id, current_user.id, current_user.name
     db.session.commit()
+    fares.invalidate(rider_id, driver_id)
+    notifications.booking_changed(driver_id, booking_id, ride_id, 'confirmed',
+                                  f'{rider_name} paid for booking #{booking_id}.')
     
     flash('Payment successful! Booking confirmed.', 'success')
     return redirect(url_for('main.ride_details', ride_id=ride.id))
@@ -132,14 +212,19 @@ def create_ride():
                 date=date_obj,
                 time=time_obj,
                 seats=int(seats),
-                price=float(price)
+                price=fares.parse_price(price)
             )
+            new_ride.origin_lat, new_ride.origin_lon = geo.coordinates_from(request.form, 'origin')
+            new_ride.destination_lat, new_ride.destination_lon = geo.coordinates_from(request.form, 'destination')
             db.session.add(new_ride)
+            db.session.flush()
+            search.index_ride(new_ride)
             db.session.commit()
+            fragment_cache.bump_catalog()
             flash('Ride created successfully!', 'success')
             return redirect(url_for('main.dashboard'))
-        except ValueError:
-            flash('Invalid date or time format.', 'danger')
+        except (TypeError, ValueError):
+            flash('Check the date, time, seats and price.', 'danger')
             
     return render_template('create_ride.html')
 
@@ -155,17 +240,21 @@ def edit_ride(ride_id):
         ride.destination = request.form.get('destination')
         date_str = request.form.get('date')
         time_str = request.form.get('time')
-        ride.seats = int(request.form.get('seats'))
-        ride.price = float(request.form.get('price'))
+        ride.origin_lat, ride.origin_lon = geo.coordinates_from(request.form, 'origin')
+        ride.destination_lat, ride.destination_lon = geo.coordinates_from(request.form, 'destination')
         
         try:
+            ride.seats = int(request.form.get('seats'))
+            ride.price = fares.parse_price(request.form.get('price'))
             ride.date = datetime.strptime(date_str, '%Y-%m-%d').date()
             ride.time = datetime.strptime(time_str, '%H:%M:%S').time() if len(time_str) == 8 else datetime.strptime(time_str, '%H:%M').time()
-        except ValueError:
-            flash('Invalid date or time format.', 'danger')
+        except (TypeError, ValueError):
+            flash('Check the date, time, seats and price.', 'danger')
             return render_template('edit_ride.html', ride=ride)
 
+        search.index_ride(ride)
         db.session.commit()
+        fragment_cache.bump_catalog()
         flash('Ride updated successfully.', 'success')
         return redirect(url_for('main.ride_details', ride_id=ride.id))
         
@@ -179,28 +268,33 @@ def delete_ride(ride_id):
         abort(403)
     
     # Delete associated bookings, messages, etc. (Cascade delete would be better in models)
+    message_buffer.discard(ride.id)
     Booking.query.filter_by(ride_id=ride.id).delete()
     Message.query.filter_by(ride_id=ride.id).delete()
+    search.unindex_rides([ride.id])
     
     db.session.delete(ride)
     db.session.commit()
+    fragment_cache.bump_catalog()
     flash('Ride deleted.', 'success')
     return redirect(url_for('main.dashboard'))
 
 @main_bp.route('/rides/<int:ride_id>')
 @login_required
+@query_budget(4)
+@read_only
 def ride_details(ride_id):
-    ride = Ride.query.get_or_404(ride_id)
-    driver = User.query.get(ride.driver_id)
+    ride = Ride.query.options(joinedload(Ride.driver)).get_or_404(ride_id)
+    driver = ride.driver
     booking = Booking.query.filter_by(ride_id=ride_id, rider_id=current_user.id).first()
     payment = None
     if booking:
-        payment = Payment.query.filter_by(ride_id=ride_id, payer_id=current_user.id).first()
+        payment = Payment.query.filter_by(booking_id=booking.id, kind='charge').first()
         
     # For driver: get all bookings
     driver_bookings = []
     if ride.driver_id == current_user.id:
-        driver_bookings = Booking.query.filter_by(ride_id=ride_id).all()
+        driver_bookings = Booking.query.options(joinedload(Booking.rider)).filter_by(ride_id=ride_id).all()
         
     return render_template('ride_details.html', ride=ride, driver=driver, booking=booking, payment=payment, driver_bookings=driver_bookings)
 
@@ -212,33 +306,45 @@ def book_ride(ride_id):
         flash('You cannot book your own ride.', 'warning')
         return redirect(url_for('main.ride_details', ride_id=ride_id))
         
+    seats = request.form.get('seats', 1, type=int)
     if ride.seats <= 0:
         flash('No seats available.', 'danger')
         return redirect(url_for('main.ride_details', ride_id=ride_id))
+    if seats is None or not 1 <= seats <= ride.seats:
+        flash(f'You can request between 1 and {ride.seats} seats.', 'warning')
+        return redirect(url_for('main.ride_details', ride_id=ride_id))
 
-    existing_booking = Booking.query.filter_by(ride_id=ride_id, rider_id=current_user.id).first()
-    if existing_booking:
+    # Seats are only taken when the driver approves (see reservations.approve_booking)
+    if reservations.request_booking(ride, current_user.id, seats) is None:
         flash('You have already booked this ride.', 'info')
         return redirect(url_for('main.ride_details', ride_id=ride_id))
 
-    booking = Booking(ride_id=ride_id, rider_id=current_user.id, status='pending')
-    db.session.add(booking)
-    db.session.commit()
     flash('Booking requested!', 'success')
     return redirect(url_for('main.ride_details', ride_id=ride_id))
 
 @main_bp.route('/bookings/<int:booking_id>/reject')
 @login_required
+@query_budget(7)
 def reject_booking(booking_id):
-    booking = Booking.query.get_or_404(booking_id)
-    ride = Ride.query.get(booking.ride_id)
+    booking = Booking.query.options(joinedload(Booking.ride)).get_or_404(booking_id)
+    ride = booking.ride
     if ride.driver_id != current_user.id:
         abort(403)
-        
-    booking.status = 'rejected'
-    db.session.commit()
+
+    rider_id, ride_id, held_seats = booking.rider_id, ride.id, booking.status in reservations.HOLDS_SEATS
+    result = reservations.reject_booking(booking)
+    if result == reservations.CONFLICT:
+        flash('This booking can no longer be rejected.', 'info')
+        return redirect(url_for('main.ride_details', ride_id=ride_id))
+
+    if held_seats:
+        fragment_cache.bump_catalog()
+        notifications.ride_changed(ride_id, seats=db.session.get(Ride, ride_id).seats)
+    notifications.booking_changed(rider_id, booking_id, ride_id, 'rejected',
+                                  'Your booking was declined. Any payment has been refunded.'
+                                  if held_seats else 'Your booking request was declined.')
     flash('Booking rejected.', 'info')
-    return redirect(url_for('main.ride_details', ride_id=ride.id))
+    return redirect(url_for('main.ride_details', ride_id=ride_id))
 
 @main_bp.route('/rides/<int:ride_id>/rate/<int:user_id>', methods=['GET', 'POST'])
 @login_required
@@ -255,8 +361,11 @@ def rate_user(ride_id, user_id):
         return redirect(url_for('main.dashboard'))
         
     if request.method == 'POST':
-        stars = int(request.form.get('stars'))
+        stars = request.form.get('stars', type=int)
         comment = request.form.get('comment')
+        if stars is None or not 1 <= stars <= 5:
+            flash('Rating must be between 1 and 5 stars.', 'danger')
+            return render_template('rate_user.html', user=ratee, ride=ride)
         
         rating = Rating(
             ride_id=ride_id,
@@ -266,13 +375,11 @@ def rate_user(ride_id, user_id):
             comment=comment
         )
         db.session.add(rating)
-        
-        # Update average rating
-        ratings = Rating.query.filter_by(ratee_id=user_id).all()
-        total_stars = sum(r.stars for r in ratings) + stars
-        ratee.rating_avg = total_stars / (len(ratings) + 1)
-        
+        ratings.record_rating(user_id, stars)
         db.session.commit()
+        user_cache.invalidate(user_id)
+        # Listings show and sort by driver ratings
+        fragment_cache.bump_catalog()
         flash('Rating submitted!', 'success')
         return redirect(url_for('main.ride_details', ride_id=ride_id))
         
@@ -285,13 +392,13 @@ def profile():
         if 'photo' in request.files:
             file = request.files['photo']
             if file.filename != '':
-                filename = secure_filename(file.filename)
-                # Ensure upload directory exists
-                os.makedirs(current_app.config['UPLOAD_FOLDER'], exist_ok=True)
-                file.save(os.path.join(current_app.config['UPLOAD_FOLDER'], filename))
-                current_user.photo_url = url_for('static', filename='uploads/' + filename)
-                db.session.commit()
-                flash('Profile photo updated.', 'success')
+                photo_hash = media.save_upload(file)
+                if photo_hash is None:
+                    flash('That file is not a supported image.', 'danger')
+                else:
+                    # Resized in the background; the new photo shows once its sizes exist
+                    jobs.enqueue('make_photo_variants', current_user.id, photo_hash)
+                    flash('Profile photo uploaded. It will appear shortly.', 'success')
         
         # Handle other profile updates if needed (e.g. phone number)
         
@@ -299,46 +406,124 @@ def profile():
         
     return render_template('profile.html')
 
+@main_bp.route('/media/<path:filename>')
+def media_file(filename):
+    # Variant names contain the content hash, so they can be cached for good
+    response = send_from_directory(media.variants_folder(), filename,
+                                   max_age=current_app.config['MEDIA_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 @main_bp.route('/calculator')
+@cached_page
 def calculator():
-    return render_template('calculator.html')
+    # Plain GET form, so results are bookmarkable and query strings skip the page cache
+    form = {'price': request.args.get('price', ''), 'seats': request.args.get('seats', '4'),
+            'seats_booked': request.args.get('seats_booked', '1')}
+    result = error = None
+    if request.args:
+        try:
+            price, seats, seats_booked = fares.parse_price(form['price']), int(form['seats']), int(form['seats_booked'])
+            if seats < 1 or not 1 <= seats_booked <= seats:
+                raise ValueError
+            result = fares.estimate(price, seats, seats_booked)
+        except ValueError:
+            error = 'Enter a price, at least one seat, and no more seats booked than offered.'
+    summary = fares.summary(current_user.id) if current_user.is_authenticated else None
+    return render_template('calculator.html', form=form, result=result, error=error, summary=summary)
 
 @main_bp.route('/admin')
 @login_required
+@admin_required
+@query_budget(8)
+@read_only
 def admin_dashboard():
-    # Simple check for admin (could be a role field or specific email)
-    if current_user.email != 'admin@covenant.edu.ng': # Example admin check
-         # In a real app, use a role field
-         pass 
-         
-    pending_users = User.query.filter_by(verified=False).all()
-    all_users = User.query.all()
-    all_rides = Ride.query.all()
-    reports = Report.query.filter_by(status='pending').all()
-    return render_template('admin.html', pending_users=pending_users, all_users=all_users, all_rides=all_rides, reports=reports)
+    # Only the selected tab's table is queried, one page at a time
+    tab = request.args.get('tab', 'pending')
+    q = (request.args.get('q') or '').strip()
+    page = request.args.get('page', 1, type=int)
+    per_page = current_app.config['ADMIN_PAGE_SIZE']
+    
+    if tab == 'users':
+        query = User.query
+        verified = request.args.get('verified')
+        if verified in ('yes', 'no'):
+            query = query.filter(User.verified == (verified == 'yes'))
+        if q:
+            query = query.filter(or_(User.email.ilike(f'{q}%'), User.name.ilike(f'{q}%')))
+        query = query.order_by(User.id.desc())
+    elif tab == 'rides':
+        query = Ride.query.options(joinedload(Ride.driver))
+        status = request.args.get('status')
+        if status:
+            query = query.filter(Ride.status == status)
+        query = search.match_text(query, 'origin', request.args.get('origin'))
+        query = search.match_text(query, 'destination', request.args.get('destination'))
+        query = query.order_by(Ride.id.desc())
+    elif tab == 'reports':
+        query = Report.query.options(joinedload(Report.reporter), joinedload(Report.reported_user)) \
+            .filter_by(status='pending').order_by(Report.id)
+    else:
+        tab = 'pending'
+        query = User.query.filter(User.verified.isnot(True))
+        if q:
+            query = query.filter(or_(User.email.ilike(f'{q}%'), User.name.ilike(f'{q}%')))
+        query = query.order_by(User.id)
+    
+    pagination = query.paginate(page=page, per_page=per_page, error_out=False)
+    return render_template('admin.html', tab=tab, pagination=pagination, summary=analytics.admin_summary())
 
 @main_bp.route('/admin/verify/<int:user_id>')
 @login_required
+@admin_required
 def verify_user(user_id):
-    # Add admin check here
     user = User.query.get_or_404(user_id)
     user.verified = True
     db.session.commit()
+    user_cache.invalidate(user.id)
     flash(f'User {user.name} verified.', 'success')
     return redirect(url_for('main.admin_dashboard'))
 
+@main_bp.route('/admin/verify', methods=['POST'])
+@login_required
+@admin_required
+def verify_users():
+    user_ids = request.form.getlist('user_ids', type=int)
+    if user_ids:
+        # One UPDATE for the whole selection instead of a round trip per user
+        count = User.query.filter(User.id.in_(user_ids), User.verified.isnot(True)) \
+            .update({User.verified: True}, synchronize_session=False)
+        db.session.commit()
+        user_cache.invalidate(*user_ids)
+        flash(f'{count} users verified.', 'success')
+    else:
+        flash('No users selected.', 'info')
+    return redirect(url_for('main.admin_dashboard', tab='pending'))
+
+@main_bp.route('/admin/reports/<int:report_id>/resolve')
+@login_required
+@admin_required
+def resolve_report(report_id):
+    report = Report.query.get_or_404(report_id)
+    report.status = 'resolved'
+    db.session.commit()
+    flash('Report resolved.', 'success')
+    return redirect(url_for('main.admin_dashboard', tab='reports'))
+
 @main_bp.route('/bookings/<int:booking_id>/receipt')
 @login_required
+@query_budget(2)
 def receipt(booking_id):
-    booking = Booking.query.get_or_404(booking_id)
-    payment = Payment.query.filter_by(ride_id=booking.ride_id, payer_id=booking.rider_id).first()
+    booking = Booking.query.options(joinedload(Booking.ride).joinedload(Ride.driver)).get_or_404(booking_id)
+    payment = Payment.query.filter_by(booking_id=booking.id, kind='charge').first()
     
     if not payment:
         flash('No payment found for this booking.', 'warning')
         return redirect(url_for('main.dashboard'))
         
-    ride = Ride.query.get(booking.ride_id)
-    driver = User.query.get(ride.driver_id)
+    ride = booking.ride
+    driver = ride.driver
     
     return render_template('receipt.html', booking=booking, payment=payment, ride=ride, driver=driver)
 
@@ -348,9 +533,19 @@ def complete_ride(ride_id):
     ride = Ride.query.get_or_404(ride_id)
     if ride.driver_id != current_user.id:
         abort(403)
+    if ride.status in ('completed', 'cancelled'):
+        flash(f'This ride is already {ride.status}.', 'warning')
+        return redirect(url_for('main.ride_details', ride_id=ride.id))
         
+    riders = db.session.query(Booking.id, Booking.rider_id).filter_by(ride_id=ride_id, status='confirmed').all()
     ride.status = 'completed'
+    activity.ride_completed(ride.driver_id, [rider_id for _, rider_id in riders])
     db.session.commit()
+    fragment_cache.bump_catalog()
+    notifications.ride_changed(ride_id, status='completed')
+    for booking_id, rider_id in riders:
+        notifications.booking_changed(rider_id, booking_id, ride_id, 'completed',
+                                      'Your ride is complete. Rate your driver from the ride page.')
     flash('Ride marked as completed.', 'success')
     return redirect(url_for('main.ride_details', ride_id=ride.id))
 
@@ -360,28 +555,117 @@ def cancel_ride(ride_id):
     ride = Ride.query.get_or_404(ride_id)
     if ride.driver_id != current_user.id:
         abort(403)
+    if ride.status in ('completed', 'cancelled'):
+        flash(f'This ride is already {ride.status}.', 'warning')
+        return redirect(url_for('main.ride_details', ride_id=ride.id))
         
     ride.status = 'cancelled'
-    # Logic to refund bookings could go here
+    activity.rides_cancelled(ride.driver_id)
     db.session.commit()
+    fragment_cache.bump_catalog()
+    notifications.ride_changed(ride_id, status='cancelled')
+    # Cancelling bookings and refunding payments scales with the number of riders.
+    # The queue isn't durable; `flask maintain-rides` re-runs anything left unfinished.
+    jobs.enqueue('cancel_ride_bookings', ride.id)
     flash('Ride cancelled.', 'warning')
     return redirect(url_for('main.ride_details', ride_id=ride.id))
 
+@main_bp.route('/schedules')
+@login_required
+def my_schedules():
+    my = RideSchedule.query.filter_by(driver_id=current_user.id).order_by(RideSchedule.id.desc()).all()
+    upcoming = dict(db.session.query(Ride.schedule_id, db.func.count(Ride.id))
+                    .filter(Ride.schedule_id.in_([s.id for s in my]), Ride.date >= datetime.now().date(),
+                            Ride.status == 'open')
+                    .group_by(Ride.schedule_id).all()) if my else {}
+    return render_template('schedules.html', schedules=my, upcoming=upcoming, weekdays_label=schedules.weekdays_label)
+
+@main_bp.route('/schedules/create', methods=['GET', 'POST'])
+@login_required
+def create_schedule():
+    if not current_user.verified:
+        flash('You must be verified to create a ride.', 'warning')
+        return redirect(url_for('main.dashboard'))
+    
+    schedule = RideSchedule(driver_id=current_user.id, status='active')
+    if request.method == 'POST':
+        try:
+            schedules.update_from_form(schedule, request.form)
+        except ValueError as e:
+            flash(str(e), 'danger')
+            return render_template('schedule_form.html', schedule=None, weekday_names=schedules.WEEKDAY_NAMES)
+        
+        db.session.add(schedule)
+        db.session.flush()
+        created = schedules.generate(schedule, datetime.now().date() + timedelta(days=current_app.config['SCHEDULE_WINDOW_DAYS']))
+        db.session.commit()
+        fragment_cache.bump_catalog()
+        flash(f'Recurring ride created; {created} upcoming rides are now listed.', 'success')
+        return redirect(url_for('main.my_schedules'))
+    
+    return render_template('schedule_form.html', schedule=None, weekday_names=schedules.WEEKDAY_NAMES)
+
+@main_bp.route('/schedules/<int:schedule_id>/edit', methods=['GET', 'POST'])
+@login_required
+def edit_schedule(schedule_id):
+    schedule = RideSchedule.query.get_or_404(schedule_id)
+    if schedule.driver_id != current_user.id:
+        abort(403)
+    if schedule.status != 'active':
+        flash('This recurring ride has been cancelled.', 'info')
+        return redirect(url_for('main.my_schedules'))
+    
+    if request.method == 'POST':
+        old_seats = schedule.seats
+        try:
+            schedules.update_from_form(schedule, request.form, editing=True)
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e), 'danger')
+            return redirect(url_for('main.edit_schedule', schedule_id=schedule.id))
+        
+        updated, dropped = schedules.propagate(schedule, old_seats)
+        activity.rides_cancelled(schedule.driver_id, len(dropped))
+        db.session.commit()
+        fragment_cache.bump_catalog()
+        if dropped:
+            jobs.enqueue('cancel_ride_bookings', *dropped)
+        flash(f'Recurring ride updated; {len(updated)} upcoming rides changed.', 'success')
+        return redirect(url_for('main.my_schedules'))
+    
+    return render_template('schedule_form.html', schedule=schedule, weekday_names=schedules.WEEKDAY_NAMES)
+
+@main_bp.route('/schedules/<int:schedule_id>/cancel', methods=['POST'])
+@login_required
+def cancel_schedule(schedule_id):
+    schedule = RideSchedule.query.get_or_404(schedule_id)
+    if schedule.driver_id != current_user.id:
+        abort(403)
+    
+    cancelled = schedules.cancel(schedule)
+    activity.rides_cancelled(schedule.driver_id, len(cancelled))
+    db.session.commit()
+    fragment_cache.bump_catalog()
+    for ride_id in cancelled:
+        notifications.ride_changed(ride_id, status='cancelled')
+    if cancelled:
+        jobs.enqueue('cancel_ride_bookings', *cancelled)
+    flash(f'Recurring ride cancelled along with {len(cancelled)} upcoming rides.', 'warning')
+    return redirect(url_for('main.my_schedules'))
+
 @main_bp.route('/rides/<int:ride_id>/chat')
 @login_required
 def ride_chat(ride_id):
     ride = Ride.query.get_or_404(ride_id)
     
     # Check if user is driver or confirmed rider
-    is_driver = ride.driver_id == current_user.id
-    is_rider = Booking.query.filter_by(ride_id=ride_id, rider_id=current_user.id, status='confirmed').first() is not None
-    
-    if not (is_driver or is_rider):
+    if not chat_history.can_access(ride_id, current_user):
         flash('You are not authorized to view this chat.', 'danger')
         return redirect(url_for('main.dashboard'))
-        
-    messages = Message.query.filter_by(ride_id=ride_id).order_by(Message.timestamp).all()
-    return render_template('chat.html', ride=ride, messages=messages)
+    
+    # Only the latest page; older messages are fetched over Socket.IO on scroll
+    messages, has_more = chat_history.latest(ride_id, current_app.config['CHAT_HISTORY_PAGE_SIZE'])
+    return render_template('chat.html', ride=ride, messages=messages, has_more=has_more)
 
 @main_bp.route('/report/user/<int:user_id>', methods=['GET', 'POST'])
 @login_required